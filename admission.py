@@ -0,0 +1,189 @@
+import asyncio
+import fnmatch
+import heapq
+import itertools
+import logging
+import os
+import re
+from datetime import datetime, timezone
+from metrics import ADMISSION_QUEUE_DEPTH, ADMISSION_WAIT, ADMISSION_CAPACITY, ADMISSION_ADMITTED
+
+logger = logging.getLogger(__name__)
+
+ADMISSION_MAX_ENVIRONMENTS = int(os.environ.get("ADMISSION_MAX_ENVIRONMENTS", "0")) # environments admitted at once; 0 means no count limit
+ADMISSION_CPU_BUDGET = os.environ.get("ADMISSION_CPU_BUDGET", "") # total CPU requests previews may use, e.g. "16"; empty means no quota
+ADMISSION_MEMORY_BUDGET = os.environ.get("ADMISSION_MEMORY_BUDGET", "") # total memory requests previews may use, e.g. "64Gi"; empty means no quota
+ADMISSION_NODE_SELECTOR = os.environ.get("ADMISSION_NODE_SELECTOR", "") # label selector of the preview node pool whose allocatable is the budget
+ADMISSION_PRIORITIES = os.environ.get("ADMISSION_PRIORITIES", "") # "release/*=100,main=50": branch pattern -> priority, higher first
+ADMISSION_RETRY_SECONDS = int(os.environ.get("ADMISSION_RETRY_SECONDS", "10")) # how often a queued create checks whether it was admitted
+ADMISSION_REFRESH_SECONDS = 60 # how often the node pool's allocatable is re-read
+
+_SUFFIXES = {
+    "m": 0.001, "k": 1e3, "M": 1e6, "G": 1e9, "T": 1e12,
+    "Ki": 2 ** 10, "Mi": 2 ** 20, "Gi": 2 ** 30, "Ti": 2 ** 40,
+}
+
+
+def parse_quantity(quantity):
+    """Kubernetes resource quantity ("250m", "128Mi", "2") as a float."""
+    if isinstance(quantity, (int, float)):
+        return float(quantity)
+    match = re.fullmatch(r"([0-9.]+)([a-zA-Z]*)", str(quantity).strip())
+    if match is None or match.group(2) not in ("", *_SUFFIXES):
+        raise ValueError(f"invalid quantity: {quantity}")
+    return float(match.group(1)) * _SUFFIXES.get(match.group(2), 1)
+
+def parse_priorities(config):
+    """"pattern=priority,..." -> [(pattern, priority)], in the order given."""
+    priorities = []
+    for item in filter(None, (part.strip() for part in config.split(","))):
+        pattern, _, priority = item.rpartition("=")
+        priorities.append((pattern, int(priority)))
+    return priorities
+
+def branch_priority(branch_name, priorities):
+    """Priority of the first pattern matching `branch_name`, else 0."""
+    for pattern, priority in priorities:
+        if fnmatch.fnmatchcase(branch_name or "", pattern):
+            return priority
+    return 0
+
+def slots_for(budget, request):
+    """How many environments requesting `request` fit in `budget` (both resource -> quantity)."""
+    # The epsilon keeps e.g. 1 / 0.1 from flooring to 9
+    return min(int(parse_quantity(budget[resource]) / parse_quantity(request[resource]) + 1e-9) for resource in budget)
+
+
+class AdmissionQueue:
+    """Holds new environments back until the preview budget has room for them.
+
+    Every admitted environment takes one slot. The number of slots is the
+    tightest of `max_environments`, the configured `budget` divided by the
+    per-environment `request`, and (when `list_nodes` is given) the node
+    pool's allocatable divided the same way. With sharding, each replica
+    gets `1 / members()` of it. Environments that don't fit wait in
+    priority order (higher first, then oldest first) and are admitted
+    when release() frees a slot. An admitted environment keeps its slot
+    until release(), even if its create is still being retried.
+    """
+
+    def __init__(self, request, max_environments=ADMISSION_MAX_ENVIRONMENTS,
+                 budget=None, list_nodes=None, members=lambda: 1, refresh_interval=ADMISSION_REFRESH_SECONDS):
+        self.request = request
+        self.max_environments = max_environments
+        self.budget = budget if budget is not None else {
+            resource: value for resource, value in (("cpu", ADMISSION_CPU_BUDGET), ("memory", ADMISSION_MEMORY_BUDGET)) if value
+        }
+        self._list_nodes = list_nodes
+        self._members = members
+        self.refresh_interval = refresh_interval
+        self._pool_slots = None
+        self._admitted = set()
+        self._waiting = []  # (-priority, created_at, sequence, key)
+        self._queued = {}  # key -> heap entry
+        self._sequence = itertools.count()
+        self._task = None
+        ADMISSION_QUEUE_DEPTH.set_function(lambda: len(self._queued))
+        ADMISSION_ADMITTED.set_function(lambda: len(self._admitted))
+        ADMISSION_CAPACITY.set_function(lambda: self.capacity() if self.enabled else 0)
+
+    @property
+    def enabled(self):
+        return bool(self.max_environments or self.budget or self._list_nodes)
+
+    def capacity(self):
+        """Slots this replica may fill, or None without any limit."""
+        limits = []
+        if self.max_environments:
+            limits.append(self.max_environments)
+        if self.budget:
+            limits.append(slots_for(self.budget, self.request))
+        if self._pool_slots is not None:
+            limits.append(self._pool_slots)
+        if not limits:
+            return None
+        return min(limits) // max(1, self._members())
+
+    def admitted(self, key):
+        return key in self._admitted
+
+    def position(self, key):
+        """1-based place of `key` in the queue, or None if it isn't queued."""
+        entry = self._queued.get(key)
+        if entry is None:
+            return None
+        return sorted(self._queued.values()).index(entry) + 1
+
+    def try_admit(self, key, priority=0, created_at=None):
+        """Queue `key` if new and admit whatever fits. Returns (admitted, queue position)."""
+        if key in self._admitted:
+            return True, None
+        if key not in self._queued:
+            entry = (-priority, created_at or datetime.now(timezone.utc), next(self._sequence), key)
+            self._queued[key] = entry
+            heapq.heappush(self._waiting, entry)
+        self._dispatch()
+        return key in self._admitted, self.position(key)
+
+    def mark_admitted(self, key):
+        """Count an environment that already exists (at startup, or adopted from another replica)."""
+        self._forget_queued(key)
+        self._admitted.add(key)
+
+    def release(self, key):
+        """Free the slot of a deleted environment, or drop it from the queue."""
+        self._admitted.discard(key)
+        self._forget_queued(key)
+        self._dispatch()
+
+    def _forget_queued(self, key):
+        entry = self._queued.pop(key, None)
+        if entry is not None:
+            self._waiting.remove(entry)
+            heapq.heapify(self._waiting)
+
+    def _dispatch(self):
+        capacity = self.capacity()
+        while self._waiting and (capacity is None or len(self._admitted) < capacity):
+            _, _, _, key = heapq.heappop(self._waiting)
+            del self._queued[key]
+            self._admitted.add(key)
+            logger.info(f"Admitted {key[1]} ({len(self._admitted)}/{capacity if capacity is not None else 'unlimited'} slots)")
+
+    def observe_wait(self, created_at):
+        ADMISSION_WAIT.observe(max(0.0, (datetime.now(timezone.utc) - created_at).total_seconds()))
+
+    async def refresh(self):
+        """Re-read the node pool's allocatable and admit whatever now fits."""
+        allocatable = {resource: 0.0 for resource in self.request}
+        for node in await self._list_nodes():
+            for resource in allocatable:
+                allocatable[resource] += parse_quantity((node.status.allocatable or {}).get(resource, "0"))
+        self._pool_slots = slots_for(allocatable, self.request)
+        self._dispatch()
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.warning(f"Reading the preview node pool failed: {e}")
+
+    async def start(self):
+        """Read the node pool once before any create is admitted, then keep it current."""
+        if self._list_nodes is not None and self._task is None:
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.warning(f"Reading the preview node pool failed: {e}")
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
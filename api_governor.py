@@ -0,0 +1,168 @@
+import asyncio
+import contextlib
+import contextvars
+import heapq
+import itertools
+import logging
+import os
+import time
+from kubernetes_asyncio.client.exceptions import ApiException
+from metrics import API_QUEUE_DEPTH, API_QUEUE_WAIT, API_IN_FLIGHT, API_THROTTLED, API_RETRIES
+from tracing import request_labels
+
+logger = logging.getLogger(__name__)
+
+API_QPS = float(os.environ.get("K8S_API_QPS", "50")) # sustained API requests per second
+API_BURST = int(os.environ.get("K8S_API_BURST", "100")) # requests allowed above the sustained rate after an idle period
+API_MAX_IN_FLIGHT = int(os.environ.get("K8S_API_MAX_IN_FLIGHT", "32")) # concurrent API requests
+API_MAX_RETRIES = int(os.environ.get("K8S_API_MAX_RETRIES", "5")) # retries of a request throttled with 429
+THROTTLE_BACKOFF_SECONDS = 1 # wait after a 429 without Retry-After, doubled per retry
+
+# Lower runs first: deletes free capacity, creates are what users wait on, updates can lag
+DELETE, CREATE, UPDATE, BACKGROUND = 0, 1, 2, 3
+PRIORITY_NAMES = {DELETE: "delete", CREATE: "create", UPDATE: "update", BACKGROUND: "background"}
+
+_priority = contextvars.ContextVar("api_priority", default=None)
+
+
+@contextlib.contextmanager
+def api_priority(priority):
+    """Run the API calls made inside this block (and tasks started from it) at `priority`."""
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+def request_priority(method):
+    priority = _priority.get()
+    if priority is not None:
+        return priority
+    if method == "DELETE":
+        return DELETE
+    return BACKGROUND if method == "GET" else UPDATE
+
+def retry_after(e, attempt):
+    try:
+        return float((e.headers or {}).get("Retry-After"))
+    except (TypeError, ValueError):
+        return THROTTLE_BACKOFF_SECONDS * 2 ** attempt
+
+
+class ApiGovernor:
+    """Client-side rate limiter and concurrency cap for the shared ApiClient.
+
+    Every request takes a token from a bucket refilled at `qps` (up to
+    `burst`) and a slot out of `max_in_flight`. When either runs out,
+    requests queue and are admitted lowest priority value first (FIFO
+    within a priority). A 429 pauses all admissions for its Retry-After
+    and the request is retried, up to `max_retries` times.
+    Watches are long-lived and bypass the governor.
+    """
+
+    def __init__(self, qps=API_QPS, burst=API_BURST, max_in_flight=API_MAX_IN_FLIGHT, max_retries=API_MAX_RETRIES):
+        self.qps = qps
+        self.burst = burst
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self._tokens = float(burst)
+        self._refilled = time.monotonic()
+        self._paused_until = 0.0
+        self._in_flight = 0
+        self._waiters = []  # (priority, sequence, future)
+        self._sequence = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._dispatcher = None
+
+    def queued(self):
+        return len(self._waiters)
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.qps)
+        self._refilled = now
+
+    def _delay(self):
+        """Seconds until a request could be admitted, or None if blocked on the in-flight cap."""
+        if self._in_flight >= self.max_in_flight:
+            return None
+        now = time.monotonic()
+        self._refill(now)
+        return max(self._paused_until - now, (1 - self._tokens) / self.qps if self._tokens < 1 else 0, 0)
+
+    def _admit(self):
+        self._tokens -= 1
+        self._in_flight += 1
+        API_IN_FLIGHT.set(self._in_flight)
+
+    def _release(self):
+        self._in_flight -= 1
+        API_IN_FLIGHT.set(self._in_flight)
+        self._wakeup.set()
+
+    async def acquire(self, priority):
+        if not self._waiters and self._delay() == 0:
+            self._admit()
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), future))
+        API_QUEUE_DEPTH.labels(priority=PRIORITY_NAMES[priority]).inc()
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        self._wakeup.set()
+        started = time.monotonic()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release()  # admitted just as we were cancelled
+            raise
+        API_QUEUE_WAIT.labels(priority=PRIORITY_NAMES[priority]).observe(time.monotonic() - started)
+
+    async def _dispatch(self):
+        while self._waiters:
+            priority, _, future = self._waiters[0]
+            if future.cancelled():
+                heapq.heappop(self._waiters)
+                API_QUEUE_DEPTH.labels(priority=PRIORITY_NAMES[priority]).dec()
+                continue
+            delay = self._delay()
+            if delay == 0:
+                heapq.heappop(self._waiters)
+                API_QUEUE_DEPTH.labels(priority=PRIORITY_NAMES[priority]).dec()
+                self._admit()
+                future.set_result(None)
+                continue
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def throttled(self, seconds):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def call(self, send, method, url, query_params=None, **kwargs):
+        if any(key == "watch" and value for key, value in query_params or []):
+            return await send(method, url, query_params=query_params, **kwargs)
+        priority = request_priority(method)
+        for attempt in itertools.count():
+            await self.acquire(priority)
+            try:
+                return await send(method, url, query_params=query_params, **kwargs)
+            except ApiException as e:
+                if e.status != 429 or attempt >= self.max_retries:
+                    raise
+                delay = retry_after(e, attempt)
+                API_THROTTLED.inc()
+                verb, resource = request_labels(method, url, query_params)
+                API_RETRIES.labels(verb=verb, resource=resource).inc()
+                logger.warning(f"API server throttled {method} {url}, retrying in {delay:.1f}s")
+                self.throttled(delay)
+            finally:
+                self._release()
+
+    def wrap(self, send):
+        """Wrap a RESTClientObject.request so every call goes through the governor."""
+        async def request(method, url, **kwargs):
+            return await self.call(send, method, url, **kwargs)
+        return request
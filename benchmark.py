@@ -0,0 +1,267 @@
+"""Offline benchmarks of the operator's handlers against fake_apiserver.
+
+Runs the real handlers (no mocks) against an in-memory API server with
+optional per-request latency and error injection, and prints one JSON
+document with the results so runs can be compared in CI:
+
+    python benchmark.py --latency-ms 5 --error-rate 0.01 --output bench.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import time
+
+import kopf
+import kube_client
+import custom_operator
+from fake_apiserver import FakeApiServer
+from ttl_scheduler import TTLScheduler
+
+logger = logging.getLogger("benchmark")
+
+SCENARIOS = ("creates", "update_storm", "resume", "ttl_sweep", "import", "render")
+CR_NAMESPACE = "preview-envs"
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else None
+
+def environment(pr_number, ttl_seconds=None, ready=False):
+    spec = {'pr_number': pr_number, 'branch_name': f'feature-{pr_number}', 'image': 'orim2002/my-app', 'image_tag': 'v1'}
+    if ttl_seconds is not None:
+        spec['ttl_seconds'] = ttl_seconds
+    return {
+        "apiVersion": "devops.orima.com/v1",
+        "kind": "PreviewEnvironment",
+        "metadata": {"name": f"pr-{pr_number}-env", "namespace": CR_NAMESPACE, "creationTimestamp": "2024-01-01T00:00:00Z"},
+        "spec": spec,
+        "status": {"ready": True} if ready else {},
+    }
+
+def namespace(pr_number):
+    return {"apiVersion": "v1", "kind": "Namespace", "metadata": {"name": f"preview-pr-{pr_number}", "labels": custom_operator.environment_labels(pr_number)}}
+
+
+async def bench_creates(server, count, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    durations, errors = [], 0
+
+    async def create(pr_number):
+        nonlocal errors
+        env = environment(pr_number)
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await custom_operator.create_fn(
+                    spec=env['spec'], name=env['metadata']['name'], namespace=CR_NAMESPACE,
+                    meta=env['metadata'], status={}, patch=kopf.Patch(), logger=logger
+                )
+            except Exception:
+                errors += 1
+                return
+            durations.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(create(n) for n in range(1, count + 1)))
+    elapsed = time.perf_counter() - started
+    await custom_operator.READINESS_TRACKER.stop()
+    return {
+        "count": count,
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "creates_per_second": round(len(durations) / elapsed, 1),
+        "p50_seconds": round(percentile(durations, 0.5) or 0, 4),
+        "p99_seconds": round(percentile(durations, 0.99) or 0, 4),
+        "api_requests": len(server.requests),
+    }
+
+async def bench_update_storm(server, prs, updates_per_pr, quiet_window):
+    coalescer = custom_operator.UPDATE_COALESCER
+    saved = coalescer.quiet_window, coalescer.max_delay
+    coalescer.quiet_window, coalescer.max_delay = quiet_window, quiet_window * 10
+    for pr_number in range(1, prs + 1):
+        server.add("namespaces", namespace(pr_number))
+    started = time.perf_counter()
+    try:
+        for tag in range(updates_per_pr):
+            for pr_number in range(1, prs + 1):
+                env = environment(pr_number)
+                env['spec']['image_tag'] = f"v{tag}"
+                await custom_operator.update_fn(
+                    spec=env['spec'], name=env['metadata']['name'], namespace=CR_NAMESPACE,
+                    meta=env['metadata'], status={}, logger=logger
+                )
+            await asyncio.sleep(quiet_window / 10)
+        await coalescer.drain()
+    finally:
+        coalescer.quiet_window, coalescer.max_delay = saved
+    elapsed = time.perf_counter() - started
+    rollouts = server.count("PATCH", "deployments")
+    return {
+        "prs": prs,
+        "updates": prs * updates_per_pr,
+        "rollouts": rollouts,
+        "seconds_to_drain": round(elapsed, 3),
+        "api_requests": len(server.requests),
+    }
+
+async def bench_resume(server, count):
+    for pr_number in range(1, count + 1):
+        server.add("previewenvironments", environment(pr_number, ready=True))
+        server.add("namespaces", namespace(pr_number))
+    started = time.perf_counter()
+    await custom_operator.bulk_resume()
+    environments = list(server.objects["previewenvironments"].values())
+    await asyncio.gather(*(
+        custom_operator.resume_fn(
+            name=env['metadata']['name'], namespace=CR_NAMESPACE, spec=env['spec'],
+            meta=env['metadata'], status=env['status'], logger=logger
+        )
+        for env in environments
+    ))
+    elapsed = time.perf_counter() - started
+    return {
+        "count": count,
+        "seconds": round(elapsed, 3),
+        "api_requests": len(server.requests),
+    }
+
+async def bench_ttl_sweep(server, count, timeout):
+    expired_deadline = time.time() - 1
+    scheduler = TTLScheduler(expire=custom_operator.expire_environments)
+    for pr_number in range(1, count + 1):
+        env = server.add("previewenvironments", environment(pr_number, ttl_seconds=60))
+        scheduler.schedule((CR_NAMESPACE, env['metadata']['name']), expired_deadline)
+    started = time.perf_counter()
+    scheduler.start()
+    while server.objects["previewenvironments"] and time.perf_counter() - started < timeout:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - started
+    await scheduler.stop()
+    return {
+        "count": count,
+        "remaining": len(server.objects["previewenvironments"]),
+        "seconds": round(elapsed, 3),
+        "deletes_per_second": round((count - len(server.objects["previewenvironments"])) / elapsed, 1),
+        "api_requests": len(server.requests),
+    }
+
+
+def bench_import(runs):
+    """Cold import of the operator in fresh interpreters, split into kopf's share and ours."""
+    # kopf is imported first, as `kopf run` does before loading the operator
+    code = (
+        "import time; started = time.perf_counter(); import kopf; loaded = time.perf_counter(); "
+        "import custom_operator; print(loaded - started, time.perf_counter() - loaded)"
+    )
+    kopf_seconds, operator_seconds = [], []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True,
+        ).stdout.split()
+        kopf_seconds.append(float(output[0]))
+        operator_seconds.append(float(output[1]))
+    return {
+        "runs": runs,
+        "kopf_seconds": round(statistics.median(kopf_seconds), 4),
+        "operator_seconds": round(statistics.median(operator_seconds), 4),
+    }
+
+def bench_render(api_client, iterations):
+    """Time to render one environment's bundle and serialize it for the API, per reconcile."""
+    started = time.perf_counter()
+    for _ in range(iterations):
+        _, bundle = custom_operator.render_bundle(142, "orim2002/my-app", "v1")
+    rendered = time.perf_counter()
+    for _ in range(iterations):
+        for body in bundle.values():
+            api_client.sanitize_for_serialization(body)
+    serialized = time.perf_counter()
+    return {
+        "iterations": iterations,
+        "render_us": round((rendered - started) / iterations * 1e6, 1),
+        "serialize_us": round((serialized - rendered) / iterations * 1e6, 1),
+    }
+
+
+async def run_scenario(name, args):
+    """Run one scenario against its own fresh fake API server."""
+    server = FakeApiServer(latency=args.latency_ms / 1000, error_rate=args.error_rate, seed=args.seed)
+    await server.start()
+    kube_client._api_client = server.api_client()
+    try:
+        if name == "creates":
+            result = await bench_creates(server, args.creates, args.concurrency)
+        elif name == "update_storm":
+            result = await bench_update_storm(server, args.storm_prs, args.storm_updates, args.quiet_window)
+        elif name == "resume":
+            result = await bench_resume(server, args.resume_crs)
+        elif name == "import":
+            result = bench_import(args.import_runs)
+        elif name == "render":
+            result = bench_render(kube_client._api_client, args.render_iterations)
+        else:
+            result = await bench_ttl_sweep(server, args.ttl_crs, args.timeout)
+    except Exception as e:
+        # e.g. an injected error hit one of the startup LISTs
+        result = {"error": str(e).splitlines()[0]}
+    finally:
+        await kube_client.close_api_client()
+        await server.stop()
+    result["peak_rss_mb"] = peak_rss_mb()
+    return result
+
+async def main(args):
+    results = {}
+    for name in args.scenarios:
+        results[name] = await run_scenario(name, args)
+        print(f"{name}: {json.dumps(results[name])}", file=sys.stderr)
+    return {
+        "config": {"latency_ms": args.latency_ms, "error_rate": args.error_rate, "seed": args.seed},
+        "results": results,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="delay added to every API request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of API requests answered with a 500")
+    parser.add_argument("--seed", type=int, default=1, help="seed for error injection")
+    parser.add_argument("--creates", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=50, help="create_fn calls in flight at once")
+    parser.add_argument("--storm-prs", type=int, default=50)
+    parser.add_argument("--storm-updates", type=int, default=10, help="spec updates per PR in the storm")
+    parser.add_argument("--quiet-window", type=float, default=0.2, help="coalescer quiet window during the storm")
+    parser.add_argument("--resume-crs", type=int, default=10000)
+    parser.add_argument("--ttl-crs", type=int, default=10000)
+    parser.add_argument("--timeout", type=float, default=300, help="give up on the TTL sweep after this long")
+    parser.add_argument("--import-runs", type=int, default=5, help="fresh interpreters to time the import in")
+    parser.add_argument("--render-iterations", type=int, default=2000)
+    parser.add_argument("--output", help="also write the JSON results to this file")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    # Injected errors would flood the output; the counts are in the report
+    logging.basicConfig(level=logging.CRITICAL)
+    args = parse_args()
+    report = asyncio.run(main(args))
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
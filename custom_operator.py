@@ -1,16 +1,47 @@
+import time
+IMPORT_STARTED = time.perf_counter()
+import asyncio
+import contextlib
+import hashlib
+import json
 import kopf
 import logging
 import re
-from datetime import datetime, timezone
-from kubernetes import client, config
+from datetime import datetime
+from kubernetes_asyncio import client
+from kube_client import load_config, get_api_client, close_api_client
+from ttl_scheduler import TTLScheduler
+from resource_cache import ResourceCache
+from update_coalescer import UpdateCoalescer
+from warm_pool import WarmPool, WARM_NAMESPACE_PREFIX
+from readiness import ReadinessTracker, patch_environment_status
+from orphan_sweeper import OrphanSweeper
+from deletion_queue import DeletionQueue
+from image_prepull import ImagePrePuller, image_pulled, prepull_name, node_selector, IMAGE_PREPULL_NAMESPACE, IMAGE_PREPULL_NODE_SELECTOR, PAUSE_IMAGE
+from route_table import RouteTable, ROUTER_NAMESPACE, WILDCARD_TLS_SECRET, SHARED_INGRESS_ENABLED
+from tracing import span, trace, traces_endpoint
+from admission import AdmissionQueue, branch_priority, parse_priorities, ADMISSION_NODE_SELECTOR, ADMISSION_PRIORITIES, ADMISSION_RETRY_SECONDS
+from profiler import PROFILER, profile_endpoint
+from api_governor import api_priority, CREATE, UPDATE, BACKGROUND
+from sharding import ShardCoordinator, shard_owner, configure_persistence, handover_patch, SHARDING_ENABLED
+from scale_to_zero import IdleController, NginxTrafficSource, start_activator, ACTIVATOR_SERVICE_HOST, ACTIVATOR_PORT, SCALE_TO_ZERO_IDLE_SECONDS
 from metrics import (
     start_metrics_server,
     ENVIRONMENTS_CREATED,
+    ENVIRONMENTS_CREATED_ALL,
     ENVIRONMENTS_FAILED,
     ENVIRONMENTS_EXPIRED,
     ACTIVE_ENVIRONMENTS,
     CREATION_DURATION,
+    PROVISION_STEP_DURATION,
+    APPLIES_SKIPPED,
     RECONCILE_COUNT,
+    RECONCILES_ALL,
+    forget_environment,
+    RESUME_DURATION,
+    STARTUP_PHASE_DURATION,
+    MISSING_NAMESPACES,
+    SHARD_QUEUE_DEPTH,
 )
 
 logger = logging.getLogger(__name__)
@@ -22,182 +53,246 @@ INGRESS_CLASS = "nginx"
 CLUSTER_ISSUER = "letsencrypt-issuer"
 RESOURCE_REQUESTS = {"cpu": "100m", "memory": "128Mi"}
 RESOURCE_LIMITS = {"cpu": "250m", "memory": "256Mi"}
+LIST_PAGE_SIZE = 500 # items per page for the startup LIST calls
+CACHE_SYNC_TIMEOUT = 30 # seconds to wait for the namespace cache before resuming from a LIST instead
 
-try:
-    config.load_kube_config()
-except config.ConfigException:
-    try:
-        config.load_incluster_config()
-    except config.ConfigException:
-        logger.warning("Kubernetes config could not be loaded. This is expected during CI/tests.")
+RESOURCE_CACHE = ResourceCache()
 
+FIELD_MANAGER = "preview-operator" # server-side apply field manager for everything the operator owns
+DESIRED_HASH_ANNOTATION = "devops.orima.com/desired-hash" # digest of the rendered object, compared before re-applying it
 
-def create_deployment(deployment_name, image, tag, namespace):
-    apps_v1 = client.AppsV1Api()
-    resources = client.V1ResourceRequirements(
-        requests=RESOURCE_REQUESTS,
-        limits=RESOURCE_LIMITS,
-    )
 
-    health_probe = client.V1Probe(
-        http_get=client.V1HTTPGetAction(path="/", port=APP_PORT),
-        initial_delay_seconds=2,
-        period_seconds=5,
-        timeout_seconds=2,
-        failure_threshold=3
-    )
+WARM_POOL_LABELS = {"managed-by": "preview-operator", "preview-pool": "warm"}
 
-    container = client.V1Container(
-        name="app",
-        image=f"{image}:{tag}",
-        ports=[client.V1ContainerPort(container_port=APP_PORT)],
-        resources=resources,
-        liveness_probe=health_probe,
-        readiness_probe=health_probe
-    )
+WILDCARD_CERTIFICATE = "preview-wildcard" # cert-manager Certificate for *.PREVIEW_DOMAIN in shared ingress mode
 
-    template = client.V1PodTemplateSpec(
-        metadata=client.V1ObjectMeta(labels={"app": deployment_name}),
-        spec=client.V1PodSpec(containers=[container])
-    )
+ACTIVATOR_SERVICE = "preview-activator" # per-namespace ExternalName alias for the activator
+# ingress-nginx sends requests that hit a Deployment with no ready pods (503) to the activator
+ACTIVATOR_ANNOTATIONS = {
+    "nginx.ingress.kubernetes.io/custom-http-errors": "503",
+    "nginx.ingress.kubernetes.io/default-backend": ACTIVATOR_SERVICE,
+}
 
-    deployment_spec = client.V1DeploymentSpec(
-        replicas=1,
-        selector=client.V1LabelSelector(match_labels={"app":deployment_name}),
-        template=template
-    )
+# Behind the shared Ingress the activator can't tell which preview a request was for, and a
+# sleeping preview answers 502 through its ExternalName alias. With sharding, the activator a
+# request lands on only knows the previews its own replica owns. Scale to zero stays off in both.
+SCALE_TO_ZERO_SUPPORTED = not (SHARED_INGRESS_ENABLED or SHARDING_ENABLED)
+IDLE_CONTROLLER = IdleController(
+    NginxTrafficSource(),
+    idle_after=SCALE_TO_ZERO_IDLE_SECONDS if SCALE_TO_ZERO_SUPPORTED else 0,
+    replicas=lambda namespace, deployment: getattr(RESOURCE_CACHE.get("deployment", deployment, namespace), "replicas", None),
+)
 
-    deployment = client.V1Deployment(
-        api_version="apps/v1",
-        kind="Deployment",
-        metadata=client.V1ObjectMeta(name=deployment_name),
-        spec=deployment_spec
-    )
 
-    try:
-        apps_v1.create_namespaced_deployment(namespace=namespace, body=deployment)
-        logger.info(f"Successfully created Deployment: {deployment_name}")
-    except client.exceptions.ApiException as e:
-        ENVIRONMENTS_FAILED.labels(step="deployment").inc()
-        logger.error(f"Failed to create deployment: {e}")
-        raise e
+def environment_labels(pr_number):
+    return {"managed-by": "preview-operator", "pr-number": str(pr_number)}
 
-def create_service(service_name, deployment_name, namespace):
-    core_v1 = client.CoreV1Api()
+def preview_host(pr_number):
+    return f"pr-{pr_number}.{PREVIEW_DOMAIN}"
 
-    service_spec = client.V1ServiceSpec(
-        selector={"app": deployment_name},
-        ports=[client.V1ServicePort(port=80, target_port=APP_PORT)],
-        type="ClusterIP"
-    )
+def environment_namespace(pr_number, status=None):
+    """The PR's namespace: whatever create_fn recorded (e.g. a claimed warm one), else preview-pr-N."""
+    return ((status or {}).get('create_fn') or {}).get('namespace') or f"preview-pr-{pr_number}"
 
-    service = client.V1Service(
-        api_version="v1",
-        kind="Service",
-        metadata=client.V1ObjectMeta(name=service_name),
-        spec=service_spec
-    )
+# Bodies are plain dicts in API (camelCase) form: no OpenAPI model objects to build
+# per reconcile, and the client sends them without converting. The constant parts
+# below are shared by every body and must never be mutated.
+HEALTH_PROBE = {
+    "httpGet": {"path": "/", "port": APP_PORT},
+    "initialDelaySeconds": 2,
+    "periodSeconds": 5,
+    "timeoutSeconds": 2,
+    "failureThreshold": 3,
+}
+CONTAINER_RESOURCES = {"requests": RESOURCE_REQUESTS, "limits": RESOURCE_LIMITS}
+CONTAINER_PORTS = [{"containerPort": APP_PORT}]
+SERVICE_PORTS = [{"port": 80, "targetPort": APP_PORT}]
+# Pre-pull pods only hold an image on their node; they never need more than this
+PREPULL_RESOURCES = {"requests": {"cpu": "1m", "memory": "8Mi"}, "limits": {"cpu": "50m", "memory": "32Mi"}}
+# Allow only the ingress controller to reach the app
+NETWORK_POLICY_INGRESS = [{
+    "from": [{"namespaceSelector": {"matchLabels": {"kubernetes.io/metadata.name": "ingress-nginx"}}}],
+    "ports": [{"port": APP_PORT, "protocol": "TCP"}],
+}]
 
-    try:
-        core_v1.create_namespaced_service(namespace=namespace, body=service)
-        logger.info(f"Successfully created Service: {service_name}")
-    except client.exceptions.ApiException as e:
-        ENVIRONMENTS_FAILED.labels(step="service").inc()
-        logger.error(f"Failed to create service: {e}")
-        raise e
+def render_namespace(pr_namespace, pr_number):
+    return {
+        "apiVersion": "v1",
+        "kind": "Namespace",
+        "metadata": {"name": pr_namespace, "labels": environment_labels(pr_number)},
+    }
 
-def create_ingress(ingress_name, ingress_host, service_name, namespace):
-    networking_v1 = client.NetworkingV1Api()
-    ingress_spec = client.V1IngressSpec(
-        ingress_class_name=INGRESS_CLASS,
-        tls=[
-            client.V1IngressTLS(
-                hosts=[ingress_host],
-                secret_name=f"{ingress_host}-tls"
-            )
-        ],
-        rules=[
-            client.V1IngressRule(
-                host=ingress_host,
-                http=client.V1HTTPIngressRuleValue(
-                    paths=[
-                        client.V1HTTPIngressPath(
-                            path="/",
-                            path_type="Prefix",
-                            backend=client.V1IngressBackend(
-                                service=client.V1IngressServiceBackend(
-                                    name=service_name,
-                                    port=client.V1ServiceBackendPort(number=80)
-                                )
-                            )
-                        )
-                    ]
-                )
-            )
-        ]
-    )
-    ingress = client.V1Ingress(
-        api_version="networking.k8s.io/v1",
-        kind="Ingress",
-        metadata=client.V1ObjectMeta(
-            name=ingress_name,
-            annotations={
-                "cert-manager.io/cluster-issuer": CLUSTER_ISSUER
-            }
-        ),
-        spec=ingress_spec
-    )
-    try:
-        networking_v1.create_namespaced_ingress(namespace=namespace, body=ingress)
-        logger.info(f"Successfully created Ingress: {ingress_name} for {ingress_host}")
-    except client.exceptions.ApiException as e:
-        ENVIRONMENTS_FAILED.labels(step="ingress").inc()
-        logger.error(f"Failed to create ingress: {e}")
-        raise e
+def render_deployment(deployment_name, image, tag, pr_number):
+    return {
+        "apiVersion": "apps/v1",
+        "kind": "Deployment",
+        "metadata": {"name": deployment_name, "labels": environment_labels(pr_number)},
+        "spec": {
+            "replicas": 1,
+            "selector": {"matchLabels": {"app": deployment_name}},
+            "template": {
+                # managed-by lets the readiness tracker watch every preview's pods with one selector
+                "metadata": {"labels": {"app": deployment_name, **environment_labels(pr_number)}},
+                "spec": {
+                    "containers": [{
+                        "name": "app",
+                        "image": f"{image}:{tag}",
+                        "ports": CONTAINER_PORTS,
+                        "resources": CONTAINER_RESOURCES,
+                        "livenessProbe": HEALTH_PROBE,
+                        "readinessProbe": HEALTH_PROBE,
+                    }],
+                },
+            },
+        },
+    }
 
-def create_network_policy(deployment_name, namespace):
-    networking_v1 = client.NetworkingV1Api()
-    netpol = client.V1NetworkPolicy(
-        api_version="networking.k8s.io/v1",
-        kind="NetworkPolicy",
-        metadata=client.V1ObjectMeta(name=f"{deployment_name}-netpol"),
-        spec=client.V1NetworkPolicySpec(
-            pod_selector=client.V1LabelSelector(
-                match_labels={"app": deployment_name}
-            ),
-            policy_types=["Ingress"],
-            ingress=[
-                # Allow only the ingress controller to reach the app
-                client.V1NetworkPolicyIngressRule(
-                    _from=[
-                        client.V1NetworkPolicyPeer(
-                            namespace_selector=client.V1LabelSelector(
-                                match_labels={"kubernetes.io/metadata.name": "ingress-nginx"}
-                            )
-                        )
-                    ],
-                    ports=[client.V1NetworkPolicyPort(port=APP_PORT, protocol="TCP")]
-                )
-            ]
-        )
-    )
-    try:
-        networking_v1.create_namespaced_network_policy(namespace=namespace, body=netpol)
-        logger.info(f"Created NetworkPolicy for {deployment_name}")
-    except client.exceptions.ApiException as e:
-        logger.error(f"Failed to create NetworkPolicy: {e}")
-        raise e
+def render_service(service_name, deployment_name, pr_number):
+    return {
+        "apiVersion": "v1",
+        "kind": "Service",
+        "metadata": {"name": service_name, "labels": environment_labels(pr_number)},
+        "spec": {"selector": {"app": deployment_name}, "ports": SERVICE_PORTS, "type": "ClusterIP"},
+    }
 
+def render_ingress_rule(ingress_host, service_name):
+    return {
+        "host": ingress_host,
+        "http": {
+            "paths": [{
+                "path": "/",
+                "pathType": "Prefix",
+                "backend": {"service": {"name": service_name, "port": {"number": 80}}},
+            }],
+        },
+    }
 
-@kopf.on.startup()
-def startup_fn(**kwargs):
-    start_metrics_server(port=METRICS_PORT)
-    logger.info(f"Prometheus metrics server started on :{METRICS_PORT}")
+def render_ingress(ingress_name, ingress_host, service_name, pr_number, extra_annotations=None):
+    return {
+        "apiVersion": "networking.k8s.io/v1",
+        "kind": "Ingress",
+        "metadata": {
+            "name": ingress_name,
+            "labels": environment_labels(pr_number),
+            "annotations": {"cert-manager.io/cluster-issuer": CLUSTER_ISSUER, **(extra_annotations or {})},
+        },
+        "spec": {
+            "ingressClassName": INGRESS_CLASS,
+            "tls": [{"hosts": [ingress_host], "secretName": f"{ingress_host}-tls"}],
+            "rules": [render_ingress_rule(ingress_host, service_name)],
+        },
+    }
 
-@kopf.on.create('devops.orima.com', 'v1', 'previewenvironments')
-def create_fn(spec, name, namespace, logger, **kwargs):
+def render_network_policy(name, pod_labels, labels):
+    return {
+        "apiVersion": "networking.k8s.io/v1",
+        "kind": "NetworkPolicy",
+        "metadata": {"name": name, "labels": labels},
+        "spec": {
+            "podSelector": {"matchLabels": pod_labels},
+            "policyTypes": ["Ingress"],
+            "ingress": NETWORK_POLICY_INGRESS,
+        },
+    }
+
+def render_activator_service(labels):
+    # default-backend must name a Service in the Ingress's own namespace
+    return {
+        "apiVersion": "v1",
+        "kind": "Service",
+        "metadata": {"name": ACTIVATOR_SERVICE, "labels": labels},
+        "spec": {
+            "type": "ExternalName",
+            "externalName": ACTIVATOR_SERVICE_HOST,
+            "ports": [{"port": ACTIVATOR_PORT, "targetPort": ACTIVATOR_PORT}],
+        },
+    }
+
+def route_service_name(pr_number):
+    return f"pr-{pr_number}"
+
+def render_route_service(pr_number, service_name, pr_namespace):
+    # An Ingress can only reach Services in its own namespace, so the shared one goes through this alias
+    return {
+        "apiVersion": "v1",
+        "kind": "Service",
+        "metadata": {
+            "name": route_service_name(pr_number),
+            "namespace": ROUTER_NAMESPACE,
+            "labels": environment_labels(pr_number),
+        },
+        "spec": {
+            "type": "ExternalName",
+            "externalName": f"{service_name}.{pr_namespace}.svc.cluster.local",
+            "ports": [{"port": 80, "targetPort": 80}],
+        },
+    }
+
+def shared_ingress_name():
+    # With sharding every replica writes its own; ingress-nginx merges Ingresses of one class
+    return f"preview-router-{SHARD_COORDINATOR.identity}" if SHARD_COORDINATOR.enabled else "preview-router"
+
+def render_shared_ingress(routes):
+    """One Ingress for every preview in `routes` (host -> route Service), served by the wildcard certificate."""
+    return {
+        "apiVersion": "networking.k8s.io/v1",
+        "kind": "Ingress",
+        "metadata": {"name": shared_ingress_name(), "labels": {"managed-by": "preview-operator"}},
+        "spec": {
+            "ingressClassName": INGRESS_CLASS,
+            "tls": [{"hosts": [f"*.{PREVIEW_DOMAIN}"], "secretName": WILDCARD_TLS_SECRET}],
+            "rules": [render_ingress_rule(host, routes[host]) for host in sorted(routes)],
+        },
+    }
+
+def render_wildcard_certificate():
+    # Wildcards need a DNS-01 solver on CLUSTER_ISSUER
+    return {
+        "apiVersion": "cert-manager.io/v1",
+        "kind": "Certificate",
+        "metadata": {"name": WILDCARD_CERTIFICATE, "namespace": ROUTER_NAMESPACE},
+        "spec": {
+            "secretName": WILDCARD_TLS_SECRET,
+            "dnsNames": [f"*.{PREVIEW_DOMAIN}"],
+            "issuerRef": {"name": CLUSTER_ISSUER, "kind": "ClusterIssuer"},
+        },
+    }
+
+def render_warm_namespace(name):
+    return {
+        "apiVersion": "v1",
+        "kind": "Namespace",
+        "metadata": {"name": name, "labels": {**WARM_POOL_LABELS, **SHARD_COORDINATOR.labels()}},
+    }
+
+def render_prepull_daemonset(image):
+    """Runs `image` as a no-op init container on every preview node, which makes each node pull it."""
+    name = prepull_name(image)
+    return {
+        "apiVersion": "apps/v1",
+        "kind": "DaemonSet",
+        "metadata": {"name": name, "labels": {"managed-by": "preview-operator", "preview-prepull": name}},
+        "spec": {
+            "selector": {"matchLabels": {"preview-prepull": name}},
+            "template": {
+                "metadata": {"labels": {"preview-prepull": name}},
+                "spec": {
+                    "nodeSelector": node_selector(IMAGE_PREPULL_NODE_SELECTOR),
+                    "terminationGracePeriodSeconds": 0,
+                    "initContainers": [{
+                        "name": "prepull",
+                        "image": image,
+                        "command": ["sh", "-c", "true"],
+                        "resources": PREPULL_RESOURCES,
+                    }],
+                    "containers": [{"name": "pause", "image": PAUSE_IMAGE, "resources": PREPULL_RESOURCES}],
+                },
+            },
+        },
+    }
+
+def validate_spec(spec):
     pr_number = spec.get('pr_number')
-    branch_name = spec.get('branch_name')
     image = spec.get("image")
     tag = spec.get('image_tag')
 
@@ -213,166 +308,812 @@ def create_fn(spec, name, namespace, logger, **kwargs):
     if not re.fullmatch(r'[a-zA-Z0-9._-]{1,128}', tag):
         raise kopf.PermanentError(f"image_tag contains invalid characters: {tag}")
 
-    pr_namespace = f"preview-pr-{pr_number}"
+    return pr_number, image, tag
+
+def render_bundle(pr_number, image, tag, pr_namespace=None):
+    """Render the full desired state of a preview environment.
+
+    Returns the environment's names and a dict of step -> object body, in
+    apply order (the namespace first). A namespace claimed from the warm
+    pool already has its namespace-level plumbing, so those steps are left out.
+    """
+    pr_namespace = pr_namespace or f"preview-pr-{pr_number}"
     deployment_name = f"pr-{pr_number}-app"
     service_name = f"pr-{pr_number}-svc"
     ingress_name = f"pr-{pr_number}-ingress"
-    ingress_host = f"pr-{pr_number}.{PREVIEW_DOMAIN}"
-
-    core_v1 = client.CoreV1Api()
-    try:
-        core_v1.create_namespace(body={
-            "apiVersion": "v1",
-            "kind": "Namespace",
-            "metadata": {
-                "name": pr_namespace,
-                "labels": {"managed-by": "preview-operator", "pr-number": str(pr_number)}
-            }
-        })
-        logger.info(f"Created namespace {pr_namespace}")
-    except client.exceptions.ApiException as e:
-        if e.status != 409:
-            raise
-
-    RECONCILE_COUNT.labels(pr_number=str(pr_number)).inc()
-
-    with CREATION_DURATION.time():
-        create_deployment(deployment_name, image, tag, pr_namespace)
-        create_service(service_name, deployment_name, pr_namespace)
-        create_ingress(ingress_name, ingress_host, service_name, pr_namespace)
-        create_network_policy(deployment_name, pr_namespace)
-
-    ENVIRONMENTS_CREATED.labels(branch_name=branch_name).inc()
-    ACTIVE_ENVIRONMENTS.inc()
+    ingress_host = preview_host(pr_number)
 
-    return {
-        'status': 'Environment Created',
+    names = {
         'deployment': deployment_name,
         'service': service_name,
         'ingress': ingress_name,
         'namespace': pr_namespace,
         'url': f"https://{ingress_host}"
     }
+    bundle = {
+        "namespace": render_namespace(pr_namespace, pr_number),
+        "deployment": render_deployment(deployment_name, image, tag, pr_number),
+        "service": render_service(service_name, deployment_name, pr_number),
+        "ingress": render_ingress(
+            ingress_name, ingress_host, service_name, pr_number,
+            ACTIVATOR_ANNOTATIONS if IDLE_CONTROLLER.enabled else None
+        ),
+        "network_policy": render_network_policy(f"{deployment_name}-netpol", {"app": deployment_name}, environment_labels(pr_number)),
+    }
+    if IDLE_CONTROLLER.enabled:
+        bundle["activator_service"] = render_activator_service(environment_labels(pr_number))
+    if ROUTE_TABLE.enabled:
+        # Routed by the shared Ingress, through an alias in the router namespace
+        del bundle["ingress"]
+        bundle.pop("activator_service", None)
+        bundle["route_service"] = render_route_service(pr_number, service_name, pr_namespace)
+    if pr_namespace.startswith(WARM_NAMESPACE_PREFIX):
+        del bundle["namespace"], bundle["network_policy"]
+    for body in bundle.values():
+        stamp_desired_hash(body)
+    return names, bundle
 
+def stamp_desired_hash(body):
+    """Annotate `body` with a digest of everything else in it."""
+    metadata = body["metadata"]
+    digest = hashlib.sha256(json.dumps(body, sort_keys=True).encode()).hexdigest()[:16]
+    metadata["annotations"] = {**metadata.get("annotations", {}), DESIRED_HASH_ANNOTATION: digest}
 
-@kopf.on.resume('devops.orima.com', 'v1', 'previewenvironments')
-def resume_fn(name, spec, logger, **kwargs):
-    pr_number = spec.get('pr_number')
-    pr_namespace = f"preview-pr-{pr_number}"
-    core_v1 = client.CoreV1Api()
+# step -> kind in RESOURCE_CACHE, for steps whose kind name differs
+CACHED_KINDS = {"activator_service": "service", "route_service": "service"}
+
+def unchanged(step, body, namespace):
+    """True when the cache shows the object already carries this exact desired state."""
+    kind = CACHED_KINDS.get(step, step)
+    if not RESOURCE_CACHE.watches(kind):
+        return False
+    metadata = body["metadata"]
+    cached = RESOURCE_CACHE.get(kind, metadata["name"], namespace)
+    return cached is not None and cached.annotations.get(DESIRED_HASH_ANNOTATION) == metadata["annotations"][DESIRED_HASH_ANNOTATION]
+
+# step -> (API class, server-side apply method); looked up on `client` at call time
+APPLY_METHODS = {
+    "namespace": ("CoreV1Api", "patch_namespace"),
+    "deployment": ("AppsV1Api", "patch_namespaced_deployment"),
+    "service": ("CoreV1Api", "patch_namespaced_service"),
+    "ingress": ("NetworkingV1Api", "patch_namespaced_ingress"),
+    "network_policy": ("NetworkingV1Api", "patch_namespaced_network_policy"),
+    "activator_service": ("CoreV1Api", "patch_namespaced_service"),
+    "route_service": ("CoreV1Api", "patch_namespaced_service"),
+    "shared_ingress": ("NetworkingV1Api", "patch_namespaced_ingress"),
+    "prepull": ("AppsV1Api", "patch_namespaced_daemon_set"),
+}
+
+async def apply_object(step, body, namespace=None):
+    """Server-side apply one object. Creates it if missing, converges it otherwise."""
+    api_name, method_name = APPLY_METHODS[step]
+    api = getattr(client, api_name)(get_api_client())
+    kwargs = {"namespace": namespace} if namespace else {}
     try:
-        core_v1.read_namespace(pr_namespace)
+        await getattr(api, method_name)(
+            name=body["metadata"]["name"],
+            body=body,
+            field_manager=FIELD_MANAGER,
+            force=True,
+            _content_type="application/apply-patch+yaml",
+            **kwargs
+        )
+        logger.info(f"Applied {body['kind']} {body['metadata']['name']}")
     except client.exceptions.ApiException as e:
-        if e.status == 404:
-            logger.warning(f"Namespace {pr_namespace} not found, skipping resume for {name}")
-            return
-        raise
-    ACTIVE_ENVIRONMENTS.inc()
-    logger.info(f"Resumed tracking active environment: {name}")
+        ENVIRONMENTS_FAILED.labels(step=step).inc()
+        logger.error(f"Failed to apply {body['kind']} {body['metadata']['name']}: {e}")
+        raise e
 
-@kopf.on.delete('devops.orima.com', 'v1', 'previewenvironments')
-def delete_fn(spec, name, namespace, logger, **kwargs):
-    pr_number = spec.get('pr_number')
-    pr_namespace = f"preview-pr-{pr_number}"
-    core_v1 = client.CoreV1Api()
+async def _timed_step(step, coro):
+    with PROVISION_STEP_DURATION.labels(step=step).time(), span(step):
+        return await coro
+
+async def provision_steps(steps):
+    """Run independent provisioning steps concurrently.
+
+    `steps` maps a step name to a coroutine. Every step runs to completion
+    even if another one fails; the first failure is re-raised afterwards so
+    kopf retries the handler.
+    """
+    results = await asyncio.gather(
+        *(_timed_step(step, coro) for step, coro in steps.items()),
+        return_exceptions=True
+    )
+    failures = [(step, result) for step, result in zip(steps, results) if isinstance(result, Exception)]
+    if failures:
+        logger.error(f"Provisioning failed at steps: {', '.join(step for step, _ in failures)}")
+        raise failures[0][1]
+
+
+async def reconcile_environment(spec, pr_namespace=None, completed=None):
+    """Converge the whole per-PR bundle to the desired state.
+
+    Shared by create, update and resume. Every object is server-side
+    applied, so retries and re-runs never fail on "already exists".
+    Objects whose cached desired-hash matches the rendered one are not
+    written at all. Steps listed in `completed` are skipped; every step
+    that succeeds is added to it, so a failed create can resume where it
+    stopped. Returns the PR number, its names and the steps that were
+    actually applied.
+    """
+    pr_number, image, tag = validate_spec(spec)
+    with trace("reconcile", pr_number=pr_number):
+        names, bundle = render_bundle(pr_number, image, tag, pr_namespace)
+        pr_namespace = names['namespace']
+        completed = set() if completed is None else completed
+        applied = []
+
+        namespace_body = bundle.pop("namespace", None)
+        cached = RESOURCE_CACHE.get("namespace", pr_namespace)
+        if namespace_body is not None and "namespace" not in completed and (cached is None or cached.phase == "Terminating"):
+            with PROVISION_STEP_DURATION.labels(step="namespace").time(), span("namespace"):
+                await apply_object("namespace", namespace_body)
+            applied.append("namespace")
+        completed.add("namespace")
+
+        async def apply_step(step, body):
+            # Only the route alias lives outside the PR's namespace
+            namespace = body["metadata"].get("namespace", pr_namespace)
+            if unchanged(step, body, namespace):
+                APPLIES_SKIPPED.labels(step=step).inc()
+            else:
+                await apply_object(step, body, namespace=namespace)
+                applied.append(step)
+            completed.add(step)
+
+        await provision_steps({
+            step: apply_step(step, body)
+            for step, body in bundle.items() if step not in completed
+        })
+        if ROUTE_TABLE.enabled:
+            ROUTE_TABLE.add(preview_host(pr_number), route_service_name(pr_number))
+    return pr_number, names, applied
+
+
+async def apply_shared_ingress(routes):
+    # New previews wait on this write for their URL
+    with api_priority(CREATE):
+        await apply_object("shared_ingress", render_shared_ingress(routes), namespace=ROUTER_NAMESPACE)
+
+ROUTE_TABLE = RouteTable(apply=apply_shared_ingress)
+
+async def setup_router():
+    """Namespace, wildcard certificate and activator alias behind the shared Ingress."""
+    await apply_object("namespace", {
+        "apiVersion": "v1",
+        "kind": "Namespace",
+        "metadata": {"name": ROUTER_NAMESPACE, "labels": {"preview-role": "router"}},
+    })
+    custom_api = client.CustomObjectsApi(get_api_client())
+    await custom_api.patch_namespaced_custom_object(
+        group="cert-manager.io",
+        version="v1",
+        namespace=ROUTER_NAMESPACE,
+        plural="certificates",
+        name=WILDCARD_CERTIFICATE,
+        body=render_wildcard_certificate(),
+        field_manager=FIELD_MANAGER,
+        force=True,
+        _content_type="application/apply-patch+yaml"
+    )
+
+async def setup_prepull():
+    await apply_object("namespace", {
+        "apiVersion": "v1",
+        "kind": "Namespace",
+        "metadata": {"name": IMAGE_PREPULL_NAMESPACE, "labels": {"preview-role": "prepull"}},
+    })
+
+async def apply_prepull(image):
+    await apply_object("prepull", render_prepull_daemonset(image), namespace=IMAGE_PREPULL_NAMESPACE)
+
+async def prepull_progress(image):
+    """(nodes that have pulled `image`, nodes its DaemonSet targets, or None before the controller has seen it)."""
+    name = prepull_name(image)
+    apps_v1 = client.AppsV1Api(get_api_client())
+    core_v1 = client.CoreV1Api(get_api_client())
+    daemon_set = await apps_v1.read_namespaced_daemon_set(name, IMAGE_PREPULL_NAMESPACE)
+    status = daemon_set.status
+    if status is None or status.observed_generation is None:
+        return 0, None
+    pods = await core_v1.list_namespaced_pod(IMAGE_PREPULL_NAMESPACE, label_selector=f"preview-prepull={name}")
+    return sum(1 for pod in pods.items if image_pulled(pod)), status.desired_number_scheduled
+
+async def remove_prepull(image):
+    apps_v1 = client.AppsV1Api(get_api_client())
     try:
-        core_v1.delete_namespace(pr_namespace)
-        logger.info(f"Deleted namespace {pr_namespace}")
+        await apps_v1.delete_namespaced_daemon_set(prepull_name(image), IMAGE_PREPULL_NAMESPACE)
     except client.exceptions.ApiException as e:
         if e.status != 404:
             raise
-    ACTIVE_ENVIRONMENTS.dec()
-    logger.info(f"Preview environment for PR {pr_number} deleted")
 
-@kopf.timer('devops.orima.com', 'v1', 'previewenvironments', interval=60)
-def ttl_check_fn(name, namespace, spec, meta, logger, **kwargs):
+IMAGE_PREPULLER = ImagePrePuller(apply=apply_prepull, progress=prepull_progress, remove=remove_prepull)
+
+def prepull_image(pr_number, image, pr_namespace):
+    """Start pulling the image an update rolls out, unless the Deployment already runs it."""
+    deployment = RESOURCE_CACHE.get("deployment", f"pr-{pr_number}-app", pr_namespace)
+    if deployment is None or deployment.image != image:
+        IMAGE_PREPULLER.request(image)
+
+async def delete_route(pr_number):
+    ROUTE_TABLE.remove(preview_host(pr_number))
+    core_v1 = client.CoreV1Api(get_api_client())
+    try:
+        await core_v1.delete_namespaced_service(route_service_name(pr_number), ROUTER_NAMESPACE)
+    except client.exceptions.ApiException as e:
+        if e.status != 404:
+            raise
+
+async def expire_environments(keys):
+    """Delete a batch of TTL-expired PreviewEnvironments, returning the keys that failed."""
+    custom_api = client.CustomObjectsApi(get_api_client())
+
+    async def expire(namespace, name):
+        try:
+            await custom_api.delete_namespaced_custom_object(
+                group="devops.orima.com",
+                version="v1",
+                namespace=namespace,
+                plural="previewenvironments",
+                name=name,
+            )
+        except client.exceptions.ApiException as e:
+            if e.status != 404:
+                raise
+            return
+        logger.info(f"TTL expired for {name}. Deleted.")
+        ENVIRONMENTS_EXPIRED.inc()
+
+    with trace("expire", count=len(keys)):
+        results = await asyncio.gather(*(expire(*key) for key in keys), return_exceptions=True)
+    failed = []
+    for key, result in zip(keys, results):
+        if isinstance(result, Exception):
+            logger.error(f"Failed to delete expired environment {key[1]}: {result}")
+            failed.append(key)
+    return failed
+
+TTL_SCHEDULER = TTLScheduler(expire=expire_environments)
+
+def spec_digest(spec):
+    return hashlib.sha256(json.dumps(dict(spec), sort_keys=True).encode()).hexdigest()[:16]
+
+def workload_digest(spec):
+    """Digest of the spec fields the bundle is rendered from; a TTL or branch change leaves it alone."""
+    return spec_digest({field: spec.get(field) for field in ('pr_number', 'image', 'image_tag')})
+
+def update_pending(status, spec):
+    """Whether the CR's spec differs from the one last applied, e.g. an update still coalescing at a crash."""
+    applied_spec = (status or {}).get('appliedSpec')
+    # CRs from before appliedSpec was recorded count as converged
+    return applied_spec is not None and applied_spec != workload_digest(spec)
+
+async def record_applied_spec(key, spec, recorded=None):
+    """Note in the CR status which spec its objects were last converged to, unless it says so already."""
+    digest = workload_digest(spec)
+    if digest == recorded:
+        return
+    try:
+        await patch_environment_status(*key, {'appliedSpec': digest})
+    except Exception as e:
+        # Costs at most one redundant re-apply on the next resume
+        logger.warning(f"Could not record the applied spec of {key[0]}/{key[1]}: {e}")
+
+def load_checkpoint(status, spec):
+    """Namespace and completed steps of an earlier, failed create of this same spec."""
+    checkpoint = (status or {}).get('checkpoint') or {}
+    if checkpoint.get('spec') != spec_digest(spec):
+        return None, set()
+    return checkpoint.get('namespace'), set(checkpoint.get('steps') or [])
+
+def save_checkpoint(patch, spec, pr_namespace, completed):
+    # kopf writes the patch even when the handler fails, which is when it matters
+    patch.status['checkpoint'] = {
+        'spec': spec_digest(spec),
+        'namespace': pr_namespace,
+        'steps': sorted(completed),
+    }
+
+def creation_time(meta):
+    return datetime.fromisoformat(meta['creationTimestamp'].replace('Z', '+00:00'))
+
+def schedule_ttl(name, namespace, spec, meta):
+    key = (namespace, name)
     ttl = spec.get('ttl_seconds')
     if ttl is None:
+        TTL_SCHEDULER.cancel(key)
         return
-    creation_time = datetime.fromisoformat(meta['creationTimestamp'].replace('Z', '+00:00'))
-    age_seconds = (datetime.now(timezone.utc) - creation_time).total_seconds()
-    if age_seconds >= ttl:
-        logger.info(f"TTL expired for {name} (age={int(age_seconds)}s, ttl={ttl}s). Deleting.")
-        custom_api = client.CustomObjectsApi()
-        custom_api.delete_namespaced_custom_object(
+    TTL_SCHEDULER.schedule(key, creation_time(meta).timestamp() + ttl)
+
+
+async def list_managed_namespaces(label_selector="managed-by=preview-operator"):
+    """One paginated LIST of every namespace the operator manages."""
+    core_v1 = client.CoreV1Api(get_api_client())
+    namespaces, token = [], None
+    while True:
+        page = await core_v1.list_namespace(
+            label_selector=label_selector,
+            limit=LIST_PAGE_SIZE,
+            _continue=token
+        )
+        namespaces.extend(page.items)
+        token = page.metadata._continue
+        if not token:
+            return namespaces
+
+async def list_preview_environments():
+    """One paginated LIST of every PreviewEnvironment CR in the cluster."""
+    custom_api = client.CustomObjectsApi(get_api_client())
+    environments, token = [], None
+    while True:
+        page = await custom_api.list_cluster_custom_object(
             group="devops.orima.com",
             version="v1",
-            namespace=namespace,
             plural="previewenvironments",
-            name=name,
+            limit=LIST_PAGE_SIZE,
+            _continue=token
         )
-        ENVIRONMENTS_EXPIRED.inc()
+        environments.extend(page['items'])
+        token = page['metadata'].get('continue')
+        if not token:
+            return environments
 
-@kopf.on.update('devops.orima.com', 'v1', 'previewenvironments')
-def update_fn(spec, name, namespace, logger, **kwargs):
-    pr_number = spec.get('pr_number')
-    image = spec.get("image")
-    tag = spec.get('image_tag')
+async def managed_pr_numbers():
+    if RESOURCE_CACHE.is_complete("namespace"):
+        return {entry.pr_number for _, entry in RESOURCE_CACHE.items("namespace")}
+    return {(ns.metadata.labels or {}).get("pr-number") for ns in await list_managed_namespaces()}
 
-    if not all([pr_number, image, tag]):
-        raise kopf.PermanentError("spec must include pr_number, image, and image_tag")
+# (namespace, name) of CRs whose PR namespace was missing at startup; None until bulk_resume runs
+missing_namespaces = None
 
-    if not isinstance(pr_number, int) or pr_number <= 0 or pr_number > 999999:
-        raise kopf.PermanentError(f"pr_number must be a positive integer, got: {pr_number}")
+async def bulk_resume():
+    """Rebuild in-memory state at startup from two LISTs instead of a GET per CR.
 
-    if not re.fullmatch(r'[a-zA-Z0-9._/-]{1,256}', image):
-        raise kopf.PermanentError(f"image contains invalid characters: {image}")
+    Joins CRs to their namespaces (from the resource cache, or one LIST if
+    the cache is not complete) by the pr-number label, sets the active
+    gauge in one step and records which CRs lost their namespace so that
+    resume_fn only has to touch those.
+    """
+    global missing_namespaces
+    started = time.monotonic()
+    existing, environments = await asyncio.gather(managed_pr_numbers(), list_preview_environments())
+    environments = [env for env in environments if SHARD_COORDINATOR.owns(env.get('spec', {}).get('pr_number'))]
+    if ADMISSION_QUEUE.enabled:
+        restore_admissions(environments)
 
-    if not re.fullmatch(r'[a-zA-Z0-9._-]{1,128}', tag):
-        raise kopf.PermanentError(f"image_tag contains invalid characters: {tag}")
+    active, missing = 0, set()
+    for env in environments:
+        if not environment_created(env.get('status')):
+            # Queued or mid-create; create_fn provisions and counts it
+            continue
+        pr_number = env.get('spec', {}).get('pr_number')
+        if ROUTE_TABLE.enabled:
+            # Seed the whole table before its first write; a missing namespace is recreated on resume
+            ROUTE_TABLE.add(preview_host(pr_number), route_service_name(pr_number))
+        if str(pr_number) in existing:
+            active += 1
+        else:
+            missing.add((env['metadata']['namespace'], env['metadata']['name']))
 
-    deployment_name = f"pr-{pr_number}-app"
-    pr_namespace = f"preview-pr-{pr_number}"
+    ACTIVE_ENVIRONMENTS.set(active)
+    MISSING_NAMESPACES.set(len(missing))
+    missing_namespaces = missing
+    elapsed = time.monotonic() - started
+    RESUME_DURATION.set(elapsed)
+    logger.info(f"Resumed {active} active environments from {len(environments)} CRs in {elapsed:.2f}s")
+    for namespace, name in sorted(missing):
+        logger.warning(f"PreviewEnvironment {namespace}/{name} has no namespace, it will be recreated on resume")
 
-    apps_v1 = client.AppsV1Api()
-    patch = {
-        "spec": {
-            "template": {
-                "spec": {
-                    "containers": [{
-                        "name": "app",
-                        "image": f"{image}:{tag}"
-                    }]
-                }
-            }
-        }
-    }
 
+def environment_created(status):
+    """Whether create_fn provisioned the environment (and counted it as active)."""
+    return bool((status or {}).get('create_fn'))
+
+def restore_admissions(environments):
+    """Rebuild the admission queue: created CRs hold slots, the rest queue in their original order."""
+    keys = lambda env: (env['metadata']['namespace'], env['metadata']['name'])
+    pending = []
+    for env in environments:
+        if (env.get('status') or {}).get('create_fn'):
+            ADMISSION_QUEUE.mark_admitted(keys(env))
+        else:
+            pending.append(env)
+    for env in pending:
+        priority = branch_priority(env.get('spec', {}).get('branch_name'), ADMISSION_PRIORITY_RULES)
+        ADMISSION_QUEUE.try_admit(keys(env), priority, creation_time(env['metadata']))
+
+async def provision_warm_namespace(name):
+    # Refilling the pool must never hold up real PRs
+    with api_priority(BACKGROUND):
+        await apply_object("namespace", render_warm_namespace(name))
+        # Selects every pod in the namespace, so it covers whichever app is bound later
+        await apply_object("network_policy", render_network_policy("preview-netpol", {}, WARM_POOL_LABELS), namespace=name)
+
+async def bind_warm_namespace(name, pr_number):
+    core_v1 = client.CoreV1Api(get_api_client())
+    await core_v1.patch_namespace(name, {"metadata": {"labels": {"pr-number": str(pr_number), "preview-pool": "claimed"}}})
+
+async def discover_warm_namespaces():
+    selector = ",".join(f"{key}={value}" for key, value in {**WARM_POOL_LABELS, **SHARD_COORDINATOR.labels()}.items())
+    namespaces = await list_managed_namespaces(label_selector=selector)
+    return [ns.metadata.name for ns in namespaces if ns.status is None or ns.status.phase != "Terminating"]
+
+WARM_POOL = WarmPool(provision=provision_warm_namespace, bind=bind_warm_namespace, discover=discover_warm_namespaces)
+
+async def claim_namespace(pr_number):
+    """Pick the namespace for a new environment, or None to create preview-pr-N.
+
+    A namespace already labelled with this PR (from an earlier, failed
+    attempt) is reused so retries never claim a second one.
+    """
+    if not WARM_POOL.enabled:
+        return None
+    for (_, name), entry in RESOURCE_CACHE.items("namespace"):
+        if entry.pr_number == str(pr_number):
+            return name
+    return await WARM_POOL.claim(pr_number)
+
+
+async def list_preview_nodes():
+    core_v1 = client.CoreV1Api(get_api_client())
+    with api_priority(BACKGROUND):
+        return (await core_v1.list_node(label_selector=ADMISSION_NODE_SELECTOR)).items
+
+ADMISSION_QUEUE = AdmissionQueue(
+    request=RESOURCE_REQUESTS,
+    list_nodes=list_preview_nodes if ADMISSION_NODE_SELECTOR else None,
+    members=lambda: len(SHARD_COORDINATOR.members) if SHARD_COORDINATOR.enabled else 1,
+)
+ADMISSION_PRIORITY_RULES = parse_priorities(ADMISSION_PRIORITIES)
+
+def admit_environment(name, namespace, spec, meta, status, patch):
+    """Raise TemporaryError, with the queue position in the status, until the environment fits."""
+    created_at = creation_time(meta)
+    priority = branch_priority(spec.get('branch_name'), ADMISSION_PRIORITY_RULES)
+    admitted, position = ADMISSION_QUEUE.try_admit((namespace, name), priority, created_at)
+    if not admitted:
+        patch.status['admission'] = {'state': 'Queued', 'position': position}
+        raise kopf.TemporaryError(f"Waiting for preview capacity, position {position} in queue", delay=ADMISSION_RETRY_SECONDS)
+    if ((status or {}).get('admission') or {}).get('state') != 'Admitted':
+        ADMISSION_QUEUE.observe_wait(created_at)
+        patch.status['admission'] = {'state': 'Admitted'}
+
+
+READINESS_TRACKER = ReadinessTracker()
+
+def track_readiness(name, namespace, meta, status, pr_number, pr_namespace):
+    """Follow a preview until it is ready, unless its status already says so."""
+    if (status or {}).get('ready'):
+        return
+    if ROUTE_TABLE.enabled:
+        certificate_namespace, certificate_name = ROUTER_NAMESPACE, WILDCARD_CERTIFICATE
+    else:
+        certificate_namespace, certificate_name = pr_namespace, f"{preview_host(pr_number)}-tls"
+    READINESS_TRACKER.track(
+        (namespace, name), pr_namespace, f"pr-{pr_number}-app", certificate_name, creation_time(meta),
+        certificate_namespace=certificate_namespace
+    )
+
+async def take_over_persistence(metadata, previous):
+    """Move a CR's kopf finalizer and diff-base from replica `previous` to this one."""
+    body = handover_patch(metadata, previous, SHARD_COORDINATOR.identity)
+    if body is None:
+        return
+    custom_api = client.CustomObjectsApi(get_api_client())
+    await custom_api.patch_namespaced_custom_object(
+        group="devops.orima.com",
+        version="v1",
+        namespace=metadata['namespace'],
+        plural="previewenvironments",
+        name=metadata['name'],
+        body=body,
+        _content_type="application/merge-patch+json"
+    )
+
+async def adopt_environment(env, previous=None, counted=False):
+    """Take over a PR this replica gained in a rebalance: converge it and start tracking it.
+
+    `previous` is the replica that owned it before; its kopf state on the
+    CR is moved here first. `counted` skips the active gauge for a PR that
+    is counted already. A CR that is not created yet is left to create_fn,
+    which admits and counts it.
+    """
+    spec, metadata = env['spec'], env['metadata']
+    if previous is not None and previous != SHARD_COORDINATOR.identity:
+        await take_over_persistence(metadata, previous)
+    if not environment_created(env.get('status')):
+        return
+    pr_number = spec.get('pr_number')
+    pr_namespace = environment_namespace(pr_number, env.get('status'))
+    schedule_ttl(metadata['name'], metadata['namespace'], spec, metadata)
+    IDLE_CONTROLLER.track(preview_host(pr_number), pr_namespace, f"pr-{pr_number}-app")
+    ADMISSION_QUEUE.mark_admitted((metadata['namespace'], metadata['name']))
+    await reconcile_environment(spec, pr_namespace)
+    track_readiness(metadata['name'], metadata['namespace'], metadata, env.get('status'), pr_number, pr_namespace)
+    if not counted:
+        ACTIVE_ENVIRONMENTS.inc()
+
+def release_environment(env):
+    """Forget a PR that another replica now owns."""
+    pr_number = env['spec'].get('pr_number')
+    TTL_SCHEDULER.cancel((env['metadata']['namespace'], env['metadata']['name']))
+    READINESS_TRACKER.cancel((env['metadata']['namespace'], env['metadata']['name']))
+    ADMISSION_QUEUE.release((env['metadata']['namespace'], env['metadata']['name']))
+    UPDATE_COALESCER.cancel(pr_number)
+    IDLE_CONTROLLER.untrack(preview_host(pr_number))
+    # The new owner routes it from its own shared Ingress
+    ROUTE_TABLE.remove(preview_host(pr_number))
+    forget_environment(pr_number, env['spec'].get('branch_name'))
+    if environment_created(env.get('status')):
+        ACTIVE_ENVIRONMENTS.dec()
+
+async def rebalance_environments(old_members, new_members):
+    """Hand PRs over after the shard ring changed, with one LIST of the CRs."""
+    me = SHARD_COORDINATOR.identity
+    adopted, released = [], 0
+    for env in await list_preview_environments():
+        pr_number = str(env.get('spec', {}).get('pr_number'))
+        owned_before = shard_owner(pr_number, old_members) == me
+        owned_now = shard_owner(pr_number, new_members) == me
+        if owned_now and not owned_before:
+            adopted.append((env, shard_owner(pr_number, old_members)))
+        elif owned_before and not owned_now:
+            release_environment(env)
+            released += 1
+    results = await asyncio.gather(*(adopt_environment(env, previous) for env, previous in adopted), return_exceptions=True)
+    for (env, _), result in zip(adopted, results):
+        if isinstance(result, Exception):
+            ENVIRONMENTS_FAILED.labels(step="rebalance").inc()
+            logger.error(f"Failed to adopt {env['metadata']['name']} after rebalance: {result}")
+    logger.info(f"Rebalanced: adopted {len(adopted)}, released {released} environments")
+
+SHARD_COORDINATOR = ShardCoordinator(on_rebalance=rebalance_environments)
+
+async def delete_namespace(name):
+    """Delete a namespace; False if it was already gone."""
+    core_v1 = client.CoreV1Api(get_api_client())
     try:
-        apps_v1.patch_namespaced_deployment(
-            name=deployment_name,
-            namespace=pr_namespace,
-            body=patch
-        )
+        await core_v1.delete_namespace(name)
+        logger.info(f"Deleted namespace {name}")
     except client.exceptions.ApiException as e:
-        if e.status == 404:
-            logger.warning(f"Deployment {deployment_name} not found in {pr_namespace}, falling back to full create")
-            branch_name = spec.get('branch_name', 'unknown')
-            service_name = f"pr-{pr_number}-svc"
-            ingress_name = f"pr-{pr_number}-ingress"
-            ingress_host = f"pr-{pr_number}.{PREVIEW_DOMAIN}"
-            core_v1 = client.CoreV1Api()
-            try:
-                core_v1.create_namespace(body={
-                    "apiVersion": "v1",
-                    "kind": "Namespace",
-                    "metadata": {
-                        "name": pr_namespace,
-                        "labels": {"managed-by": "preview-operator", "pr-number": str(pr_number)}
-                    }
-                })
-            except client.exceptions.ApiException as ns_e:
-                if ns_e.status != 409:
-                    raise
-            with CREATION_DURATION.time():
-                create_deployment(deployment_name, image, tag, pr_namespace)
-                create_service(service_name, deployment_name, pr_namespace)
-                create_ingress(ingress_name, ingress_host, service_name, pr_namespace)
-            ENVIRONMENTS_CREATED.labels(branch_name=branch_name).inc()
-            ACTIVE_ENVIRONMENTS.inc()
+        if e.status != 404:
+            raise
+        return False
+    return True
+
+DELETION_QUEUE = DeletionQueue(delete=delete_namespace, exists=lambda name: RESOURCE_CACHE.exists("namespace", name))
+RESOURCE_CACHE.subscribe(DELETION_QUEUE.observe)
+
+async def delete_orphaned_namespace(name):
+    with api_priority(BACKGROUND):
+        await delete_namespace(name)
+
+ORPHAN_SWEEPER = OrphanSweeper(
+    list_namespaces=list_managed_namespaces,
+    list_environments=list_preview_environments,
+    delete_namespace=delete_orphaned_namespace,
+    owns=lambda pr_number: SHARD_COORDINATOR.owns(pr_number),
+    shard=SHARD_COORDINATOR.identity if SHARD_COORDINATOR.enabled else None,
+    members=lambda: SHARD_COORDINATOR.members,
+    pooled=WARM_POOL.names,
+)
+
+def owned_by_this_shard(spec, **_):
+    return SHARD_COORDINATOR.owns(spec.get('pr_number'))
+
+# kopf retries a failed startup_fn, so the servers it binds are started once and kept here
+metrics_server = None
+# aiohttp runner of the activator, while it is serving
+activator_runner = None
+# Set once startup_fn has resumed every CR; /readyz reports 503 until then
+startup_complete = False
+
+@contextlib.contextmanager
+def startup_phase(phase):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STARTUP_PHASE_DURATION.labels(phase=phase).set(time.perf_counter() - started)
+
+@kopf.on.startup()
+async def startup_fn(settings, **kwargs):
+    """Start the operator. Safe to retry: kopf re-runs it after a failure, e.g. a failed bulk_resume LIST."""
+    global startup_complete, metrics_server, activator_runner
+    if SHARD_COORDINATOR.enabled:
+        configure_persistence(settings)
+    PROFILER.attach()  # startup runs on the event loop's thread
+    if metrics_server is None:
+        # Up first so liveness probes pass while the rest of startup runs; /readyz waits for it
+        metrics_server = start_metrics_server(port=METRICS_PORT, debug_routes={
+            "/debug/traces": traces_endpoint,
+            "/debug/profile": profile_endpoint,
+        }, ready=lambda: startup_complete)
+        logger.info(f"Prometheus metrics server started on :{METRICS_PORT}")
+    if SCALE_TO_ZERO_IDLE_SECONDS > 0 and not SCALE_TO_ZERO_SUPPORTED:
+        logger.warning("Scale to zero is not supported with the shared ingress or sharding and stays off")
+    with startup_phase("config"):
+        await load_config()
+    with startup_phase("cache_sync"):
+        RESOURCE_CACHE.start()
+        try:
+            await RESOURCE_CACHE.wait_synced(["namespace"], timeout=CACHE_SYNC_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("Namespace cache not synced in time, resuming from a LIST")
+    with startup_phase("resume"):
+        await SHARD_COORDINATOR.join()
+        await ADMISSION_QUEUE.start()
+        await bulk_resume()
+        if ROUTE_TABLE.enabled:
+            await setup_router()
+            ROUTE_TABLE.start()
+        if IMAGE_PREPULLER.enabled:
+            await setup_prepull()
+    SHARD_COORDINATOR.start()
+    TTL_SCHEDULER.start()
+    READINESS_TRACKER.start()
+    WARM_POOL.start()
+    ORPHAN_SWEEPER.start()
+    DELETION_QUEUE.start()
+    IDLE_CONTROLLER.start()
+    if IDLE_CONTROLLER.enabled and activator_runner is None:
+        activator_runner = await start_activator(IDLE_CONTROLLER)
+    startup_complete = True
+    total = time.perf_counter() - IMPORT_STARTED
+    STARTUP_PHASE_DURATION.labels(phase="total").set(total)
+    logger.info(f"Operator ready {total:.2f}s after import")
+
+@kopf.on.cleanup()
+async def cleanup_fn(**kwargs):
+    await UPDATE_COALESCER.flush()
+    await ROUTE_TABLE.stop()
+    await SHARD_COORDINATOR.stop()
+    await READINESS_TRACKER.stop()
+    await ADMISSION_QUEUE.stop()
+    await IDLE_CONTROLLER.stop()
+    if activator_runner is not None:
+        await activator_runner.cleanup()
+    await ORPHAN_SWEEPER.stop()
+    await DELETION_QUEUE.stop()
+    await IMAGE_PREPULLER.stop()
+    await WARM_POOL.stop()
+    await TTL_SCHEDULER.stop()
+    await RESOURCE_CACHE.stop()
+    await close_api_client()
+
+@kopf.on.create('devops.orima.com', 'v1', 'previewenvironments', when=owned_by_this_shard)
+@SHARD_COORDINATOR.tracked('create')
+async def create_fn(spec, name, namespace, meta, status, patch, logger, **kwargs):
+    branch_name = spec.get('branch_name')
+    pr_number, _, _ = validate_spec(spec)
+    if (status or {}).get('create_fn'):
+        # Created while another replica owned it, and the diff-base kopf would skip this with
+        # was not handed over yet; bulk_resume or adopt_environment counted it already
+        logger.info(f"{name} was created before this replica owned it, adopting it")
+        await adopt_environment({'metadata': {**meta, 'name': name, 'namespace': namespace}, 'spec': spec, 'status': status}, counted=True)
+        return status['create_fn']
+    if ADMISSION_QUEUE.enabled:
+        admit_environment(name, namespace, spec, meta, status, patch)
+    pr_namespace, completed = load_checkpoint(status, spec)
+    if completed:
+        logger.info(f"Resuming create of {name} after steps: {', '.join(sorted(completed))}")
+    with CREATION_DURATION.time(), api_priority(CREATE), trace("create", pr_number=pr_number):
+        pr_namespace = pr_namespace or await claim_namespace(pr_number)
+        try:
+            _, names, _ = await reconcile_environment(spec, pr_namespace, completed)
+        except Exception:
+            save_checkpoint(patch, spec, pr_namespace or environment_namespace(pr_number), completed)
+            raise
+    patch.status['checkpoint'] = None
+    patch.status['appliedSpec'] = workload_digest(spec)
+    schedule_ttl(name, namespace, spec, meta)
+    IDLE_CONTROLLER.track(preview_host(pr_number), names['namespace'], names['deployment'])
+    # Returns right away; readiness is recorded in the status by a background task
+    track_readiness(name, namespace, meta, None, pr_number, names['namespace'])
+
+    RECONCILE_COUNT.labels(pr_number=str(pr_number)).inc()
+    RECONCILES_ALL.inc()
+    ENVIRONMENTS_CREATED.labels(branch_name=branch_name).inc()
+    ENVIRONMENTS_CREATED_ALL.inc()
+    ACTIVE_ENVIRONMENTS.inc()
+
+    return {'status': 'Environment Created', **names}
+
+
+@kopf.on.resume('devops.orima.com', 'v1', 'previewenvironments', when=owned_by_this_shard)
+@SHARD_COORDINATOR.tracked()
+async def resume_fn(name, namespace, spec, meta, status, logger, **kwargs):
+    schedule_ttl(name, namespace, spec, meta)
+    if not environment_created(status):
+        # Still queued or mid-create; kopf retries create_fn, which provisions and counts it
+        logger.info(f"Left {name} to create_fn, it has not been created yet")
+        return
+    pr_number = spec.get('pr_number')
+    pr_namespace = environment_namespace(pr_number, status)
+    IDLE_CONTROLLER.track(preview_host(pr_number), pr_namespace, f"pr-{pr_number}-app")
+    track_readiness(name, namespace, meta, status, pr_number, pr_namespace)
+    missing = missing_namespaces is None or (namespace, name) in missing_namespaces
+    pending = update_pending(status, spec)
+    if not missing and not pending:
+        # Namespace was seen by bulk_resume, which already counted it
+        logger.info(f"Resumed tracking active environment: {name}")
+        return
+    _, names, applied = await reconcile_environment(spec, pr_namespace)
+    IDLE_CONTROLLER.track(preview_host(pr_number), names['namespace'], names['deployment'], awake="deployment" in applied)
+    if pending:
+        await record_applied_spec((namespace, name), spec)
+    if not missing:
+        logger.info(f"Applied the update of {name} that was pending before the restart")
+        return
+    if missing_namespaces is not None:
+        missing_namespaces.discard((namespace, name))
+        MISSING_NAMESPACES.set(len(missing_namespaces))
+    ACTIVE_ENVIRONMENTS.inc()
+    logger.info(f"Recreated and resumed active environment: {name}")
+
+@kopf.on.delete('devops.orima.com', 'v1', 'previewenvironments', when=owned_by_this_shard)
+@SHARD_COORDINATOR.tracked('delete')
+async def delete_fn(spec, name, namespace, status, logger, **kwargs):
+    TTL_SCHEDULER.cancel((namespace, name))
+    READINESS_TRACKER.cancel((namespace, name))
+    # Frees the slot for the next queued environment
+    ADMISSION_QUEUE.release((namespace, name))
+    pr_number = spec.get('pr_number')
+    UPDATE_COALESCER.cancel(pr_number)
+    IDLE_CONTROLLER.untrack(preview_host(pr_number))
+    if not environment_created(status):
+        # Still queued, or its create failed part way: never counted as active
+        checkpoint = (status or {}).get('checkpoint') or {}
+        if checkpoint.get('namespace'):
+            await DELETION_QUEUE.delete(checkpoint['namespace'])
+        logger.info(f"Preview environment for PR {pr_number} deleted before it was created")
+        return
+    with trace("delete", pr_number=pr_number):
+        if ROUTE_TABLE.enabled:
+            await delete_route(pr_number)
+        pr_namespace = environment_namespace(pr_number, status)
+        if RESOURCE_CACHE.exists("namespace", pr_namespace) is False:
+            logger.info(f"Namespace {pr_namespace} already gone")
+            ACTIVE_ENVIRONMENTS.dec()
         else:
-            ENVIRONMENTS_FAILED.labels(step="update").inc()
-            logger.error(f"Failed to update deployment {deployment_name}: {e}")
-            raise e
+            # Returns once the delete is accepted; the environment counts as active until the namespace is gone
+            await DELETION_QUEUE.delete(pr_namespace, on_gone=ACTIVE_ENVIRONMENTS.dec)
+    forget_environment(pr_number, spec.get('branch_name'))
+    logger.info(f"Preview environment for PR {pr_number} deleted")
+
+async def apply_update(pr_number, update):
+    spec, pr_namespace, key, recorded = update
+    if IMAGE_PREPULLER.enabled:
+        await IMAGE_PREPULLER.wait(f"{spec['image']}:{spec['image_tag']}")
+    try:
+        with api_priority(UPDATE):
+            _, names, applied = await reconcile_environment(spec, pr_namespace)
+    except client.exceptions.ApiException:
+        ENVIRONMENTS_FAILED.labels(step="update").inc()
+        raise
+    IDLE_CONTROLLER.track(preview_host(pr_number), names['namespace'], names['deployment'], awake="deployment" in applied)
+    # Until this lands, resume_fn re-applies the spec after a restart; a no-op update writes nothing
+    await record_applied_spec(key, spec, recorded)
+    if not applied:
+        logger.info(f"PR {pr_number} spec change does not affect its objects, nothing applied")
+        return
     RECONCILE_COUNT.labels(pr_number=str(pr_number)).inc()
-    logger.info(f"Updated deployment {deployment_name} to image {image}:{tag}")
+    RECONCILES_ALL.inc()
+    logger.info(f"Reconciled {names['deployment']} to image {spec['image']}:{spec['image_tag']}")
+
+UPDATE_COALESCER = UpdateCoalescer(apply=apply_update)
+SHARD_QUEUE_DEPTH.set_function(lambda: SHARD_COORDINATOR.in_flight + UPDATE_COALESCER.pending())
+
+@kopf.on.update('devops.orima.com', 'v1', 'previewenvironments', when=owned_by_this_shard)
+@SHARD_COORDINATOR.tracked()
+async def update_fn(spec, name, namespace, meta, status, logger, **kwargs):
+    # Reject bad specs here; the coalesced apply runs after this handler has returned
+    pr_number, image, tag = validate_spec(spec)
+    schedule_ttl(name, namespace, spec, meta)
+    pr_namespace = environment_namespace(pr_number, status)
+    if IMAGE_PREPULLER.enabled:
+        # Pulls during the quiet window, before the coalesced apply patches the Deployment
+        prepull_image(pr_number, f"{image}:{tag}", pr_namespace)
+    await UPDATE_COALESCER.submit(pr_number, (dict(spec), pr_namespace, (namespace, name), (status or {}).get('appliedSpec')))
+
+STARTUP_PHASE_DURATION.labels(phase="import").set(time.perf_counter() - IMPORT_STARTED)
@@ -0,0 +1,144 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from metrics import DELETION_QUEUE_DEPTH, NAMESPACE_DELETION_DURATION, NAMESPACES_TERMINATING, NAMESPACES_STUCK_TERMINATING
+
+logger = logging.getLogger(__name__)
+
+DELETE_BATCH_SIZE = int(os.environ.get("DELETE_BATCH_SIZE", "20")) # namespace deletes sent at once
+DELETE_BATCH_INTERVAL_SECONDS = float(os.environ.get("DELETE_BATCH_INTERVAL_SECONDS", "1")) # pause between delete batches while more are queued
+DELETE_STUCK_SECONDS = float(os.environ.get("DELETE_STUCK_SECONDS", "600")) # a namespace still terminating after this long counts as stuck
+DELETE_CHECK_SECONDS = 30 # how often terminating namespaces are checked against the cache and for being stuck
+
+
+class DeletionQueue:
+    """Sends namespace deletes in bounded batches and tracks their termination.
+
+    delete() queues a namespace and returns once the API has accepted its
+    delete. Deletes go out `batch_size` at a time with `batch_interval`
+    between batches, so a burst of closed PRs doesn't hit the API server
+    (and the namespace controller) all at once. An accepted namespace is
+    terminating until the cache's namespace watch reports it DELETED
+    (observe()); only then are its `on_gone` callbacks run. A namespace
+    missed by the watch, e.g. across a relist, is caught by the periodic
+    check against `exists`, which reads the cache and sends no requests.
+    """
+
+    def __init__(self, delete, exists=lambda name: None, batch_size=DELETE_BATCH_SIZE,
+                 batch_interval=DELETE_BATCH_INTERVAL_SECONDS, stuck_after=DELETE_STUCK_SECONDS,
+                 check_interval=DELETE_CHECK_SECONDS):
+        self._delete = delete
+        self._exists = exists
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.stuck_after = stuck_after
+        self.check_interval = check_interval
+        self._queued = deque()  # names in send order
+        self._sent = {}  # name -> (future resolved once the delete is accepted, on_gone callbacks)
+        self._terminating = {}  # name -> (accepted at, on_gone callbacks)
+        self._reported_stuck = set()
+        self._worker = None
+        self._task = None
+        DELETION_QUEUE_DEPTH.set_function(lambda: len(self._queued))
+        NAMESPACES_TERMINATING.set_function(lambda: len(self._terminating))
+        NAMESPACES_STUCK_TERMINATING.set_function(lambda: len(self.stuck()))
+
+    def terminating(self):
+        return set(self._terminating)
+
+    def stuck(self, now=None):
+        now = time.monotonic() if now is None else now
+        return [name for name, (accepted, _) in self._terminating.items() if now - accepted >= self.stuck_after]
+
+    async def delete(self, name, on_gone=None):
+        """Queue `name` for deletion and wait until the API has accepted it."""
+        if name in self._terminating:
+            if on_gone is not None:
+                self._terminating[name][1].append(on_gone)
+            return
+        if name not in self._sent:
+            self._sent[name] = (asyncio.get_running_loop().create_future(), [])
+            self._queued.append(name)
+            if self._worker is None:
+                self._worker = asyncio.create_task(self._send_batches())
+        future, callbacks = self._sent[name]
+        if on_gone is not None:
+            callbacks.append(on_gone)
+        await asyncio.shield(future)
+
+    async def _send_batches(self):
+        try:
+            while self._queued:
+                batch = [self._queued.popleft() for _ in range(min(self.batch_size, len(self._queued)))]
+                await asyncio.gather(*(self._send(name) for name in batch))
+                if self._queued:
+                    await asyncio.sleep(self.batch_interval)
+        finally:
+            self._worker = None
+
+    async def _send(self, name):
+        future, on_gone = self._sent.pop(name)
+        try:
+            accepted = await self._delete(name)
+        except Exception as e:
+            future.set_exception(e)
+            return
+        if accepted:
+            self._terminating[name] = (time.monotonic(), on_gone)
+            logger.info(f"Namespace {name} is terminating")
+        else:
+            self._finish(name, on_gone)
+        future.set_result(None)
+
+    def observe(self, kind, event_type, key, entry):
+        """Resource cache listener: a DELETED namespace has finished terminating."""
+        if kind == "namespace" and event_type == "DELETED" and key[1] in self._terminating:
+            self.gone(key[1])
+
+    def gone(self, name):
+        accepted, on_gone = self._terminating.pop(name)
+        self._reported_stuck.discard(name)
+        elapsed = time.monotonic() - accepted
+        NAMESPACE_DELETION_DURATION.observe(elapsed)
+        logger.info(f"Namespace {name} deleted after {elapsed:.0f}s")
+        self._finish(name, on_gone)
+
+    def _finish(self, name, on_gone):
+        for callback in on_gone:
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f"Callback after deleting namespace {name} failed: {e}")
+
+    def check(self):
+        """Finish namespaces the cache no longer has and warn about stuck ones."""
+        for name in list(self._terminating):
+            if self._exists(name) is False:
+                self.gone(name)
+        for name in self.stuck():
+            if name not in self._reported_stuck:
+                self._reported_stuck.add(name)
+                logger.warning(f"Namespace {name} still terminating after {self.stuck_after:.0f}s; check its finalizers")
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            self.check()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """Send whatever is still queued, then stop checking."""
+        if self._worker is not None:
+            await self._worker
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
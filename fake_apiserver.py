@@ -0,0 +1,263 @@
+"""In-memory stand-in for the Kubernetes API server, for tests and benchmarks.
+
+Implements just enough of the REST API for the operator's calls: get,
+list (label selectors and pagination), watch, create, delete, server-side
+apply, merge/strategic-merge patches and the deployment scale subresource.
+A watch without a resourceVersion starts with the current objects; one
+with a resourceVersion only gets later events, as no history is kept.
+Callbacks registered with `on_change` can play the part of controllers,
+e.g. marking a Deployment ready after it is scaled up. `latency` and
+`error_rate` add a per-request delay and random 500s for benchmarks.
+"""
+import asyncio
+import copy
+import json
+import itertools
+import random
+from datetime import datetime, timezone
+from aiohttp import web
+from kubernetes_asyncio import client
+
+
+def _merge(target, patch):
+    """Recursive merge; lists of named dicts merge by name (strategic-merge style)."""
+    for key, value in patch.items():
+        current = target.get(key)
+        if value is None:
+            target.pop(key, None)
+        elif isinstance(value, dict) and isinstance(current, dict):
+            _merge(current, value)
+        elif (isinstance(value, list) and isinstance(current, list)
+              and all(isinstance(item, dict) and "name" in item for item in value + current)):
+            by_name = {item["name"]: item for item in current}
+            for item in value:
+                if item["name"] in by_name:
+                    _merge(by_name[item["name"]], item)
+                else:
+                    current.append(copy.deepcopy(item))
+        else:
+            target[key] = copy.deepcopy(value)
+    return target
+
+
+def _matches(labels, selector):
+    for term in filter(None, (selector or "").split(",")):
+        if term.startswith("!"):
+            if term[1:] in labels:
+                return False
+        elif "!=" in term:
+            key, value = term.split("!=", 1)
+            if labels.get(key) == value:
+                return False
+        elif "=" in term:
+            key, value = term.split("=", 1)
+            if labels.get(key) != value.lstrip("="):
+                return False
+        elif term not in labels:
+            return False
+    return True
+
+
+def _status(code, reason, message):
+    return web.json_response(
+        {"kind": "Status", "apiVersion": "v1", "status": "Failure", "code": code, "reason": reason, "message": message},
+        status=code
+    )
+
+
+class FakeApiServer:
+    def __init__(self, latency=0.0, error_rate=0.0, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self.objects = {}  # plural -> {(namespace, name): object}
+        self.requests = []  # (method, path) of every request served
+        self._resource_version = itertools.count(1)
+        self._on_change = []
+        self._watches = []  # (plural, namespace, label selector, event queue)
+        self._runner = None
+        self.url = None
+
+    def on_change(self, callback):
+        """Call `callback(plural, event_type, obj)` after every write."""
+        self._on_change.append(callback)
+
+    def add(self, plural, obj):
+        """Seed an object directly, bypassing the REST layer."""
+        return self._store(plural, "ADDED", copy.deepcopy(obj))
+
+    def get(self, plural, name, namespace=None):
+        return self.objects.get(plural, {}).get((namespace, name))
+
+    def count(self, method=None, plural=None):
+        return sum(
+            1 for request_method, path in self.requests
+            if (method is None or request_method == method) and (plural is None or f"/{plural}" in path)
+        )
+
+    def _store(self, plural, event_type, obj):
+        metadata = obj.setdefault("metadata", {})
+        metadata["resourceVersion"] = str(next(self._resource_version))
+        metadata.setdefault("creationTimestamp", datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"))
+        metadata.setdefault("uid", f"uid-{metadata['resourceVersion']}")
+        self.objects.setdefault(plural, {})[(metadata.get("namespace"), metadata["name"])] = obj
+        self._notify(plural, event_type, obj)
+        return obj
+
+    def _notify(self, plural, event_type, obj):
+        for callback in self._on_change:
+            callback(plural, event_type, obj)
+        for watched, namespace, selector, queue in self._watches:
+            if watched == plural and self._selected(obj, namespace, selector):
+                queue.put_nowait({"type": event_type, "object": copy.deepcopy(obj)})
+
+    @staticmethod
+    def _selected(obj, namespace, selector):
+        return (namespace is None or obj["metadata"].get("namespace") == namespace) \
+            and _matches(obj["metadata"].get("labels") or {}, selector)
+
+    @staticmethod
+    def _parse(path):
+        parts = [part for part in path.split("/") if part]
+        parts = parts[2:] if parts[0] == "api" else parts[3:]  # drop api/v1 or apis/group/version
+        namespace = None
+        if len(parts) >= 3 and parts[0] == "namespaces":
+            namespace, parts = parts[1], parts[2:]
+        plural = parts[0]
+        name = parts[1] if len(parts) > 1 else None
+        subresource = parts[2] if len(parts) > 2 else None
+        return plural, namespace, name, subresource
+
+    async def _handle(self, request):
+        self.requests.append((request.method, request.path))
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.error_rate and self._random.random() < self.error_rate:
+            return _status(500, "InternalError", "injected error")
+        plural, namespace, name, subresource = self._parse(request.path)
+        store = self.objects.setdefault(plural, {})
+        key = (namespace, name)
+
+        if request.method == "GET" and name is None and request.query.get("watch") in ("true", "True", "1"):
+            return await self._watch(request, plural, namespace, request.query)
+        if request.method == "GET" and name is None:
+            return self._list(plural, namespace, request.query)
+        if request.method == "GET":
+            if key not in store:
+                return _status(404, "NotFound", f"{plural} {name} not found")
+            obj = store[key]
+            if subresource == "scale":
+                return web.json_response(self._scale(obj))
+            return web.json_response(obj)
+
+        if request.method == "POST":
+            body = await request.json()
+            body.setdefault("metadata", {})["namespace"] = namespace
+            if namespace is None:
+                body["metadata"].pop("namespace")
+            if (namespace, body["metadata"]["name"]) in store:
+                return _status(409, "AlreadyExists", f"{plural} {body['metadata']['name']} already exists")
+            return web.json_response(self._store(plural, "ADDED", body), status=201)
+
+        if request.method == "PATCH":
+            body = json.loads(await request.read())
+            content_type = request.headers.get("Content-Type", "")
+            if subresource == "scale":
+                if key not in store:
+                    return _status(404, "NotFound", f"{plural} {name} not found")
+                obj = copy.deepcopy(store[key])
+                obj["spec"]["replicas"] = body["spec"]["replicas"]
+                return web.json_response(self._scale(self._store(plural, "MODIFIED", obj)))
+            if key not in store:
+                if "apply-patch" not in content_type:
+                    return _status(404, "NotFound", f"{plural} {name} not found")
+                body.setdefault("metadata", {})
+                if namespace is not None:
+                    body["metadata"]["namespace"] = namespace
+                return web.json_response(self._store(plural, "ADDED", body), status=201)
+            if subresource == "status":
+                body = {"status": body.get("status", {})}
+            obj = _merge(copy.deepcopy(store[key]), body)
+            return web.json_response(self._store(plural, "MODIFIED", obj))
+
+        if request.method == "DELETE":
+            if key not in store:
+                return _status(404, "NotFound", f"{plural} {name} not found")
+            obj = store.pop(key)
+            self._notify(plural, "DELETED", obj)
+            return web.json_response({"kind": "Status", "apiVersion": "v1", "status": "Success"})
+
+        return _status(405, "MethodNotAllowed", request.method)
+
+    def _list(self, plural, namespace, query):
+        items = [
+            obj for _, obj in sorted(self.objects.get(plural, {}).items(), key=lambda item: str(item[0]))
+            if self._selected(obj, namespace, query.get("labelSelector"))
+        ]
+        start = int(query.get("continue") or 0)
+        limit = int(query.get("limit") or 0) or len(items)
+        page = items[start:start + limit]
+        metadata = {"resourceVersion": str(next(self._resource_version))}
+        if start + limit < len(items):
+            metadata["continue"] = str(start + limit)
+        return web.json_response({"kind": "List", "apiVersion": "v1", "metadata": metadata, "items": page})
+
+    async def _watch(self, request, plural, namespace, query):
+        queue = asyncio.Queue()
+        if not query.get("resourceVersion"):
+            for _, obj in sorted(self.objects.get(plural, {}).items(), key=lambda item: str(item[0])):
+                if self._selected(obj, namespace, query.get("labelSelector")):
+                    queue.put_nowait({"type": "ADDED", "object": copy.deepcopy(obj)})
+        watch = (plural, namespace, query.get("labelSelector"), queue)
+        self._watches.append(watch)
+        response = web.StreamResponse()
+        response.content_type = "application/json"
+        await response.prepare(request)
+        try:
+            timeout = float(query.get("timeoutSeconds") or 0) or None
+            loop = asyncio.get_running_loop()
+            deadline = None if timeout is None else loop.time() + timeout
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), None if deadline is None else deadline - loop.time())
+                except asyncio.TimeoutError:
+                    break
+                if event is None:  # server stopping
+                    break
+                await response.write((json.dumps(event) + "\n").encode())
+        finally:
+            self._watches.remove(watch)
+        return response
+
+    @staticmethod
+    def _scale(obj):
+        return {
+            "apiVersion": "autoscaling/v1",
+            "kind": "Scale",
+            "metadata": {"name": obj["metadata"]["name"], "namespace": obj["metadata"].get("namespace")},
+            "spec": {"replicas": obj.get("spec", {}).get("replicas", 0)},
+            "status": {"replicas": obj.get("status", {}).get("replicas", 0)},
+        }
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_route("*", "/{tail:.*}", self._handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        self.url = f"http://127.0.0.1:{port}"
+        return self.url
+
+    async def stop(self):
+        for *_, queue in self._watches:
+            queue.put_nowait(None)
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def api_client(self):
+        """An ApiClient pointed at this server; must be created inside the running loop."""
+        configuration = client.Configuration(host=self.url)
+        return client.ApiClient(configuration)
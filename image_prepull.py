@@ -0,0 +1,126 @@
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from metrics import IMAGE_PREPULLS, IMAGE_PREPULL_DURATION, IMAGE_PREPULL_SAVED
+
+logger = logging.getLogger(__name__)
+
+IMAGE_PREPULL_ENABLED = os.environ.get("IMAGE_PREPULL_ENABLED", "false").lower() == "true" # pull an update's new image onto the nodes before patching the Deployment
+IMAGE_PREPULL_NAMESPACE = os.environ.get("IMAGE_PREPULL_NAMESPACE", "preview-prepull") # holds the short-lived pre-pull DaemonSets
+IMAGE_PREPULL_NODE_SELECTOR = os.environ.get("IMAGE_PREPULL_NODE_SELECTOR", "") # "key=value,..." of the nodes previews run on; empty means every node
+IMAGE_PREPULL_TIMEOUT_SECONDS = float(os.environ.get("IMAGE_PREPULL_TIMEOUT_SECONDS", "300")) # roll out anyway if the pull hasn't finished by then
+IMAGE_PREPULL_POLL_SECONDS = 2 # how often pre-pull progress is checked
+PAUSE_IMAGE = "registry.k8s.io/pause:3.9" # keeps a pre-pull pod alive once its init container has run
+
+# Waiting reasons of an init container whose image is not on its node yet
+PULLING_REASONS = {"ContainerCreating", "PodInitializing", "ErrImagePull", "ImagePullBackOff"}
+
+
+def prepull_name(image):
+    return f"prepull-{hashlib.sha256(image.encode()).hexdigest()[:12]}"
+
+def node_selector(config):
+    """"key=value,..." -> nodeSelector dict."""
+    return dict(term.split("=", 1) for term in filter(None, (part.strip() for part in config.split(","))))
+
+def image_pulled(pod):
+    """Whether a pre-pull pod's node has the image, judging by its init container."""
+    statuses = (pod.status.init_container_statuses if pod.status else None) or []
+    if not statuses or statuses[0].state is None:
+        return False
+    state = statuses[0].state
+    if state.running or state.terminated:
+        return True
+    # An image without a shell fails to start, but only after it was pulled
+    return state.waiting is not None and state.waiting.reason not in PULLING_REASONS
+
+
+class ImagePrePuller:
+    """Pulls an update's new image onto the preview nodes ahead of its rollout.
+
+    request() is called as soon as update_fn sees a new image: `apply(image)`
+    creates a DaemonSet running the image as a no-op init container, and
+    `progress(image)` reports (nodes pulled, nodes targeted; None until the
+    DaemonSet controller has seen it). The pull overlaps the update's quiet
+    window. wait() holds the coalesced apply until every node has the image
+    or `timeout` has passed, so the new pod starts without pulling. The
+    DaemonSet is removed (`remove(image)`) once the pull is over. Pulls of
+    one image are shared between PRs.
+    """
+
+    def __init__(self, apply, progress, remove, enabled=IMAGE_PREPULL_ENABLED,
+                 timeout=IMAGE_PREPULL_TIMEOUT_SECONDS, poll_interval=IMAGE_PREPULL_POLL_SECONDS):
+        self._apply = apply
+        self._progress = progress
+        self._remove = remove
+        self.enabled = enabled
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self._pulls = {}  # image -> (started, task)
+
+    def pulling(self):
+        return {image for image, (_, task) in self._pulls.items() if not task.done()}
+
+    def request(self, image):
+        """Start pulling `image` unless a pull of it is already running or waiting to be used."""
+        now = time.monotonic()
+        # Drop finished pulls no update waited for, e.g. a tag superseded within the quiet window
+        for stale in [key for key, (started, task) in self._pulls.items() if task.done() and now - started > self.timeout]:
+            del self._pulls[stale]
+        if image not in self._pulls:
+            self._pulls[image] = (now, asyncio.create_task(self._pull(image)))
+
+    async def wait(self, image):
+        """Wait for the pull of `image`, if there is one. True if every node has it."""
+        entry = self._pulls.get(image)
+        if entry is None:
+            return False
+        started, task = entry
+        waiting_since = time.monotonic()
+        duration = await asyncio.shield(task)
+        if self._pulls.get(image) is entry:
+            del self._pulls[image]
+        if duration is None:
+            return False
+        # Without the pre-pull the new pod would pull for `duration`; the part before wait() was hidden in the quiet window
+        IMAGE_PREPULL_SAVED.observe(min(duration, waiting_since - started))
+        return True
+
+    async def _pull(self, image):
+        """Seconds the pull took, or None if it failed or timed out."""
+        started = time.monotonic()
+        result, duration = "failed", None
+        try:
+            await self._apply(image)
+            await asyncio.wait_for(self._wait_pulled(image), self.timeout)
+            result, duration = "pulled", time.monotonic() - started
+            IMAGE_PREPULL_DURATION.observe(duration)
+            logger.info(f"Pre-pulled {image} in {duration:.1f}s")
+        except asyncio.TimeoutError:
+            result = "timeout"
+            logger.warning(f"Pre-pull of {image} not done after {self.timeout:.0f}s, rolling out anyway")
+        except Exception as e:
+            logger.warning(f"Pre-pull of {image} failed, rolling out anyway: {e}")
+        finally:
+            IMAGE_PREPULLS.labels(result=result).inc()
+            try:
+                await self._remove(image)
+            except Exception as e:
+                logger.warning(f"Could not remove the pre-pull DaemonSet of {image}: {e}")
+        return duration
+
+    async def _wait_pulled(self, image):
+        while True:
+            pulled, targeted = await self._progress(image)
+            if targeted is not None and pulled >= targeted:
+                return
+            await asyncio.sleep(self.poll_interval)
+
+    async def stop(self):
+        tasks = [task for _, task in self._pulls.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._pulls.clear()
@@ -0,0 +1,53 @@
+import os
+import logging
+from kubernetes_asyncio import client, config
+from api_governor import ApiGovernor
+from tracing import instrument, instrument_serialization
+
+logger = logging.getLogger(__name__)
+
+API_POOL_SIZE = int(os.environ.get("K8S_API_POOL_SIZE", "64")) # max concurrent connections to the API server
+API_KEEPALIVE_SECONDS = float(os.environ.get("K8S_API_KEEPALIVE_SECONDS", "30")) # how long an idle pooled connection is kept open
+
+_api_client = None
+
+
+async def load_config():
+    try:
+        await config.load_kube_config()
+    except config.ConfigException:
+        try:
+            config.load_incluster_config()
+        except config.ConfigException:
+            logger.warning("Kubernetes config could not be loaded. This is expected during CI/tests.")
+
+
+def get_api_client():
+    """Return the process-wide ApiClient, creating it on first use.
+
+    All handlers share this client, so every API call goes through one
+    keep-alive connection pool instead of opening a connection per call,
+    and through one ApiGovernor that rate-limits and prioritises them.
+    Every request is timed and traced (see tracing.py).
+    Must be called from inside the running event loop.
+    """
+    global _api_client
+    if _api_client is None:
+        configuration = client.Configuration.get_default_copy()
+        configuration.connection_pool_maxsize = API_POOL_SIZE
+        _api_client = client.ApiClient(configuration)
+        # kubernetes_asyncio builds its own TCPConnector and does not expose keep-alive
+        _api_client.rest_client.pool_manager.connector._keepalive_timeout = API_KEEPALIVE_SECONDS
+        # Created with the client so it lives on the same event loop. Instrumented
+        # inside the governor, so every attempt is timed without its queueing delay.
+        _api_client.rest_client.request = ApiGovernor().wrap(instrument(_api_client.rest_client.request))
+        instrument_serialization(_api_client)
+        logger.info(f"Kubernetes API client pool ready (size={API_POOL_SIZE}, keepalive={API_KEEPALIVE_SECONDS}s)")
+    return _api_client
+
+
+async def close_api_client():
+    global _api_client
+    if _api_client is not None:
+        await _api_client.close()
+        _api_client = None
@@ -1,20 +1,78 @@
-from prometheus_client import Counter, Gauge, Histogram, start_http_server
+from collections import OrderedDict
+from prometheus_client import Counter, Gauge, Histogram, make_wsgi_app
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
 import logging
+import os
+import threading
 
 logger = logging.getLogger(__name__)
 
-# How many full preview environments were created successfully
-ENVIRONMENTS_CREATED = Counter(
+METRICS_MAX_SERIES = int(os.environ.get("METRICS_MAX_SERIES", "1000")) # per-PR/per-branch series kept per metric; least recently used are dropped
+
+
+class BoundedLabels:
+    """Caps the label combinations of a labelled metric with LRU eviction.
+
+    Used in place of the metric: labels() returns the child as usual but
+    also marks the combination as recently used, and once more than
+    `max_series` exist the least recently used one is removed from the
+    registry. remove() drops a series when its environment is deleted.
+    """
+
+    def __init__(self, metric, max_series=METRICS_MAX_SERIES):
+        self._metric = metric
+        self._max_series = max_series
+        self._series = OrderedDict()
+
+    def __len__(self):
+        return len(self._series)
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self._metric._labelnames)
+
+    def labels(self, **labels):
+        key = self._key(labels)
+        self._series[key] = None
+        self._series.move_to_end(key)
+        while len(self._series) > self._max_series:
+            evicted, _ = self._series.popitem(last=False)
+            self._metric.remove(*evicted)
+            SERIES_EVICTED.labels(metric=self._metric._name).inc()
+        return self._metric.labels(*key)
+
+    def remove(self, **labels):
+        key = self._key(labels)
+        if key in self._series:
+            del self._series[key]
+            self._metric.remove(*key)
+
+# Series dropped by BoundedLabels because a metric hit METRICS_MAX_SERIES
+SERIES_EVICTED = Counter(
+    "preview_operator_metric_series_evicted_total",
+    "Per-PR metric series evicted to bound cardinality",
+    ["metric"]
+)
+
+# How many full preview environments were created successfully, per branch (bounded, removed on delete)
+ENVIRONMENTS_CREATED = BoundedLabels(Counter(
     "preview_environments_created_total",
     "Total preview environments successfully created",
     ["branch_name"]
+))
+
+# Same count without the branch label, so it survives series eviction
+ENVIRONMENTS_CREATED_ALL = Counter(
+    "preview_environments_created_all_total",
+    "Total preview environments successfully created, across all branches"
 )
 
 # How many failed (broken down by which step failed)
 ENVIRONMENTS_FAILED = Counter(
     "preview_environments_failed_total",
     "Total preview environment creation failures",
-    ["step"]  # "deployment", "service", or "ingress"
+    ["step"]  # "namespace", "deployment", "service", "ingress", "network_policy", "activator_service", "route_service", "shared_ingress", "update", or "rebalance"
 )
 
 # How many are currently alive
@@ -23,11 +81,17 @@ ACTIVE_ENVIRONMENTS = Gauge(
     "Currently active preview environments"
 )
 
-# Tracks how many times each PR has triggered reconciliation
-RECONCILE_COUNT = Counter(
+# Tracks how many times each PR has triggered reconciliation (bounded, removed on delete)
+RECONCILE_COUNT = BoundedLabels(Counter(
     "preview_environments_reconcile_total",
     "Total reconciliation events per PR",
     ["pr_number"]
+))
+
+# Reconciliations across all PRs
+RECONCILES_ALL = Counter(
+    "preview_environments_reconcile_all_total",
+    "Total reconciliation events across all PRs"
 )
 
 # How long the full create_fn takes end to end
@@ -37,20 +101,414 @@ CREATION_DURATION = Histogram(
     buckets=[1, 2, 5, 10, 20, 30, 60, float("inf")]
 )
 
+# How long each provisioning step takes, to find the slow resource when time-to-URL goes up
+PROVISION_STEP_DURATION = Histogram(
+    "preview_environment_provision_step_duration_seconds",
+    "Time to provision a single resource of a preview environment",
+    ["step"],
+    buckets=[0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, float("inf")]
+)
+
+# Objects whose rendered state already matched the cluster, so no write was sent
+APPLIES_SKIPPED = Counter(
+    "preview_environment_applies_skipped_total",
+    "Object applies skipped because the desired state was unchanged",
+    ["step"]  # "deployment", "service", "ingress", "network_policy", "activator_service" or "route_service"
+)
+
 # How many environments were auto-deleted due to TTL expiry
 ENVIRONMENTS_EXPIRED = Counter(
     "preview_environments_expired_total",
     "Total preview environments auto-deleted due to TTL expiry"
 )
 
+# How late TTL deletions are issued relative to the environment's deadline
+TTL_EXPIRY_LAG = Histogram(
+    "preview_environments_ttl_expiry_lag_seconds",
+    "Delay between an environment's TTL deadline and its deletion being issued",
+    buckets=[0.1, 0.5, 1, 5, 15, 30, 60, float("inf")]
+)
+
+# How many environments currently have a TTL deadline scheduled
+TTL_SCHEDULED = Gauge(
+    "preview_environments_ttl_scheduled",
+    "Preview environments with a pending TTL deadline"
+)
+
+# How long the bulk startup resume took on the last operator start
+RESUME_DURATION = Gauge(
+    "preview_operator_resume_duration_seconds",
+    "Time taken by the bulk startup resume"
+)
+
+# Where operator start-up time went on the last start: import, config, cache_sync, resume, total
+STARTUP_PHASE_DURATION = Gauge(
+    "preview_operator_startup_phase_seconds",
+    "Duration of each operator start-up phase on the last start",
+    ["phase"]
+)
+
+# CRs whose preview namespace was missing at startup and still needs recreating
+MISSING_NAMESPACES = Gauge(
+    "preview_environments_missing_namespace",
+    "PreviewEnvironments whose namespace was missing at startup"
+)
+
+# Lookups answered by the resource cache ("hit") vs. ones that need the API ("miss")
+CACHE_LOOKUPS = Counter(
+    "preview_operator_cache_lookups_total",
+    "Resource cache lookups by kind and result",
+    ["kind", "result"]
+)
+
+# Seconds since the cache last heard from the API server (event or bookmark)
+CACHE_STALENESS = Gauge(
+    "preview_operator_cache_staleness_seconds",
+    "Seconds since the resource cache last received a watch event",
+    ["kind"]
+)
+
+# Objects currently held in the resource cache
+CACHE_ENTRIES = Gauge(
+    "preview_operator_cache_entries",
+    "Objects held in the resource cache",
+    ["kind"]
+)
+
+# Spec updates received vs. actually applied after coalescing; the gap is rollouts saved
+UPDATES_RECEIVED = Counter(
+    "preview_environments_updates_received_total",
+    "Spec updates received by update_fn"
+)
+
+UPDATES_APPLIED = Counter(
+    "preview_environments_updates_applied_total",
+    "Coalesced spec updates applied to the cluster"
+)
+
+# Creates served from the warm namespace pool ("hit") vs. creating a namespace from scratch ("miss")
+WARM_POOL_CLAIMS = Counter(
+    "preview_warm_pool_claims_total",
+    "Warm pool claims by result",
+    ["result"]
+)
+
+# How long it takes to bind a warm namespace to a PR
+WARM_POOL_CLAIM_DURATION = Histogram(
+    "preview_warm_pool_claim_duration_seconds",
+    "Time to claim a namespace from the warm pool",
+    buckets=[0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, float("inf")]
+)
+
+# Warm namespaces provisioned and waiting to be claimed
+WARM_POOL_READY = Gauge(
+    "preview_warm_pool_ready",
+    "Warm namespaces ready to be claimed"
+)
+
+# Previews currently scaled to zero for lack of traffic
+SCALED_TO_ZERO = Gauge(
+    "preview_environments_scaled_to_zero",
+    "Preview environments currently scaled to zero"
+)
+
+# Scale-to-zero ("down") and wake-up ("up") events
+SCALE_EVENTS = Counter(
+    "preview_environments_scale_events_total",
+    "Idle scale-downs and on-demand wake-ups",
+    ["direction"]
+)
+
+# How long a request is held by the activator while its preview wakes up
+ACTIVATOR_WAIT = Histogram(
+    "preview_activator_wait_seconds",
+    "Time from the first request to a sleeping preview until it is ready",
+    buckets=[1, 2, 5, 10, 20, 30, 60, 120, float("inf")]
+)
+
+# Time from a CR being created until its preview serves traffic over TLS
+TIME_TO_READY = Histogram(
+    "preview_environment_time_to_ready_seconds",
+    "Time from PreviewEnvironment creation until its pod is ready and its certificate issued",
+    buckets=[5, 10, 20, 30, 60, 90, 120, 180, 300, 600, float("inf")]
+)
+
+# Where time-to-ready goes: scheduling, image_pull, probe, tls
+TIME_TO_READY_PHASE = Histogram(
+    "preview_environment_time_to_ready_phase_seconds",
+    "Time-to-ready split into scheduling, image pull, readiness probe and TLS issuance",
+    ["phase"],
+    buckets=[1, 2, 5, 10, 20, 30, 60, 120, 300, float("inf")]
+)
+
+# New previews still waiting for their pod or certificate to become ready
+ENVIRONMENTS_NOT_READY = Gauge(
+    "preview_environments_not_ready",
+    "Preview environments created but not ready yet"
+)
+
+# Namespaces found by the last orphan sweep that no PreviewEnvironment owns
+ORPHANS_FOUND = Gauge(
+    "preview_orphaned_namespaces",
+    "Managed namespaces without a PreviewEnvironment, as of the last sweep"
+)
+
+# How long orphaned namespaces had been leaking when found
+ORPHAN_AGE = Histogram(
+    "preview_orphaned_namespace_age_seconds",
+    "Age of orphaned namespaces found by the sweeper",
+    buckets=[600, 1800, 3600, 6 * 3600, 24 * 3600, 7 * 24 * 3600, float("inf")]
+)
+
+# Orphaned namespaces deleted by the sweeper
+ORPHANS_DELETED = Counter(
+    "preview_orphaned_namespaces_deleted_total",
+    "Orphaned namespaces deleted by the sweeper"
+)
+
+# API requests waiting for the client-side governor, by priority
+API_QUEUE_DEPTH = Gauge(
+    "preview_operator_api_queue_depth",
+    "API requests queued by the client-side rate limiter",
+    ["priority"]
+)
+
+# How long API requests waited for a token and a slot
+API_QUEUE_WAIT = Histogram(
+    "preview_operator_api_queue_wait_seconds",
+    "Time API requests waited in the client-side rate limiter",
+    ["priority"],
+    buckets=[0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, float("inf")]
+)
+
+# API requests currently in flight
+API_IN_FLIGHT = Gauge(
+    "preview_operator_api_in_flight",
+    "API requests in flight through the client-side rate limiter"
+)
+
+# 429 responses from API Priority and Fairness
+API_THROTTLED = Counter(
+    "preview_operator_api_throttled_total",
+    "API requests rejected with 429 and retried"
+)
+
+# Latency of every API request the operator sends, by verb, resource and HTTP status
+API_REQUEST_DURATION = Histogram(
+    "preview_operator_api_request_duration_seconds",
+    "Kubernetes API request latency as seen by the operator",
+    ["verb", "resource", "code"],
+    buckets=[0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, float("inf")]
+)
+
+# Requests sent again after a 429, by verb and resource
+API_RETRIES = Counter(
+    "preview_operator_api_retries_total",
+    "Kubernetes API requests retried after being throttled",
+    ["verb", "resource"]
+)
+
+# Time the operator itself spends turning models into JSON and back
+API_SERIALIZATION_DURATION = Histogram(
+    "preview_operator_api_serialization_duration_seconds",
+    "Request serialization and response deserialization time in the operator",
+    ["stage"],  # "serialize" or "deserialize"
+    buckets=[0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, float("inf")]
+)
+
+# Spans dropped because their trace hit MAX_SPANS_PER_TRACE
+TRACE_SPANS_DROPPED = Counter(
+    "preview_operator_trace_spans_dropped_total",
+    "Trace spans dropped because their trace was too large"
+)
+
+# Operator replicas currently in the shard ring, as seen by this replica
+SHARD_MEMBERS = Gauge(
+    "preview_operator_shard_members",
+    "Operator replicas in the shard ring"
+)
+
+# How often the shard ring changed and this replica re-divided PRs
+SHARD_REBALANCES = Counter(
+    "preview_operator_shard_rebalances_total",
+    "Shard ring changes handled by this replica"
+)
+
+# Handlers running plus coalesced updates waiting on this replica
+SHARD_QUEUE_DEPTH = Gauge(
+    "preview_operator_shard_queue_depth",
+    "Handlers in flight and pending coalesced updates on this replica"
+)
+
+# Time from a CR being created/deleted to this replica's handler starting
+SHARD_EVENT_LAG = Histogram(
+    "preview_operator_shard_event_lag_seconds",
+    "Delay between a create/delete and its handler starting on the owning replica",
+    ["event"],
+    buckets=[0.1, 0.5, 1, 2, 5, 10, 30, 60, float("inf")]
+)
+
+# Previews routed through the shared Ingress
+SHARED_ROUTES = Gauge(
+    "preview_operator_shared_routes",
+    "Hosts in the shared Ingress routing table"
+)
+
+# Writes of the shared Ingress; each one is an ingress controller reload
+ROUTE_TABLE_WRITES = Counter(
+    "preview_operator_route_table_writes_total",
+    "Writes of the shared Ingress routing table"
+)
+
+# New environments waiting for preview capacity
+ADMISSION_QUEUE_DEPTH = Gauge(
+    "preview_admission_queue_depth",
+    "New preview environments waiting for capacity"
+)
+
+# Time from a CR being created until it was admitted
+ADMISSION_WAIT = Histogram(
+    "preview_admission_wait_seconds",
+    "Time new preview environments waited for capacity before provisioning",
+    buckets=[1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, float("inf")]
+)
+
+# Environments this replica may run at once under the admission budget
+ADMISSION_CAPACITY = Gauge(
+    "preview_admission_capacity",
+    "Preview environment slots available to this replica (0 when admission control is off)"
+)
+
+# Slots currently taken
+ADMISSION_ADMITTED = Gauge(
+    "preview_admission_admitted",
+    "Admitted preview environments holding a slot"
+)
+
+# Namespace deletes waiting for their batch to be sent
+DELETION_QUEUE_DEPTH = Gauge(
+    "preview_operator_deletion_queue_depth",
+    "Namespace deletes queued and not yet sent"
+)
+
+# Time from a namespace delete being accepted until the namespace is gone
+NAMESPACE_DELETION_DURATION = Histogram(
+    "preview_namespace_deletion_duration_seconds",
+    "Time from a preview namespace delete being accepted until the namespace is gone",
+    buckets=[5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600, float("inf")]
+)
+
+# Preview namespaces deleted but not gone yet
+NAMESPACES_TERMINATING = Gauge(
+    "preview_namespaces_terminating",
+    "Preview namespaces deleted by this replica that are still terminating"
+)
+
+# Namespaces terminating for longer than DELETE_STUCK_SECONDS, usually a finalizer that never clears
+NAMESPACES_STUCK_TERMINATING = Gauge(
+    "preview_namespaces_stuck_terminating",
+    "Preview namespaces terminating for longer than DELETE_STUCK_SECONDS"
+)
+
+# Image pre-pulls by outcome: pulled, timeout (rolled out anyway) or failed
+IMAGE_PREPULLS = Counter(
+    "preview_image_prepulls_total",
+    "Image pre-pulls ahead of an update rollout, by result",
+    ["result"]
+)
+
+# Time to pull an update's image onto every preview node
+IMAGE_PREPULL_DURATION = Histogram(
+    "preview_image_prepull_duration_seconds",
+    "Time to pull an update's new image onto every targeted node",
+    buckets=[1, 5, 10, 20, 30, 60, 120, 300, float("inf")]
+)
+
+# Pull time taken off the rollout: the part of the pre-pull that ran before the update was due
+IMAGE_PREPULL_SAVED = Histogram(
+    "preview_image_prepull_saved_seconds",
+    "Image pull time that ran before the update was applied instead of delaying the new pod",
+    buckets=[1, 5, 10, 20, 30, 60, 120, 300, float("inf")]
+)
+
 # Pre-initialize labels so metrics exist from startup even before any events occur
 ENVIRONMENTS_CREATED.labels(branch_name="unknown")
+ENVIRONMENTS_FAILED.labels(step="namespace")
 ENVIRONMENTS_FAILED.labels(step="deployment")
 ENVIRONMENTS_FAILED.labels(step="service")
 ENVIRONMENTS_FAILED.labels(step="ingress")
+ENVIRONMENTS_FAILED.labels(step="network_policy")
+ENVIRONMENTS_FAILED.labels(step="activator_service")
+ENVIRONMENTS_FAILED.labels(step="route_service")
+ENVIRONMENTS_FAILED.labels(step="shared_ingress")
 ENVIRONMENTS_FAILED.labels(step="update")
+ENVIRONMENTS_FAILED.labels(step="rebalance")
+for step in ("deployment", "service", "ingress", "network_policy", "activator_service", "route_service"):
+    APPLIES_SKIPPED.labels(step=step)
 RECONCILE_COUNT.labels(pr_number="unknown")
+WARM_POOL_CLAIMS.labels(result="hit")
+WARM_POOL_CLAIMS.labels(result="miss")
+SCALE_EVENTS.labels(direction="down")
+SCALE_EVENTS.labels(direction="up")
+TIME_TO_READY_PHASE.labels(phase="scheduling")
+TIME_TO_READY_PHASE.labels(phase="image_pull")
+TIME_TO_READY_PHASE.labels(phase="probe")
+TIME_TO_READY_PHASE.labels(phase="tls")
+for priority in ("delete", "create", "update", "background"):
+    API_QUEUE_DEPTH.labels(priority=priority)
+    API_QUEUE_WAIT.labels(priority=priority)
+API_SERIALIZATION_DURATION.labels(stage="serialize")
+API_SERIALIZATION_DURATION.labels(stage="deserialize")
+SHARD_EVENT_LAG.labels(event="create")
+for result in ("pulled", "timeout", "failed"):
+    IMAGE_PREPULLS.labels(result=result)
+for phase in ("import", "config", "cache_sync", "resume", "total"):
+    STARTUP_PHASE_DURATION.labels(phase=phase)
+SHARD_EVENT_LAG.labels(event="delete")
+
+def forget_environment(pr_number, branch_name=None):
+    """Drop an environment's per-PR series once it is deleted."""
+    RECONCILE_COUNT.remove(pr_number=pr_number)
+    if branch_name is not None:
+        ENVIRONMENTS_CREATED.remove(branch_name=branch_name)
+
+class _ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server(port: int = 8000, debug_routes=None, ready=lambda: True):
+    """Serve /metrics, plus `debug_routes` (path -> fn(query) returning (content type, body)).
+
+    Runs in its own thread, like prometheus_client's server, so a slow
+    debug request never blocks the event loop. A ValueError from a route
+    is answered with a 400. /healthz answers 200 as soon as the server
+    runs; /readyz answers 503 until `ready()` is true.
+    """
+    metrics_app = make_wsgi_app()
+    routes = debug_routes or {}
+
+    def app(environ, start_response):
+        path = environ.get("PATH_INFO")
+        if path in ("/healthz", "/readyz"):
+            ok = path == "/healthz" or ready()
+            start_response("200 OK" if ok else "503 Service Unavailable", [("Content-Type", "text/plain")])
+            return [b"ok\n" if ok else b"starting\n"]
+        route = routes.get(path)
+        if route is None:
+            return metrics_app(environ, start_response)
+        query = {key: values[0] for key, values in parse_qs(environ.get("QUERY_STRING", "")).items()}
+        try:
+            content_type, body = route(query)
+        except ValueError as e:
+            start_response("400 Bad Request", [("Content-Type", "text/plain")])
+            return [f"{e}\n".encode()]
+        start_response("200 OK", [("Content-Type", content_type)])
+        return [body.encode()]
 
-def start_metrics_server(port: int = 8000):
-    start_http_server(port)
-    logger.info(f"Metrics server started on :{port}")
\ No newline at end of file
+    server = make_server("", port, app, _ThreadingWSGIServer, handler_class=_QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"Metrics server started on :{port}")
+    return server
\ No newline at end of file
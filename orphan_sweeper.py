@@ -0,0 +1,131 @@
+import asyncio
+import logging
+import os
+from datetime import datetime, timezone
+from metrics import ORPHANS_FOUND, ORPHANS_DELETED, ORPHAN_AGE
+from sharding import SHARD_LABEL
+
+logger = logging.getLogger(__name__)
+
+ORPHAN_SWEEP_INTERVAL_SECONDS = float(os.environ.get("ORPHAN_SWEEP_INTERVAL_SECONDS", "600")) # how often leaked namespaces are looked for; 0 disables the sweeper
+ORPHAN_GRACE_SECONDS = float(os.environ.get("ORPHAN_GRACE_SECONDS", "600")) # never touch namespaces younger than this
+ORPHAN_DELETE_BATCH_SIZE = int(os.environ.get("ORPHAN_DELETE_BATCH_SIZE", "20")) # namespaces deleted per batch
+ORPHAN_BATCH_PAUSE_SECONDS = 5 # pause between delete batches
+
+
+class OrphanSweeper:
+    """Deletes preview namespaces that no PreviewEnvironment owns any more.
+
+    Namespaces leak when a CR is removed while the operator is down or a
+    create fails half way. Each sweep does one LIST of managed namespaces,
+    then one LIST of CRs (in that order, so a namespace created during the
+    sweep always has its CR in the second list), and deletes namespaces
+    whose pr-number no CR claims in batches of `batch_size`. Terminating
+    namespaces, ones younger than `grace` and ones for PRs this replica
+    does not own (`owns`) are left alone.
+
+    An unclaimed warm namespace is deleted when no pool holds it: it is
+    this replica's (labelled `shard`, or any with sharding off) but not in
+    `pooled()`, e.g. beyond the pool size or left by a failed claim, or its
+    replica is no longer one of `members()`. A dead replica's namespaces
+    are split between the survivors with `owns`, by name.
+    """
+
+    def __init__(self, list_namespaces, list_environments, delete_namespace, owns=lambda pr_number: True,
+                 shard=None, members=lambda: (), pooled=lambda: set(),
+                 interval=ORPHAN_SWEEP_INTERVAL_SECONDS, grace=ORPHAN_GRACE_SECONDS,
+                 batch_size=ORPHAN_DELETE_BATCH_SIZE, batch_pause=ORPHAN_BATCH_PAUSE_SECONDS):
+        self._list_namespaces = list_namespaces
+        self._list_environments = list_environments
+        self._delete_namespace = delete_namespace
+        self._owns = owns
+        self._shard = shard
+        self._members = members
+        self._pooled = pooled
+        self.interval = interval
+        self.grace = grace
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+        self._task = None
+
+    @property
+    def enabled(self):
+        return self.interval > 0
+
+    def find_orphans(self, namespaces, environments, now, pooled=None):
+        """Return (name, age in seconds) of every namespace that can be deleted, oldest first.
+
+        `pooled` is what the warm pool held before `namespaces` was listed.
+        """
+        claimed = {str(env.get('spec', {}).get('pr_number')) for env in environments}
+        pooled = self._pooled() if pooled is None else pooled
+        orphans = []
+        for ns in namespaces:
+            labels = ns.metadata.labels or {}
+            pr_number = labels.get("pr-number")
+            if pr_number is None:
+                if labels.get("preview-pool") != "warm" or self._pool_holds(ns.metadata.name, labels, pooled):
+                    continue
+            elif pr_number in claimed or not self._owns(pr_number):
+                continue
+            if ns.status is not None and ns.status.phase == "Terminating":
+                continue
+            age = (now - ns.metadata.creation_timestamp).total_seconds()
+            if age >= self.grace:
+                orphans.append((ns.metadata.name, age))
+        return sorted(orphans, key=lambda orphan: -orphan[1])
+
+    def _pool_holds(self, name, labels, pooled):
+        """Whether an unclaimed warm namespace still belongs to a pool, or is another replica's to sweep."""
+        shard = labels.get(SHARD_LABEL)
+        if self._shard is None or shard == self._shard:
+            return name in pooled
+        return shard in self._members() or not self._owns(name)
+
+    async def sweep(self):
+        # Taken first, so a namespace claimed while the LIST runs is still held
+        pooled = self._pooled()
+        namespaces = await self._list_namespaces()
+        environments = await self._list_environments()
+        orphans = self.find_orphans(namespaces, environments, datetime.now(timezone.utc), pooled)
+        ORPHANS_FOUND.set(len(orphans))
+        for _, age in orphans:
+            ORPHAN_AGE.observe(age)
+        if orphans:
+            logger.warning(f"Found {len(orphans)} orphaned preview namespaces, oldest {orphans[0][1] / 3600:.1f}h old")
+        deleted = 0
+        for start in range(0, len(orphans), self.batch_size):
+            if start:
+                await asyncio.sleep(self.batch_pause)
+            batch = [name for name, _ in orphans[start:start + self.batch_size]]
+            results = await asyncio.gather(*(self._delete_namespace(name) for name in batch), return_exceptions=True)
+            for name, result in zip(batch, results):
+                if isinstance(result, Exception):
+                    logger.error(f"Failed to delete orphaned namespace {name}: {result}")
+                else:
+                    deleted += 1
+                    ORPHANS_DELETED.inc()
+                    logger.info(f"Deleted orphaned namespace {name}")
+        return deleted
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.sweep()
+            except Exception as e:
+                logger.warning(f"Orphan sweep failed: {e}")
+
+    def start(self):
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self.run())
+            logger.info(f"Orphan sweeper started (interval={self.interval}s)")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
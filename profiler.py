@@ -0,0 +1,67 @@
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+PROFILE_MAX_SECONDS = float(os.environ.get("PROFILE_MAX_SECONDS", "60")) # longest profile /debug/profile will take
+PROFILE_INTERVAL_SECONDS = 0.005 # time between stack samples
+
+
+class SamplingProfiler:
+    """Samples the stack of one thread (the event loop's) from another thread.
+
+    Nothing runs until profile() is called, so it costs nothing in between.
+    The result is in collapsed-stack format ("outer;inner count" per line),
+    which flamegraph.pl and speedscope read directly. Only one profile runs
+    at a time.
+    """
+
+    def __init__(self, thread_id=None, interval=PROFILE_INTERVAL_SECONDS, max_seconds=PROFILE_MAX_SECONDS):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self._lock = threading.Lock()
+
+    def attach(self, thread_id=None):
+        """Profile `thread_id`, by default the calling thread."""
+        self.thread_id = thread_id or threading.get_ident()
+
+    def sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+            frame = frame.f_back
+        return ";".join(reversed(stack))
+
+    def profile(self, seconds):
+        if self.thread_id is None:
+            raise ValueError("profiler is not attached to a thread")
+        if not 0 < seconds <= self.max_seconds:
+            raise ValueError(f"seconds must be in (0, {self.max_seconds:g}]")
+        if not self._lock.acquire(blocking=False):
+            raise ValueError("a profile is already running")
+        try:
+            samples = Counter()
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                stack = self.sample()
+                if stack:
+                    samples[stack] += 1
+                time.sleep(self.interval)
+        finally:
+            self._lock.release()
+        logger.info(f"Profiled {sum(samples.values())} samples over {seconds:g}s")
+        return "".join(f"{stack} {count}\n" for stack, count in samples.most_common())
+
+PROFILER = SamplingProfiler()
+
+
+def profile_endpoint(query):
+    """/debug/profile?seconds=N: sample the event loop for N seconds, collapsed stacks."""
+    return "text/plain", PROFILER.profile(float(query.get("seconds", "10")))
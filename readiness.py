@@ -0,0 +1,273 @@
+import asyncio
+import json
+import logging
+import os
+from datetime import datetime
+from kubernetes_asyncio import client
+from kube_client import get_api_client
+from metrics import TIME_TO_READY, TIME_TO_READY_PHASE, ENVIRONMENTS_NOT_READY
+from resource_cache import MANAGED_SELECTOR, WATCH_TIMEOUT_SECONDS, WATCH_RETRY_SECONDS
+
+logger = logging.getLogger(__name__)
+
+READY_POLL_SECONDS = float(os.environ.get("READY_POLL_SECONDS", "2")) # how often a new preview's pods and certificate are checked while the watches are down
+READY_POLL_FULL_RATE = 50 # previews polled every READY_POLL_SECONDS; beyond this the poll slows down in proportion
+READY_RESYNC_SECONDS = 60 # with the watches up, a preview is still re-checked this often in case an event was missed
+READY_TIMEOUT_SECONDS = float(os.environ.get("READY_TIMEOUT_SECONDS", "900")) # stop waiting for a preview to become ready after this long
+
+
+def _condition_time(conditions, condition_type):
+    for condition in conditions or []:
+        if condition.type == condition_type and condition.status == "True":
+            return condition.last_transition_time
+    return None
+
+
+def pod_milestones(pod):
+    """Scheduled, container-started and ready timestamps of a ready pod, else None.
+
+    Timestamps come from the scheduler and kubelet, so the phase split does
+    not depend on how often the tracker polls.
+    """
+    status = pod.status
+    if status is None:
+        return None
+    ready = _condition_time(status.conditions, "Ready")
+    scheduled = _condition_time(status.conditions, "PodScheduled")
+    running = (status.container_statuses or [None])[0]
+    started = running.state.running.started_at if running and running.state and running.state.running else None
+    if ready is None or scheduled is None or started is None:
+        return None
+    return {"scheduled": scheduled, "started": started, "ready": ready}
+
+
+def certificate_ready_at(certificate):
+    for condition in certificate.get("status", {}).get("conditions") or []:
+        if condition.get("type") == "Ready" and condition.get("status") == "True":
+            return datetime.fromisoformat(condition["lastTransitionTime"].replace('Z', '+00:00'))
+    return None
+
+
+def phase_durations(created_at, pod, tls_ready):
+    """Split time-to-ready into scheduling, image pull, probe and TLS phases (seconds)."""
+    return {
+        "scheduling": (pod["scheduled"] - created_at).total_seconds(),
+        "image_pull": (pod["started"] - pod["scheduled"]).total_seconds(),
+        "probe": (pod["ready"] - pod["started"]).total_seconds(),
+        "tls": (tls_ready - created_at).total_seconds(),
+    }
+
+
+async def ready_pod(pr_namespace, deployment_name):
+    core_v1 = client.CoreV1Api(get_api_client())
+    pods = await core_v1.list_namespaced_pod(pr_namespace, label_selector=f"app={deployment_name}")
+    milestones = [pod_milestones(pod) for pod in pods.items]
+    return min((m for m in milestones if m), key=lambda m: m["ready"], default=None)
+
+async def certificate_ready(pr_namespace, certificate_name):
+    custom_api = client.CustomObjectsApi(get_api_client())
+    try:
+        certificate = await custom_api.get_namespaced_custom_object(
+            group="cert-manager.io",
+            version="v1",
+            namespace=pr_namespace,
+            plural="certificates",
+            name=certificate_name,
+        )
+    except client.exceptions.ApiException as e:
+        if e.status == 404:  # ingress-shim has not created it yet
+            return None
+        raise
+    return certificate_ready_at(certificate)
+
+async def watch_pods(**kwargs):
+    core_v1 = client.CoreV1Api(get_api_client())
+    return await core_v1.list_pod_for_all_namespaces(label_selector=MANAGED_SELECTOR, watch=True, _preload_content=False, **kwargs)
+
+async def watch_certificates(**kwargs):
+    # ingress-shim does not label the Certificates it creates, and there are few of them
+    custom_api = client.CustomObjectsApi(get_api_client())
+    return await custom_api.list_cluster_custom_object(
+        "cert-manager.io", "v1", "certificates", watch=True, _preload_content=False, **kwargs
+    )
+
+WATCHES = {"pods": watch_pods, "certificates": watch_certificates}
+
+async def patch_environment_status(namespace, name, status):
+    """Merge `status` into a PreviewEnvironment's status."""
+    custom_api = client.CustomObjectsApi(get_api_client())
+    body = {"status": status}
+    kwargs = dict(group="devops.orima.com", version="v1", namespace=namespace, plural="previewenvironments", name=name, body=body)
+    try:
+        await custom_api.patch_namespaced_custom_object_status(**kwargs)
+    except client.exceptions.ApiException as e:
+        if e.status != 404:
+            raise
+        # CRD without a status subresource: status is part of the main object
+        await custom_api.patch_namespaced_custom_object(**kwargs)
+
+async def report_ready(namespace, name, ready_at):
+    """Write ready/readyAt into the PreviewEnvironment's status."""
+    await patch_environment_status(namespace, name, {"ready": True, "readyAt": ready_at.strftime("%Y-%m-%dT%H:%M:%SZ")})
+
+
+class ReadinessTracker:
+    """Follows new previews in the background until they are actually usable.
+
+    A preview is ready once a pod of its Deployment passes its readiness
+    probe and its cert-manager Certificate is issued. The handler that
+    calls track() returns immediately; the tracker then records the
+    time-to-ready phases and writes ready/readyAt into the CR status.
+
+    After start(), one pod watch and one Certificate watch are shared by
+    every tracked preview: an event in a preview's namespace wakes it to
+    check again, so an idle preview sends no requests. Until the watches
+    are up, and whenever one fails, previews fall back to polling, which
+    slows down as more of them are tracked.
+    """
+
+    def __init__(self, poll_interval=READY_POLL_SECONDS, timeout=READY_TIMEOUT_SECONDS,
+                 resync_interval=READY_RESYNC_SECONDS, watches=WATCHES):
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.resync_interval = resync_interval
+        self._watches = watches
+        self._tasks = {}
+        self._wakeups = {}  # namespace -> {key: event set when something in the namespace changed}
+        self._watching = set()  # watches currently streaming
+        self._watch_tasks = []
+        ENVIRONMENTS_NOT_READY.set_function(lambda: len(self._tasks))
+
+    def tracking(self, key):
+        return key in self._tasks
+
+    def track(self, key, pr_namespace, deployment_name, certificate_name, created_at, certificate_namespace=None):
+        """Start following the CR at `key` ((namespace, name)) created at `created_at`.
+
+        The Certificate is looked up in `certificate_namespace`, which defaults to the PR's namespace.
+        """
+        if key in self._tasks:
+            return
+        self._tasks[key] = asyncio.create_task(
+            self._follow(key, pr_namespace, deployment_name, (certificate_namespace or pr_namespace, certificate_name), created_at)
+        )
+
+    def cancel(self, key):
+        task = self._tasks.pop(key, None)
+        if task is not None:
+            task.cancel()
+
+    def check_interval(self):
+        if self._watches and self._watching == set(self._watches):
+            return self.resync_interval
+        return self.poll_interval * max(1.0, len(self._tasks) / READY_POLL_FULL_RATE)
+
+    async def _follow(self, key, pr_namespace, deployment_name, certificate, created_at):
+        try:
+            pod, tls_ready = await asyncio.wait_for(
+                self._wait_ready(key, pr_namespace, deployment_name, certificate), self.timeout
+            )
+            ready_at = max(pod["ready"], tls_ready)
+            for phase, seconds in phase_durations(created_at, pod, tls_ready).items():
+                TIME_TO_READY_PHASE.labels(phase=phase).observe(max(0.0, seconds))
+            TIME_TO_READY.observe(max(0.0, (ready_at - created_at).total_seconds()))
+            await report_ready(*key, ready_at)
+            logger.info(f"{key[1]} ready after {(ready_at - created_at).total_seconds():.0f}s")
+        except asyncio.TimeoutError:
+            logger.warning(f"{key[1]} not ready after {self.timeout:.0f}s, giving up")
+        except client.exceptions.ApiException as e:
+            logger.error(f"Failed to record readiness of {key[1]}: {e}")
+        finally:
+            if self._tasks.get(key) is asyncio.current_task():
+                del self._tasks[key]
+
+    async def _wait_ready(self, key, pr_namespace, deployment_name, certificate):
+        changed = asyncio.Event()
+        namespaces = {pr_namespace, certificate[0]}
+        for namespace in namespaces:
+            self._wakeups.setdefault(namespace, {})[key] = changed
+        try:
+            pod = tls_ready = None
+            while True:
+                changed.clear()
+                try:
+                    if pod is None:
+                        pod = await ready_pod(pr_namespace, deployment_name)
+                    if tls_ready is None:
+                        tls_ready = await certificate_ready(*certificate)
+                except Exception as e:
+                    logger.warning(f"Readiness check in {pr_namespace} failed: {e}")
+                if pod is not None and tls_ready is not None:
+                    return pod, tls_ready
+                try:
+                    await asyncio.wait_for(changed.wait(), self.check_interval())
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            for namespace in namespaces:
+                waiters = self._wakeups.get(namespace, {})
+                waiters.pop(key, None)
+                if not waiters:
+                    self._wakeups.pop(namespace, None)
+
+    def _wake(self, namespace):
+        for changed in self._wakeups.get(namespace, {}).values():
+            changed.set()
+
+    def _wake_all(self):
+        for waiters in self._wakeups.values():
+            for changed in waiters.values():
+                changed.set()
+
+    async def _watch(self, kind, open_watch):
+        resource_version = None
+        while True:
+            try:
+                response = await open_watch(
+                    resource_version=resource_version, allow_watch_bookmarks=True, timeout_seconds=WATCH_TIMEOUT_SECONDS
+                )
+                if kind not in self._watching:
+                    self._watching.add(kind)
+                    # Whatever changed while the watch was down has not been seen
+                    self._wake_all()
+                async with response:
+                    async for line in response.content:
+                        if not line.strip():
+                            continue
+                        event = json.loads(line)
+                        if event["type"] == "ERROR":
+                            status = event["object"]
+                            raise client.exceptions.ApiException(status=status.get("code"), reason=status.get("message"))
+                        resource_version = event["object"]["metadata"]["resourceVersion"]
+                        if event["type"] != "BOOKMARK":
+                            self._wake(event["object"]["metadata"].get("namespace"))
+            except asyncio.CancelledError:
+                raise
+            except client.exceptions.ApiException as e:
+                self._watching.discard(kind)
+                if e.status == 410:
+                    resource_version = None
+                else:
+                    logger.warning(f"Readiness watch on {kind} failed: {e}")
+                    await asyncio.sleep(WATCH_RETRY_SECONDS)
+            except Exception as e:
+                self._watching.discard(kind)
+                logger.warning(f"Readiness watch on {kind} failed: {e}")
+                await asyncio.sleep(WATCH_RETRY_SECONDS)
+
+    def start(self):
+        if not self._watch_tasks:
+            self._watch_tasks = [asyncio.create_task(self._watch(kind, open_watch)) for kind, open_watch in self._watches.items()]
+
+    async def stop(self):
+        for task in self._watch_tasks:
+            task.cancel()
+        await asyncio.gather(*self._watch_tasks, return_exceptions=True)
+        self._watch_tasks = []
+        self._watching.clear()
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks.clear()
+
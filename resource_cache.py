@@ -0,0 +1,207 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import OrderedDict, namedtuple
+from kubernetes_asyncio import client
+from kube_client import get_api_client
+from metrics import CACHE_LOOKUPS, CACHE_STALENESS, CACHE_ENTRIES
+
+logger = logging.getLogger(__name__)
+
+CACHE_MAX_ENTRIES = int(os.environ.get("CACHE_MAX_ENTRIES", "20000")) # per kind; least recently used entries are evicted beyond this
+WATCH_TIMEOUT_SECONDS = 300 # server-side timeout of each watch request before it is re-opened
+WATCH_RETRY_SECONDS = 5 # back-off before relisting after a watch error
+MANAGED_SELECTOR = "managed-by=preview-operator"
+ANNOTATION_PREFIX = "devops.orima.com/"
+
+# kind -> (API class, cluster-wide list method); looked up on `client` at call time
+WATCHED_KINDS = {
+    "namespace": ("CoreV1Api", "list_namespace"),
+    "deployment": ("AppsV1Api", "list_deployment_for_all_namespaces"),
+    "service": ("CoreV1Api", "list_service_for_all_namespaces"),
+    "ingress": ("NetworkingV1Api", "list_ingress_for_all_namespaces"),
+    "network_policy": ("NetworkingV1Api", "list_network_policy_for_all_namespaces"),
+}
+
+# Only what handlers need is kept per object, so memory stays small with thousands of PRs
+CacheEntry = namedtuple("CacheEntry", ["resource_version", "pr_number", "phase", "annotations", "image", "replicas"])
+
+
+def summarize(obj):
+    metadata = obj.get("metadata", {})
+    annotations = {
+        key: value for key, value in (metadata.get("annotations") or {}).items()
+        if key.startswith(ANNOTATION_PREFIX)
+    }
+    containers = obj.get("spec", {}).get("template", {}).get("spec", {}).get("containers") or [{}]
+    return CacheEntry(
+        resource_version=metadata.get("resourceVersion"),
+        pr_number=(metadata.get("labels") or {}).get("pr-number"),
+        phase=obj.get("status", {}).get("phase"),
+        annotations=annotations,
+        image=containers[0].get("image"),
+        replicas=obj.get("spec", {}).get("replicas"),
+    )
+
+
+class ResourceCache:
+    """Informer-style cache of the namespaces and workloads the operator manages.
+
+    Each kind is LISTed once and then kept current by a watch with
+    bookmarks, relisting when the watch expires (410) or errors. Lookups
+    are answered from memory; a kind that is not synced yet, or has had
+    entries evicted by the size cap, cannot prove an object is absent and
+    reports a miss so the caller falls back to the API.
+    """
+
+    def __init__(self, kinds=WATCHED_KINDS, max_entries=CACHE_MAX_ENTRIES):
+        self._kinds = kinds
+        self._max_entries = max_entries
+        self._stores = {kind: OrderedDict() for kind in kinds}
+        self._complete = {kind: False for kind in kinds}
+        self._synced = {kind: asyncio.Event() for kind in kinds}
+        self._last_event = {kind: None for kind in kinds}
+        self._listeners = []
+        self._tasks = []
+        for kind in kinds:
+            CACHE_STALENESS.labels(kind=kind).set_function(lambda kind=kind: self.staleness(kind))
+            CACHE_ENTRIES.labels(kind=kind).set_function(lambda kind=kind: len(self._stores[kind]))
+
+    def staleness(self, kind):
+        last_event = self._last_event[kind]
+        return 0.0 if last_event is None else time.monotonic() - last_event
+
+    def subscribe(self, callback):
+        """Call `callback(kind, event_type, key, entry)` for every applied watch event."""
+        self._listeners.append(callback)
+
+    def get(self, kind, name, namespace=None):
+        """Return the cached entry, or None if the object is not cached."""
+        key = (namespace, name)
+        store = self._stores[kind]
+        entry = store.get(key)
+        if entry is not None:
+            store.move_to_end(key)
+            CACHE_LOOKUPS.labels(kind=kind, result="hit").inc()
+        elif self._complete[kind]:
+            CACHE_LOOKUPS.labels(kind=kind, result="hit").inc()
+        else:
+            CACHE_LOOKUPS.labels(kind=kind, result="miss").inc()
+        return entry
+
+    def exists(self, kind, name, namespace=None):
+        """True/False when the cache knows, None when the caller has to ask the API."""
+        if self.get(kind, name, namespace) is not None:
+            return True
+        return False if self._complete[kind] else None
+
+    def watches(self, kind):
+        return kind in self._stores
+
+    def is_complete(self, kind):
+        return self._complete[kind]
+
+    def items(self, kind):
+        return list(self._stores[kind].items())
+
+    def replace(self, kind, objects):
+        store = OrderedDict()
+        for obj in objects:
+            metadata = obj["metadata"]
+            store[(metadata.get("namespace"), metadata["name"])] = summarize(obj)
+        while len(store) > self._max_entries:
+            store.popitem(last=False)
+        self._stores[kind] = store
+        self._complete[kind] = len(objects) <= self._max_entries
+        self._last_event[kind] = time.monotonic()
+        self._synced[kind].set()
+
+    def apply_event(self, kind, event_type, obj):
+        self._last_event[kind] = time.monotonic()
+        if event_type == "BOOKMARK":
+            return
+        metadata = obj["metadata"]
+        key = (metadata.get("namespace"), metadata["name"])
+        store = self._stores[kind]
+        if event_type == "DELETED":
+            entry = store.pop(key, None)
+        else:
+            entry = summarize(obj)
+            store[key] = entry
+            store.move_to_end(key)
+            if len(store) > self._max_entries:
+                store.popitem(last=False)
+                self._complete[kind] = False
+        for callback in self._listeners:
+            callback(kind, event_type, key, entry)
+
+    async def _request(self, kind, **kwargs):
+        api_name, method_name = self._kinds[kind]
+        api = getattr(client, api_name)(get_api_client())
+        return await getattr(api, method_name)(label_selector=MANAGED_SELECTOR, _preload_content=False, **kwargs)
+
+    async def _list(self, kind):
+        # Raw JSON rather than OpenAPI models: the cache only keeps summaries
+        objects, token = [], None
+        while True:
+            response = await self._request(kind, limit=500, _continue=token)
+            page = json.loads(await response.read())
+            objects.extend(page["items"])
+            token = page["metadata"].get("continue")
+            if not token:
+                return objects, page["metadata"]["resourceVersion"]
+
+    async def _watch(self, kind, resource_version):
+        while True:
+            response = await self._request(
+                kind,
+                watch=True,
+                resource_version=resource_version,
+                allow_watch_bookmarks=True,
+                timeout_seconds=WATCH_TIMEOUT_SECONDS,
+            )
+            async with response:
+                async for line in response.content:
+                    if not line.strip():
+                        continue
+                    event = json.loads(line)
+                    if event["type"] == "ERROR":
+                        status = event["object"]
+                        raise client.exceptions.ApiException(status=status.get("code"), reason=status.get("message"))
+                    resource_version = event["object"]["metadata"]["resourceVersion"]
+                    self.apply_event(kind, event["type"], event["object"])
+
+    async def _run(self, kind):
+        while True:
+            try:
+                objects, resource_version = await self._list(kind)
+                self.replace(kind, objects)
+                logger.info(f"Cache synced {len(objects)} {kind} objects")
+                await self._watch(kind, resource_version)
+            except asyncio.CancelledError:
+                raise
+            except client.exceptions.ApiException as e:
+                if e.status != 410:
+                    logger.warning(f"Watch on {kind} failed: {e}")
+                    await asyncio.sleep(WATCH_RETRY_SECONDS)
+            except Exception as e:
+                logger.warning(f"Watch on {kind} failed: {e}")
+                await asyncio.sleep(WATCH_RETRY_SECONDS)
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._run(kind)) for kind in self._kinds]
+
+    async def wait_synced(self, kinds=None, timeout=None):
+        await asyncio.wait_for(
+            asyncio.gather(*(self._synced[kind].wait() for kind in (kinds or self._kinds))),
+            timeout
+        )
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
@@ -0,0 +1,93 @@
+import asyncio
+import logging
+import os
+from metrics import SHARED_ROUTES, ROUTE_TABLE_WRITES
+
+logger = logging.getLogger(__name__)
+
+SHARED_INGRESS_ENABLED = os.environ.get("SHARED_INGRESS_ENABLED", "false").lower() == "true" # route every preview through one Ingress and a wildcard certificate
+ROUTER_NAMESPACE = os.environ.get("ROUTER_NAMESPACE", "preview-router") # holds the shared Ingress, wildcard certificate and per-PR route aliases
+WILDCARD_TLS_SECRET = os.environ.get("WILDCARD_TLS_SECRET", "preview-wildcard-tls") # secret the wildcard certificate is issued into
+ROUTE_FLUSH_SECONDS = float(os.environ.get("ROUTE_FLUSH_SECONDS", "2")) # route changes within this window go out as one Ingress write
+
+
+class RouteTable:
+    """In-memory host -> Service routing table behind one shared Ingress.
+
+    add() and remove() only touch memory. A change schedules one write of
+    the whole table `flush_interval` seconds later, so a burst of new PRs
+    costs one Ingress write (and one ingress controller reload) rather
+    than one per PR. Nothing is written before start(), which lets the
+    table be seeded from the existing CRs first; writing a partial table
+    would drop the routes of every PR not yet seen. A failed write is
+    retried after another interval.
+    """
+
+    def __init__(self, apply, flush_interval=ROUTE_FLUSH_SECONDS, enabled=SHARED_INGRESS_ENABLED):
+        self._apply = apply
+        self.flush_interval = flush_interval
+        self.enabled = enabled
+        self._routes = {}
+        self._dirty = False
+        self._started = False
+        self._task = None
+        SHARED_ROUTES.set_function(lambda: len(self._routes))
+
+    def routes(self):
+        return dict(self._routes)
+
+    def add(self, host, service_name):
+        if self._routes.get(host) != service_name:
+            self._routes[host] = service_name
+            self._changed()
+
+    def remove(self, host):
+        if self._routes.pop(host, None) is not None:
+            self._changed()
+
+    def _changed(self):
+        self._dirty = True
+        if self._started and self._task is None:
+            self._task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        try:
+            while self._dirty:
+                await asyncio.sleep(self.flush_interval)
+                await self.flush()
+        finally:
+            self._task = None
+
+    async def flush(self):
+        """Write the table now if it changed since the last write."""
+        if not self._dirty:
+            return
+        self._dirty = False
+        routes = dict(self._routes)
+        try:
+            await self._apply(routes)
+        except Exception as e:
+            self._dirty = True
+            logger.warning(f"Writing {len(routes)} routes failed, retrying: {e}")
+            return
+        ROUTE_TABLE_WRITES.inc()
+        logger.info(f"Shared ingress now routes {len(routes)} previews")
+
+    def start(self):
+        if self.enabled and not self._started:
+            self._started = True
+            self._dirty = True  # always write the seeded table once
+            self._task = asyncio.create_task(self._flush_later())
+
+    async def stop(self):
+        """Stop the background writer and write any pending change."""
+        started, self._started = self._started, False
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if started:
+            await self.flush()
@@ -0,0 +1,225 @@
+import asyncio
+import logging
+import os
+import time
+import aiohttp
+from aiohttp import web
+from kubernetes_asyncio import client
+from prometheus_client.parser import text_string_to_metric_families
+from kube_client import get_api_client
+from metrics import SCALED_TO_ZERO, SCALE_EVENTS, ACTIVATOR_WAIT
+
+logger = logging.getLogger(__name__)
+
+SCALE_TO_ZERO_IDLE_SECONDS = float(os.environ.get("SCALE_TO_ZERO_IDLE_SECONDS", "0")) # scale a preview to zero after this long without traffic; 0 disables
+IDLE_CHECK_INTERVAL_SECONDS = float(os.environ.get("IDLE_CHECK_INTERVAL_SECONDS", "60")) # how often traffic counters are sampled
+NGINX_METRICS_URL = os.environ.get("NGINX_METRICS_URL", "http://ingress-nginx-controller-metrics.ingress-nginx.svc:10254/metrics")
+ACTIVATOR_PORT = int(os.environ.get("ACTIVATOR_PORT", "8080")) # port the activator listens on
+ACTIVATOR_SERVICE_HOST = os.environ.get("ACTIVATOR_SERVICE_HOST", "preview-operator-activator.preview-operator.svc.cluster.local")
+ACTIVATOR_TIMEOUT_SECONDS = float(os.environ.get("ACTIVATOR_TIMEOUT_SECONDS", "120")) # max time a request is held while its preview wakes
+READY_POLL_SECONDS = 0.5
+
+
+class NginxTrafficSource:
+    """Per-host request counters scraped from the ingress-nginx controller's /metrics."""
+
+    def __init__(self, url=NGINX_METRICS_URL):
+        self.url = url
+
+    async def requests_by_host(self):
+        async with aiohttp.ClientSession() as session:
+            async with session.get(self.url) as response:
+                text = await response.text()
+        counts = {}
+        for family in text_string_to_metric_families(text):
+            if family.name != "nginx_ingress_controller_requests":
+                continue
+            for sample in family.samples:
+                host = sample.labels.get("host")
+                if host:
+                    counts[host] = counts.get(host, 0) + sample.value
+        return counts
+
+
+async def scale_deployment(namespace, name, replicas):
+    apps_v1 = client.AppsV1Api(get_api_client())
+    await apps_v1.patch_namespaced_deployment_scale(name, namespace, {"spec": {"replicas": replicas}})
+
+async def ready_replicas(namespace, name):
+    apps_v1 = client.AppsV1Api(get_api_client())
+    deployment = await apps_v1.read_namespaced_deployment(name, namespace)
+    return (deployment.status.ready_replicas or 0) if deployment.status else 0
+
+
+class IdleController:
+    """Scales idle previews to zero and wakes them on demand.
+
+    Environments are tracked by host. Every `interval` seconds the
+    traffic source is sampled; a host whose request counter has not moved
+    for `idle_after` seconds has its Deployment scaled to zero. wake() is
+    called by the activator when a request reaches a sleeping preview: it
+    scales the Deployment back up and waits until a replica is ready.
+    Concurrent wakes of the same preview share one scale-up. `replicas`
+    looks up a Deployment's replica count without an API call (None if
+    unknown), so a preview scaled down before a restart is still known
+    to be asleep.
+    """
+
+    def __init__(self, traffic, idle_after=SCALE_TO_ZERO_IDLE_SECONDS, interval=IDLE_CHECK_INTERVAL_SECONDS,
+                 replicas=lambda namespace, deployment: None):
+        self._traffic = traffic
+        self._replicas = replicas
+        self.idle_after = idle_after
+        self.interval = interval
+        self._environments = {}  # host -> (namespace, deployment)
+        self._by_namespace = {}  # namespace -> host
+        self._last_count = {}
+        self._last_active = {}
+        self._sleeping = set()
+        self._wakes = {}
+        self._task = None
+
+    @property
+    def enabled(self):
+        return self.idle_after > 0
+
+    def track(self, host, namespace, deployment, awake=False):
+        """Follow `host`'s traffic. Pass `awake=True` when its Deployment was just applied."""
+        self._environments[host] = (namespace, deployment)
+        self._by_namespace[namespace] = host
+        self._last_active[host] = time.monotonic()
+        if awake:
+            # Applying the Deployment sets replicas=1, so the preview is awake again
+            self._sleeping.discard(host)
+            SCALED_TO_ZERO.set(len(self._sleeping))
+
+    def untrack(self, host):
+        namespace, _ = self._environments.pop(host, (None, None))
+        self._by_namespace.pop(namespace, None)
+        self._last_count.pop(host, None)
+        self._last_active.pop(host, None)
+        self._sleeping.discard(host)
+        SCALED_TO_ZERO.set(len(self._sleeping))
+
+    def is_sleeping(self, host):
+        return host in self._sleeping
+
+    def host_for(self, namespace):
+        return self._by_namespace.get(namespace)
+
+    def asleep(self, host):
+        """Whether a request to `host` should wake it: scaled to zero, or waking up right now."""
+        if host in self._sleeping or host in self._wakes:
+            return True
+        namespace, deployment = self._environments[host]
+        return self._replicas(namespace, deployment) == 0
+
+    async def check(self):
+        """Sample traffic once and scale down every preview idle for too long."""
+        counts = await self._traffic.requests_by_host()
+        now = time.monotonic()
+        for host, (namespace, deployment) in list(self._environments.items()):
+            count = counts.get(host, 0)
+            if count != self._last_count.get(host):
+                self._last_count[host] = count
+                self._last_active[host] = now
+                continue
+            if host in self._sleeping or now - self._last_active[host] < self.idle_after:
+                continue
+            try:
+                await scale_deployment(namespace, deployment, 0)
+            except client.exceptions.ApiException as e:
+                logger.error(f"Failed to scale {namespace}/{deployment} to zero: {e}")
+                continue
+            self._sleeping.add(host)
+            SCALE_EVENTS.labels(direction="down").inc()
+            logger.info(f"Scaled idle preview {host} to zero")
+        SCALED_TO_ZERO.set(len(self._sleeping))
+
+    async def wake(self, namespace):
+        """Scale the preview in `namespace` back up and wait for it to be ready. Returns its host."""
+        host = self._by_namespace.get(namespace)
+        if host is None:
+            raise KeyError(namespace)
+        if host not in self._wakes:
+            self._wakes[host] = asyncio.ensure_future(self._wake(host))
+        await asyncio.shield(self._wakes[host])
+        return host
+
+    async def _wake(self, host):
+        namespace, deployment = self._environments[host]
+        started = time.monotonic()
+        try:
+            await scale_deployment(namespace, deployment, 1)
+            SCALE_EVENTS.labels(direction="up").inc()
+            self._sleeping.discard(host)
+            SCALED_TO_ZERO.set(len(self._sleeping))
+            while await ready_replicas(namespace, deployment) < 1:
+                if time.monotonic() - started > ACTIVATOR_TIMEOUT_SECONDS:
+                    raise asyncio.TimeoutError(f"{host} did not become ready")
+                await asyncio.sleep(READY_POLL_SECONDS)
+            self._last_active[host] = time.monotonic()
+            ACTIVATOR_WAIT.observe(time.monotonic() - started)
+            logger.info(f"Woke preview {host} in {time.monotonic() - started:.1f}s")
+        finally:
+            self._wakes.pop(host, None)
+
+    async def run(self):
+        while True:
+            try:
+                await self.check()
+            except Exception as e:
+                logger.warning(f"Idle check failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self.run())
+            logger.info(f"Idle controller started (idle_after={self.idle_after}s)")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+def activator_app(controller, timeout=ACTIVATOR_TIMEOUT_SECONDS):
+    """HTTP app that ingress-nginx falls back to (custom-http-errors 503) while a preview has no ready pods.
+
+    ingress-nginx passes the original namespace and URI as X-Namespace and
+    X-Original-URI. The request is held until the preview is ready and
+    then redirected to the original URL, which now reaches the app. A 503
+    from a preview that is awake came from the app itself and is passed
+    back as is; redirecting it would loop and scale nothing.
+    """
+    async def activate(request):
+        namespace = request.headers.get("X-Namespace")
+        host = controller.host_for(namespace)
+        if host is None:
+            return web.Response(status=404, text="Unknown preview environment")
+        if not controller.asleep(host):
+            return web.Response(status=503, text="Service Unavailable")
+        try:
+            host = await asyncio.wait_for(controller.wake(namespace), timeout)
+        except KeyError:
+            return web.Response(status=404, text="Unknown preview environment")
+        except asyncio.TimeoutError:
+            return web.Response(status=503, headers={"Retry-After": "5"}, text="Preview is still starting")
+        original_uri = request.headers.get("X-Original-URI", "/")
+        raise web.HTTPTemporaryRedirect(f"https://{host}{original_uri}")
+
+    app = web.Application()
+    app.router.add_route("*", "/{tail:.*}", activate)
+    return app
+
+
+async def start_activator(controller, port=ACTIVATOR_PORT):
+    runner = web.AppRunner(activator_app(controller))
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", port).start()
+    logger.info(f"Activator listening on :{port}")
+    return runner
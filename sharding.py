@@ -0,0 +1,230 @@
+import asyncio
+import functools
+import hashlib
+import logging
+import os
+import socket
+import time
+import kopf
+from datetime import datetime, timezone
+from kubernetes_asyncio import client
+from kube_client import get_api_client
+from metrics import SHARD_MEMBERS, SHARD_REBALANCES, SHARD_EVENT_LAG
+
+logger = logging.getLogger(__name__)
+
+SHARDING_ENABLED = os.environ.get("SHARDING_ENABLED", "false").lower() == "true" # split PRs across operator replicas
+SHARD_IDENTITY = os.environ.get("POD_NAME") or socket.gethostname() # must be stable across restarts (StatefulSet pod name)
+OPERATOR_NAMESPACE = os.environ.get("OPERATOR_NAMESPACE", "preview-operator") # where the membership Leases live
+SHARD_LEASE_DURATION_SECONDS = int(os.environ.get("SHARD_LEASE_DURATION_SECONDS", "15")) # a replica that misses renewals this long leaves the ring
+SHARD_MEMBER_SELECTOR = "managed-by=preview-operator,preview-shard-member=true"
+SHARD_LABEL = "preview-shard" # names the replica a per-replica object belongs to
+DIFFBASE_KEY = "last-handled-configuration" # kopf's annotation (under the replica's prefix) holding the last handled spec
+FIELD_MANAGER = "preview-operator"
+# handler event -> meta timestamp its lag is measured from
+LAG_TIMESTAMPS = {"create": "creationTimestamp", "delete": "deletionTimestamp"}
+
+
+def shard_owner(pr_number, members):
+    """Rendezvous hashing: the member with the highest hash for this PR owns it.
+
+    Adding or removing a member only moves the PRs that member gains or
+    loses; every other PR keeps its owner.
+    """
+    if not members:
+        return None
+    return max(members, key=lambda member: hashlib.sha256(f"{member}/{pr_number}".encode()).digest())
+
+
+class ShardCoordinator:
+    """Lease-based membership for splitting PRs across operator replicas.
+
+    Every replica keeps its own Lease in `namespace` renewed; the replicas
+    whose Lease is current form the ring and each PR is owned by
+    shard_owner(pr_number, members). When the ring changes,
+    `on_rebalance(old_members, new_members)` is awaited so the replica can
+    adopt the PRs it gained and drop the ones it lost. A replica that
+    cannot renew its own Lease for a full lease duration owns nothing,
+    so two replicas never act on the same PR for long.
+    With sharding disabled every PR is owned locally.
+    """
+
+    def __init__(self, identity=SHARD_IDENTITY, namespace=OPERATOR_NAMESPACE,
+                 lease_duration=SHARD_LEASE_DURATION_SECONDS, enabled=SHARDING_ENABLED, on_rebalance=None):
+        self.identity = identity
+        self.namespace = namespace
+        self.lease_duration = lease_duration
+        self.enabled = enabled
+        self.on_rebalance = on_rebalance
+        self.members = (identity,)
+        self.in_flight = 0
+        self._last_renewed = None
+        self._task = None
+
+    @property
+    def lease_name(self):
+        return f"preview-operator-shard-{self.identity}"
+
+    def owns(self, pr_number):
+        return not self.enabled or shard_owner(str(pr_number), self.members) == self.identity
+
+    def labels(self):
+        """Labels that tie per-replica objects (e.g. warm namespaces) to this shard."""
+        return {SHARD_LABEL: self.identity} if self.enabled else {}
+
+    async def heartbeat(self):
+        lease = client.V1Lease(
+            api_version="coordination.k8s.io/v1",
+            kind="Lease",
+            metadata=client.V1ObjectMeta(
+                name=self.lease_name,
+                labels={"managed-by": "preview-operator", "preview-shard-member": "true"}
+            ),
+            spec=client.V1LeaseSpec(
+                holder_identity=self.identity,
+                lease_duration_seconds=self.lease_duration,
+                renew_time=datetime.now(timezone.utc)
+            )
+        )
+        coordination_v1 = client.CoordinationV1Api(get_api_client())
+        await coordination_v1.patch_namespaced_lease(
+            name=self.lease_name,
+            namespace=self.namespace,
+            body=lease,
+            field_manager=FIELD_MANAGER,
+            force=True,
+            _content_type="application/apply-patch+yaml"
+        )
+        self._last_renewed = time.monotonic()
+
+    async def live_members(self):
+        coordination_v1 = client.CoordinationV1Api(get_api_client())
+        leases = await coordination_v1.list_namespaced_lease(self.namespace, label_selector=SHARD_MEMBER_SELECTOR)
+        now = datetime.now(timezone.utc)
+        members = {self.identity}
+        for lease in leases.items:
+            spec = lease.spec
+            if spec is None or spec.holder_identity is None or spec.renew_time is None:
+                continue
+            if (now - spec.renew_time).total_seconds() < (spec.lease_duration_seconds or self.lease_duration):
+                members.add(spec.holder_identity)
+        return tuple(sorted(members))
+
+    async def _set_members(self, members, rebalance=True):
+        if members == self.members:
+            return
+        old_members, self.members = self.members, members
+        SHARD_MEMBERS.set(len(members))
+        logger.info(f"Shard ring changed: {', '.join(members) or 'no members'}")
+        if rebalance and self.on_rebalance is not None:
+            SHARD_REBALANCES.inc()
+            await self.on_rebalance(old_members, members)
+
+    async def sync(self, rebalance=True):
+        await self.heartbeat()
+        await self._set_members(await self.live_members(), rebalance)
+
+    async def join(self):
+        """Register this replica and learn the ring, before anything is resumed."""
+        if self.enabled:
+            await self.sync(rebalance=False)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.lease_duration / 3)
+            try:
+                await self.sync()
+            except Exception as e:
+                logger.warning(f"Shard membership sync failed: {e}")
+                if self._last_renewed is None or time.monotonic() - self._last_renewed > self.lease_duration:
+                    # Our Lease has lapsed, so peers have taken over our PRs
+                    await self._set_members(())
+
+    def start(self):
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self.run())
+            logger.info(f"Shard coordinator started as {self.identity}")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.enabled:
+            # Leave the ring now instead of waiting for the Lease to expire
+            coordination_v1 = client.CoordinationV1Api(get_api_client())
+            try:
+                await coordination_v1.delete_namespaced_lease(self.lease_name, self.namespace)
+            except client.exceptions.ApiException as e:
+                if e.status != 404:
+                    logger.warning(f"Could not delete shard lease {self.lease_name}: {e}")
+
+    def tracked(self, event=None):
+        """Decorate a kopf handler: count it in `in_flight` and observe its lag for create/delete events."""
+        def decorator(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                timestamp = (kwargs.get('meta') or {}).get(LAG_TIMESTAMPS.get(event))
+                if timestamp:
+                    happened = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+                    lag = (datetime.now(timezone.utc) - happened).total_seconds()
+                    SHARD_EVENT_LAG.labels(event=event).observe(max(0.0, lag))
+                self.in_flight += 1
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    self.in_flight -= 1
+            return wrapper
+        return decorator
+
+
+def persistence_prefix(identity):
+    return f"{identity}.kopf.zalando.org"
+
+def finalizer_of(identity):
+    return f"{persistence_prefix(identity)}/KopfFinalizerMarker"
+
+def diffbase_annotation_of(identity):
+    return f"{persistence_prefix(identity)}/{DIFFBASE_KEY}"
+
+def configure_persistence(settings, identity=SHARD_IDENTITY):
+    """Give this replica its own kopf annotations and finalizer.
+
+    kopf records the last handled spec on the CR; with a shared key, a
+    replica that filters a CR out would mark the change as handled before
+    its owner sees it. Per-replica keys keep each replica's view separate,
+    so a PR's keys are moved to its new owner when it changes hands
+    (handover_patch).
+    """
+    prefix = persistence_prefix(identity)
+    settings.persistence.progress_storage = kopf.AnnotationsProgressStorage(prefix=prefix)
+    settings.persistence.diffbase_storage = kopf.AnnotationsDiffBaseStorage(prefix=prefix, key=DIFFBASE_KEY)
+    settings.persistence.finalizer = finalizer_of(identity)
+    # Replicas split the work, so they must not pause each other through kopf peering
+    settings.peering.standalone = True
+
+def handover_patch(metadata, previous, identity=SHARD_IDENTITY):
+    """Merge patch moving a CR's kopf finalizer and diff-base from replica `previous` to `identity`.
+
+    Without it the new owner has no diff-base and runs create_fn again,
+    and the CR's finalizer belongs to a replica that no longer handles its
+    deletion: deletes hang once that replica is gone, or go through without
+    delete_fn while it lives. None if `previous` left nothing to move.
+    """
+    annotations = metadata.get('annotations') or {}
+    finalizers = metadata.get('finalizers') or []
+    diffbase = annotations.get(diffbase_annotation_of(previous))
+    if diffbase is None and finalizer_of(previous) not in finalizers:
+        return None
+    moved = [finalizer_of(identity) if finalizer == finalizer_of(previous) else finalizer for finalizer in finalizers]
+    patch = {
+        # Fails with a conflict rather than overwrite a change made meanwhile
+        "resourceVersion": metadata.get('resourceVersion'),
+        "finalizers": list(dict.fromkeys(moved)),
+    }
+    if diffbase is not None:
+        patch["annotations"] = {diffbase_annotation_of(previous): None, diffbase_annotation_of(identity): diffbase}
+    return {"metadata": patch}
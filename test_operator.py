@@ -1,159 +1,1573 @@
+import asyncio
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
 import pytest
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, AsyncMock
 from datetime import datetime, timezone, timedelta
 import kopf
-from kubernetes import client
+from kubernetes_asyncio import client
+from prometheus_client import REGISTRY, Counter
 
 import custom_operator
+import metrics
+from ttl_scheduler import TTLScheduler
+from resource_cache import ResourceCache
+from update_coalescer import UpdateCoalescer
+from warm_pool import WarmPool
+from fake_apiserver import FakeApiServer
+from scale_to_zero import IdleController, activator_app
+from sharding import ShardCoordinator, shard_owner, configure_persistence, finalizer_of, diffbase_annotation_of
+from readiness import ReadinessTracker, phase_durations
+from api_governor import ApiGovernor, DELETE, CREATE, UPDATE
+from orphan_sweeper import OrphanSweeper
+from deletion_queue import DeletionQueue
+import route_table
+from route_table import RouteTable
+import tracing
+from profiler import SamplingProfiler
+from admission import AdmissionQueue, branch_priority, parse_priorities
+from image_prepull import ImagePrePuller, prepull_name, IMAGE_PREPULL_NAMESPACE
 
-@patch('custom_operator.client.AppsV1Api')
-def test_create_deployment(mock_apps_v1):
-    mock_api_instance = mock_apps_v1.return_value
-    deployment_name = "pr-142-app"
-    image = "orim2002/my-app"
-    tag = "v2.1"
-    namespace = "preview-pr-142"
-    custom_operator.create_deployment(deployment_name, image, tag, namespace)
-    mock_api_instance.create_namespaced_deployment.assert_called_once()
-    args, kwargs = mock_api_instance.create_namespaced_deployment.call_args
-    assert kwargs['namespace'] == "preview-pr-142"
-    created_deployment = kwargs['body']
-    assert created_deployment.metadata.name == "pr-142-app"
-    container = created_deployment.spec.template.spec.containers[0]
-    assert container.image == "orim2002/my-app:v2.1"
-    assert container.liveness_probe is not None
-    assert container.readiness_probe.http_get.path == "/"
-
-@patch('custom_operator.client.CoreV1Api')
-def test_create_service(mock_core_v1):
-    mock_api_instance = mock_core_v1.return_value
-    custom_operator.create_service("pr-142-svc", "pr-142-app", "preview-pr-142")
-    mock_api_instance.create_namespaced_service.assert_called_once()
-    _, kwargs = mock_api_instance.create_namespaced_service.call_args
-    created_service = kwargs['body']
-    assert created_service.metadata.name == "pr-142-svc"
-    assert created_service.spec.selector["app"] == "pr-142-app"
-    assert created_service.spec.ports[0].port == 80
-
-@patch('custom_operator.client.NetworkingV1Api')
-def test_create_ingress(mock_networking_v1):
-    mock_api_instance = mock_networking_v1.return_value
-    custom_operator.create_ingress("pr-142-ingress", "pr-142.preview.orimatest.com", "pr-142-svc", "preview-pr-142")
-    mock_api_instance.create_namespaced_ingress.assert_called_once()
-    _, kwargs = mock_api_instance.create_namespaced_ingress.call_args
-    assert kwargs['namespace'] == "preview-pr-142"
-    ingress = kwargs['body']
-    assert ingress.metadata.name == "pr-142-ingress"
-    assert ingress.metadata.annotations["cert-manager.io/cluster-issuer"] == "letsencrypt-issuer"
-    assert ingress.spec.ingress_class_name == "nginx"
-    assert ingress.spec.tls[0].hosts[0] == "pr-142.preview.orimatest.com"
-    assert ingress.spec.rules[0].host == "pr-142.preview.orimatest.com"
-    assert ingress.spec.rules[0].http.paths[0].backend.service.name == "pr-142-svc"
-
-@patch('custom_operator.client.CoreV1Api')
-@patch('custom_operator.create_network_policy')
-@patch('custom_operator.create_ingress')
-@patch('custom_operator.create_service')
-@patch('custom_operator.create_deployment')
-def test_create_fn_success(mock_create_deployment, mock_create_service, mock_create_ingress, mock_create_network_policy, mock_core_v1):
-    spec = {'pr_number': 142, 'branch_name': 'feature-x', 'image': 'orim2002/my-app', 'image_tag': 'v2.1'}
-    result = custom_operator.create_fn(spec=spec, name='test', namespace='preview-envs', logger=MagicMock())
-    mock_create_deployment.assert_called_once_with("pr-142-app", "orim2002/my-app", "v2.1", "preview-pr-142")
-    mock_create_service.assert_called_once_with("pr-142-svc", "pr-142-app", "preview-pr-142")
-    mock_create_ingress.assert_called_once_with("pr-142-ingress", "pr-142.preview.orimatest.com", "pr-142-svc", "preview-pr-142")
-    mock_create_network_policy.assert_called_once_with("pr-142-app", "preview-pr-142")
+@pytest.fixture(autouse=True)
+def shared_api_client():
+    # Handlers start background readiness tracking, which must not reach a real cluster either
+    with patch('custom_operator.get_api_client') as mock_get_api_client, \
+            patch('readiness.get_api_client', mock_get_api_client):
+        yield mock_get_api_client
+
+SPEC = {'pr_number': 142, 'branch_name': 'feature-x', 'image': 'orim2002/my-app', 'image_tag': 'v2.1'}
+META = {'creationTimestamp': '2024-01-01T00:00:00Z'}
+CREATED = {'create_fn': {'status': 'Environment Created', 'namespace': 'preview-pr-142'}}
+
+def test_render_deployment():
+    deployment = custom_operator.render_deployment("pr-142-app", "orim2002/my-app", "v2.1", 142)
+    assert deployment["metadata"]["name"] == "pr-142-app"
+    assert deployment["metadata"]["labels"] == {"managed-by": "preview-operator", "pr-number": "142"}
+    container = deployment["spec"]["template"]["spec"]["containers"][0]
+    assert container["image"] == "orim2002/my-app:v2.1"
+    assert container["livenessProbe"] is not None
+    assert container["readinessProbe"]["httpGet"]["path"] == "/"
+
+def test_render_service():
+    service = custom_operator.render_service("pr-142-svc", "pr-142-app", 142)
+    assert service["metadata"]["name"] == "pr-142-svc"
+    assert service["spec"]["selector"]["app"] == "pr-142-app"
+    assert service["spec"]["ports"][0]["port"] == 80
+
+def test_render_ingress():
+    ingress = custom_operator.render_ingress("pr-142-ingress", "pr-142.preview.orimatest.com", "pr-142-svc", 142)
+    assert ingress["metadata"]["name"] == "pr-142-ingress"
+    assert ingress["metadata"]["annotations"]["cert-manager.io/cluster-issuer"] == "letsencrypt-issuer"
+    assert ingress["spec"]["ingressClassName"] == "nginx"
+    assert ingress["spec"]["tls"][0]["hosts"][0] == "pr-142.preview.orimatest.com"
+    assert ingress["spec"]["rules"][0]["host"] == "pr-142.preview.orimatest.com"
+    assert ingress["spec"]["rules"][0]["http"]["paths"][0]["backend"]["service"]["name"] == "pr-142-svc"
+
+def test_render_bundle():
+    names, bundle = custom_operator.render_bundle(142, "orim2002/my-app", "v2.1")
+    assert list(bundle) == ["namespace", "deployment", "service", "ingress", "network_policy"]
+    assert bundle["namespace"]["metadata"]["name"] == "preview-pr-142"
+    assert names['url'] == 'https://pr-142.preview.orimatest.com'
+
+@patch('custom_operator.client.AppsV1Api', return_value=AsyncMock())
+def test_apply_object_uses_server_side_apply(mock_apps_v1):
+    body = custom_operator.render_deployment("pr-142-app", "orim2002/my-app", "v2.1", 142)
+    asyncio.run(custom_operator.apply_object("deployment", body, namespace="preview-pr-142"))
+    mock_apps_v1.return_value.patch_namespaced_deployment.assert_called_once_with(
+        name="pr-142-app",
+        namespace="preview-pr-142",
+        body=body,
+        field_manager="preview-operator",
+        force=True,
+        _content_type="application/apply-patch+yaml",
+    )
+
+@patch('custom_operator.client.NetworkingV1Api', return_value=AsyncMock())
+@patch('custom_operator.client.CoreV1Api', return_value=AsyncMock())
+@patch('custom_operator.client.AppsV1Api', return_value=AsyncMock())
+def test_create_fn_success(mock_apps_v1, mock_core_v1, mock_networking_v1):
+    result = asyncio.run(custom_operator.create_fn(spec=SPEC, name='test', namespace='preview-envs', meta=META, status={}, patch=kopf.Patch(), logger=MagicMock()))
+    assert mock_core_v1.return_value.patch_namespace.call_args.kwargs['name'] == "preview-pr-142"
+    assert mock_apps_v1.return_value.patch_namespaced_deployment.call_args.kwargs['namespace'] == "preview-pr-142"
+    mock_core_v1.return_value.patch_namespaced_service.assert_called_once()
+    mock_networking_v1.return_value.patch_namespaced_ingress.assert_called_once()
+    mock_networking_v1.return_value.patch_namespaced_network_policy.assert_called_once()
     assert result['status'] == 'Environment Created'
     assert result['url'] == 'https://pr-142.preview.orimatest.com'
     assert result['namespace'] == 'preview-pr-142'
 
+@patch('custom_operator.client.CoreV1Api', return_value=AsyncMock())
+@patch('custom_operator.client.NetworkingV1Api', return_value=AsyncMock())
+@patch('custom_operator.client.AppsV1Api', return_value=AsyncMock())
+def test_create_fn_step_failure_runs_other_steps(mock_apps_v1, mock_networking_v1, mock_core_v1):
+    mock_apps_v1.return_value.patch_namespaced_deployment.side_effect = client.exceptions.ApiException(status=500)
+    failed_before = custom_operator.ENVIRONMENTS_FAILED.labels(step="deployment")._value.get()
+    with pytest.raises(client.exceptions.ApiException):
+        asyncio.run(custom_operator.create_fn(spec=SPEC, name='test', namespace='preview-envs', meta=META, status={}, patch=kopf.Patch(), logger=MagicMock()))
+    mock_core_v1.return_value.patch_namespaced_service.assert_called_once()
+    mock_networking_v1.return_value.patch_namespaced_ingress.assert_called_once()
+    mock_networking_v1.return_value.patch_namespaced_network_policy.assert_called_once()
+    assert custom_operator.ENVIRONMENTS_FAILED.labels(step="deployment")._value.get() == failed_before + 1
+
+@patch('custom_operator.client.CoreV1Api', return_value=AsyncMock())
+@patch('custom_operator.client.NetworkingV1Api', return_value=AsyncMock())
+@patch('custom_operator.client.AppsV1Api', return_value=AsyncMock())
+def test_create_fn_retry_resumes_from_checkpoint(mock_apps_v1, mock_networking_v1, mock_core_v1):
+    mock_networking_v1.return_value.patch_namespaced_ingress.side_effect = client.exceptions.ApiException(status=500)
+    patch_ = kopf.Patch()
+    with pytest.raises(client.exceptions.ApiException):
+        asyncio.run(custom_operator.create_fn(spec=SPEC, name='test', namespace='preview-envs', meta=META, status={}, patch=patch_, logger=MagicMock()))
+    checkpoint = patch_.status['checkpoint']
+    assert checkpoint['namespace'] == 'preview-pr-142'
+    assert checkpoint['steps'] == ['deployment', 'namespace', 'network_policy', 'service']
+
+    for api in (mock_apps_v1, mock_networking_v1, mock_core_v1):
+        api.return_value.reset_mock()
+    mock_networking_v1.return_value.patch_namespaced_ingress.side_effect = None
+    patch_ = kopf.Patch()
+    asyncio.run(custom_operator.create_fn(spec=SPEC, name='test', namespace='preview-envs', meta=META, status={'checkpoint': checkpoint}, patch=patch_, logger=MagicMock()))
+    mock_networking_v1.return_value.patch_namespaced_ingress.assert_called_once()
+    mock_apps_v1.return_value.patch_namespaced_deployment.assert_not_called()
+    mock_core_v1.return_value.patch_namespaced_service.assert_not_called()
+    mock_core_v1.return_value.patch_namespace.assert_not_called()
+    assert patch_.status['checkpoint'] is None
+
+def test_load_checkpoint_ignores_other_spec():
+    checkpoint = {'spec': custom_operator.spec_digest(SPEC), 'namespace': 'preview-pr-142', 'steps': ['service']}
+    assert custom_operator.load_checkpoint({'checkpoint': checkpoint}, SPEC) == ('preview-pr-142', {'service'})
+    assert custom_operator.load_checkpoint({'checkpoint': checkpoint}, {**SPEC, 'image_tag': 'v9'}) == (None, set())
+
+def test_provision_steps_records_step_latency():
+    async def step():
+        return None
+    asyncio.run(custom_operator.provision_steps({"service": step()}))
+    samples = {s.name: s.value for s in custom_operator.PROVISION_STEP_DURATION.collect()[0].samples if s.labels.get('step') == 'service'}
+    assert samples['preview_environment_provision_step_duration_seconds_count'] >= 1
+
 def test_create_fn_missing_fields():
     spec = {'pr_number': 142, 'branch_name': 'feature-x'}  # missing image and image_tag
     with pytest.raises(kopf.PermanentError):
-        custom_operator.create_fn(spec=spec, name='test', namespace='preview-envs', logger=MagicMock())
+        asyncio.run(custom_operator.create_fn(spec=spec, name='test', namespace='preview-envs', meta=META, status={}, patch=kopf.Patch(), logger=MagicMock()))
 
-@patch('custom_operator.client.AppsV1Api')
-def test_update_fn(mock_apps_v1):
-    mock_api_instance = mock_apps_v1.return_value
+@patch.object(custom_operator.UPDATE_COALESCER, 'quiet_window', 0)
+@patch('custom_operator.apply_object')
+def test_update_fn(mock_apply_object):
     spec = {'pr_number': 142, 'image': 'orim2002/my-app', 'image_tag': 'v2.2'}
-    custom_operator.update_fn(spec=spec, name='test', namespace='preview-envs', logger=MagicMock())
-    mock_api_instance.patch_namespaced_deployment.assert_called_once()
-    _, kwargs = mock_api_instance.patch_namespaced_deployment.call_args
-    assert kwargs['name'] == "pr-142-app"
-    assert kwargs['namespace'] == "preview-pr-142"
-    assert kwargs['body']['spec']['template']['spec']['containers'][0]['image'] == "orim2002/my-app:v2.2"
+    asyncio.run(custom_operator.update_fn(spec=spec, name='test', namespace='preview-envs', status={}, meta=META, logger=MagicMock()))
+    applied = {call.args[0]: call for call in mock_apply_object.call_args_list}
+    assert set(applied) == {"namespace", "deployment", "service", "ingress", "network_policy"}
+    deployment_call = applied["deployment"]
+    assert deployment_call.kwargs['namespace'] == "preview-pr-142"
+    assert deployment_call.args[1]["spec"]["template"]["spec"]["containers"][0]["image"] == "orim2002/my-app:v2.2"
 
 def test_update_fn_missing_fields():
     spec = {'pr_number': 142}  # missing image and image_tag
     with pytest.raises(kopf.PermanentError):
-        custom_operator.update_fn(spec=spec, name='test', namespace='preview-envs', logger=MagicMock())
+        asyncio.run(custom_operator.update_fn(spec=spec, name='test', namespace='preview-envs', status={}, meta=META, logger=MagicMock()))
+
+def _applied_cache(spec):
+    """A synced cache holding the objects `spec` renders to, as if they had been applied."""
+    cache = ResourceCache(kinds={kind: None for kind in ("namespace", "deployment", "service", "ingress", "network_policy")})
+    names, bundle = custom_operator.render_bundle(*custom_operator.validate_spec(spec))
+    for step, body in bundle.items():
+        obj = {'metadata': {'name': body['metadata']['name'], 'annotations': body['metadata']['annotations']}, 'spec': body.get('spec', {})}
+        if step != "namespace":
+            obj['metadata']['namespace'] = names['namespace']
+        cache.replace(step, [obj])
+    return cache
+
+def test_render_bundle_desired_hash_tracks_workload_only():
+    _, first = custom_operator.render_bundle(142, 'orim2002/my-app', 'v1')
+    _, again = custom_operator.render_bundle(142, 'orim2002/my-app', 'v1')
+    _, retagged = custom_operator.render_bundle(142, 'orim2002/my-app', 'v2')
+    digest = lambda body: body["metadata"]["annotations"][custom_operator.DESIRED_HASH_ANNOTATION]
+    assert all(digest(first[step]) == digest(again[step]) for step in first)
+    assert digest(first["deployment"]) != digest(retagged["deployment"])
+    assert digest(first["service"]) == digest(retagged["service"])
+
+@patch.object(custom_operator.UPDATE_COALESCER, 'quiet_window', 0)
+@patch('custom_operator.apply_object')
+def test_update_fn_skips_writes_when_workload_unchanged(mock_apply_object):
+    spec = {'pr_number': 142, 'branch_name': 'feature-x', 'image': 'orim2002/my-app', 'image_tag': 'v1'}
+    reconciles_before = custom_operator.RECONCILES_ALL._value.get()
+    skipped_before = metrics.APPLIES_SKIPPED.labels(step="deployment")._value.get()
+    with patch.object(custom_operator, 'RESOURCE_CACHE', _applied_cache(spec)):
+        for changed in ({'ttl_seconds': 3600}, {'branch_name': 'feature-y'}):
+            asyncio.run(custom_operator.update_fn(spec={**spec, **changed}, name='test', namespace='preview-envs', status={}, meta=META, logger=MagicMock()))
+        mock_apply_object.assert_not_called()
+        asyncio.run(custom_operator.update_fn(spec={**spec, 'image_tag': 'v2'}, name='test', namespace='preview-envs', status={}, meta=META, logger=MagicMock()))
+    assert [call.args[0] for call in mock_apply_object.call_args_list] == ["deployment"]
+    assert custom_operator.RECONCILES_ALL._value.get() == reconciles_before + 1
+    assert metrics.APPLIES_SKIPPED.labels(step="deployment")._value.get() == skipped_before + 2
 
-@patch('custom_operator.client.CoreV1Api')
-def test_delete_fn_decrements_gauge(mock_core_v1):
+@patch('custom_operator.client.CoreV1Api', return_value=AsyncMock())
+def test_delete_fn_decrements_gauge_once_namespace_is_gone(mock_core_v1):
     spec = {'pr_number': 142}
+    queue = DeletionQueue(delete=custom_operator.delete_namespace)
     before = custom_operator.ACTIVE_ENVIRONMENTS._value.get()
-    custom_operator.delete_fn(spec=spec, name='test', namespace='preview-envs', logger=MagicMock())
-    after = custom_operator.ACTIVE_ENVIRONMENTS._value.get()
-    assert after == before - 1
+    with patch.object(custom_operator, 'DELETION_QUEUE', queue):
+        asyncio.run(custom_operator.delete_fn(spec=spec, name='test', namespace='preview-envs', status=CREATED, logger=MagicMock()))
     mock_core_v1.return_value.delete_namespace.assert_called_once_with("preview-pr-142")
+    assert custom_operator.ACTIVE_ENVIRONMENTS._value.get() == before
+    assert queue.terminating() == {"preview-pr-142"}
+    queue.observe("namespace", "DELETED", (None, "preview-pr-142"), None)
+    assert custom_operator.ACTIVE_ENVIRONMENTS._value.get() == before - 1
+    assert queue.terminating() == set()
+
+def test_update_fn_coalesces_rapid_updates():
+    apply = AsyncMock()
+    received_before = metrics.UPDATES_RECEIVED._value.get()
+    applied_before = metrics.UPDATES_APPLIED._value.get()
+
+    async def run():
+        coalescer = UpdateCoalescer(apply=apply, quiet_window=0.05, max_delay=5)
+        with patch.object(custom_operator, 'UPDATE_COALESCER', coalescer):
+            for tag in ['v1', 'v2', 'v3']:
+                spec = {'pr_number': 142, 'image': 'orim2002/my-app', 'image_tag': tag}
+                await custom_operator.update_fn(spec=spec, name='test', namespace='preview-envs', status={}, meta=META, logger=MagicMock())
+            apply.assert_not_called()
+            await asyncio.sleep(0.15)
+
+    asyncio.run(run())
+    apply.assert_awaited_once_with(142, ({'pr_number': 142, 'image': 'orim2002/my-app', 'image_tag': 'v3'}, 'preview-pr-142', ('preview-envs', 'test'), None))
+    assert metrics.UPDATES_RECEIVED._value.get() == received_before + 3
+    assert metrics.UPDATES_APPLIED._value.get() == applied_before + 1
+
+def test_update_coalescer_max_delay_bounds_latency():
+    apply = AsyncMock()
+
+    async def run():
+        coalescer = UpdateCoalescer(apply=apply, quiet_window=0.05, max_delay=0.1)
+        for i in range(8):  # keeps resetting the quiet window
+            await coalescer.submit(142, i)
+            await asyncio.sleep(0.03)
+        await asyncio.sleep(0.1)
+
+    asyncio.run(run())
+    assert 1 < apply.await_count < 8
+    assert apply.await_args_list[-1].args == (142, 7)
+
+def test_update_coalescer_retries_failed_apply():
+    apply = AsyncMock(side_effect=[client.exceptions.ApiException(status=500), None])
+
+    async def run():
+        coalescer = UpdateCoalescer(apply=apply, quiet_window=0.02, max_delay=5)
+        await coalescer.submit(142, 'v1')
+        await asyncio.sleep(0.15)
+        return coalescer
+
+    coalescer = asyncio.run(run())
+    assert apply.await_count == 2
+    assert coalescer.pending() == 0
+
+def test_update_coalescer_cancel_and_flush():
+    apply = AsyncMock()
+
+    async def run():
+        coalescer = UpdateCoalescer(apply=apply, quiet_window=10, max_delay=10)
+        await coalescer.submit(1, 'a')
+        await coalescer.submit(2, 'b')
+        coalescer.cancel(1)
+        await coalescer.flush()
+
+    asyncio.run(run())
+    apply.assert_awaited_once_with(2, 'b')
+
+def test_environment_namespace_prefers_recorded_namespace():
+    assert custom_operator.environment_namespace(142, {}) == "preview-pr-142"
+    assert custom_operator.environment_namespace(142, {'create_fn': {'namespace': 'preview-warm-ab12'}}) == "preview-warm-ab12"
 
 # --- resume_fn ---
 
-@patch('custom_operator.client.CoreV1Api')
-def test_resume_fn_namespace_exists(mock_core_v1):
-    mock_core_v1.return_value.read_namespace.return_value = MagicMock()
+@patch('custom_operator.apply_object')
+def test_resume_fn_reconciles_bundle(mock_apply_object):
     before = custom_operator.ACTIVE_ENVIRONMENTS._value.get()
-    custom_operator.resume_fn(name='pr-142-env', spec={'pr_number': 142}, logger=MagicMock())
+    asyncio.run(custom_operator.resume_fn(name='pr-142-env', namespace='preview-envs', spec=SPEC, meta=META, status=CREATED, logger=MagicMock()))
     after = custom_operator.ACTIVE_ENVIRONMENTS._value.get()
     assert after == before + 1
+    assert mock_apply_object.call_count == 5
 
-@patch('custom_operator.client.CoreV1Api')
-def test_resume_fn_namespace_not_found(mock_core_v1):
-    mock_core_v1.return_value.read_namespace.side_effect = client.exceptions.ApiException(status=404)
+@patch('custom_operator.apply_object', side_effect=client.exceptions.ApiException(status=500))
+def test_resume_fn_api_error(mock_apply_object):
     before = custom_operator.ACTIVE_ENVIRONMENTS._value.get()
-    custom_operator.resume_fn(name='pr-142-env', spec={'pr_number': 142}, logger=MagicMock())
-    after = custom_operator.ACTIVE_ENVIRONMENTS._value.get()
-    assert after == before  # no change — returns early
-
-@patch('custom_operator.client.CoreV1Api')
-def test_resume_fn_other_api_error(mock_core_v1):
-    mock_core_v1.return_value.read_namespace.side_effect = client.exceptions.ApiException(status=500)
     with pytest.raises(client.exceptions.ApiException):
-        custom_operator.resume_fn(name='pr-142-env', spec={'pr_number': 142}, logger=MagicMock())
+        asyncio.run(custom_operator.resume_fn(name='pr-142-env', namespace='preview-envs', spec=SPEC, meta=META, status=CREATED, logger=MagicMock()))
+    assert custom_operator.ACTIVE_ENVIRONMENTS._value.get() == before
 
-# --- ttl_check_fn ---
+def _namespace(pr_number):
+    return client.V1Namespace(metadata=client.V1ObjectMeta(
+        name=f"preview-pr-{pr_number}", labels={"managed-by": "preview-operator", "pr-number": str(pr_number)}
+    ))
 
-@patch('custom_operator.client.CustomObjectsApi')
-def test_ttl_check_fn_no_ttl(mock_custom_api):
-    meta = {'creationTimestamp': '2024-01-01T00:00:00Z'}
-    custom_operator.ttl_check_fn(
-        name='pr-142-env', namespace='preview-envs', spec={}, meta=meta, logger=MagicMock()
-    )
-    mock_custom_api.return_value.delete_namespaced_custom_object.assert_not_called()
-
-@patch('custom_operator.client.CustomObjectsApi')
-def test_ttl_check_fn_not_expired(mock_custom_api):
-    meta = {'creationTimestamp': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')}
-    spec = {'ttl_seconds': 86400}
-    custom_operator.ttl_check_fn(
-        name='pr-142-env', namespace='preview-envs', spec=spec, meta=meta, logger=MagicMock()
-    )
-    mock_custom_api.return_value.delete_namespaced_custom_object.assert_not_called()
+def _environment(pr_number, created=True):
+    env = {'metadata': {'namespace': 'preview-envs', 'name': f'pr-{pr_number}-env'}, 'spec': {'pr_number': pr_number}}
+    if created:
+        env['status'] = {'create_fn': {'namespace': f'preview-pr-{pr_number}'}}
+    return env
+
+@patch('custom_operator.missing_namespaces', None)
+@patch('custom_operator.client.CustomObjectsApi', return_value=AsyncMock())
+@patch('custom_operator.client.CoreV1Api', return_value=AsyncMock())
+def test_bulk_resume_joins_namespaces_and_crs(mock_core_v1, mock_custom_api):
+    mock_core_v1.return_value.list_namespace.side_effect = [
+        client.V1NamespaceList(items=[_namespace(1)], metadata=client.V1ListMeta(_continue="page-2")),
+        client.V1NamespaceList(items=[_namespace(2)], metadata=client.V1ListMeta()),
+    ]
+    mock_custom_api.return_value.list_cluster_custom_object.return_value = {
+        'items': [_environment(1), _environment(2), _environment(3)], 'metadata': {}
+    }
+    asyncio.run(custom_operator.bulk_resume())
+    assert mock_core_v1.return_value.list_namespace.call_count == 2
+    assert mock_core_v1.return_value.list_namespace.call_args.kwargs['_continue'] == "page-2"
+    mock_core_v1.return_value.read_namespace.assert_not_called()
+    assert custom_operator.ACTIVE_ENVIRONMENTS._value.get() == 2
+    assert custom_operator.MISSING_NAMESPACES._value.get() == 1
+    assert custom_operator.missing_namespaces == {('preview-envs', 'pr-3-env')}
+
+@patch('custom_operator.missing_namespaces', set())
+@patch('custom_operator.apply_object')
+def test_resume_fn_skips_api_when_namespace_exists(mock_apply_object):
+    before = custom_operator.ACTIVE_ENVIRONMENTS._value.get()
+    asyncio.run(custom_operator.resume_fn(name='pr-142-env', namespace='preview-envs', spec=SPEC, meta=META, status=CREATED, logger=MagicMock()))
+    mock_apply_object.assert_not_called()
+    assert custom_operator.ACTIVE_ENVIRONMENTS._value.get() == before
+
+@patch('custom_operator.missing_namespaces', {('preview-envs', 'pr-142-env')})
+@patch('custom_operator.apply_object')
+def test_resume_fn_recreates_missing_namespace(mock_apply_object):
+    before = custom_operator.ACTIVE_ENVIRONMENTS._value.get()
+    asyncio.run(custom_operator.resume_fn(name='pr-142-env', namespace='preview-envs', spec=SPEC, meta=META, status=CREATED, logger=MagicMock()))
+    assert mock_apply_object.call_count == 5
+    assert custom_operator.ACTIVE_ENVIRONMENTS._value.get() == before + 1
+    assert custom_operator.missing_namespaces == set()
+
+@patch('custom_operator.missing_namespaces', set())
+@patch('custom_operator.patch_environment_status')
+@patch('custom_operator.apply_object')
+def test_resume_fn_applies_update_lost_in_a_crash(mock_apply_object, mock_patch_status):
+    before = custom_operator.ACTIVE_ENVIRONMENTS._value.get()
+    status = {**CREATED, 'appliedSpec': custom_operator.workload_digest({**SPEC, 'image_tag': 'v2.0'})}
+    asyncio.run(custom_operator.resume_fn(name='pr-142-env', namespace='preview-envs', spec=SPEC, meta=META, status=status, logger=MagicMock()))
+    assert "deployment" in [call.args[0] for call in mock_apply_object.call_args_list]
+    mock_patch_status.assert_awaited_once_with('preview-envs', 'pr-142-env', {'appliedSpec': custom_operator.workload_digest(SPEC)})
+    assert custom_operator.ACTIVE_ENVIRONMENTS._value.get() == before
+
+    mock_apply_object.reset_mock()
+    status = {**CREATED, 'appliedSpec': custom_operator.workload_digest(SPEC)}
+    asyncio.run(custom_operator.resume_fn(name='pr-142-env', namespace='preview-envs', spec=SPEC, meta=META, status=status, logger=MagicMock()))
+    mock_apply_object.assert_not_called()
+
+@patch.object(custom_operator.UPDATE_COALESCER, 'quiet_window', 0)
+@patch('custom_operator.patch_environment_status')
+@patch('custom_operator.apply_object')
+def test_update_fn_records_applied_spec(mock_apply_object, mock_patch_status):
+    spec = {**SPEC, 'image_tag': 'v2.2'}
+    asyncio.run(custom_operator.update_fn(spec=spec, name='test', namespace='preview-envs', status={}, meta=META, logger=MagicMock()))
+    mock_patch_status.assert_awaited_once_with('preview-envs', 'test', {'appliedSpec': custom_operator.workload_digest(spec)})
+
+@patch.object(custom_operator.UPDATE_COALESCER, 'quiet_window', 0)
+@patch('custom_operator.patch_environment_status')
+@patch('custom_operator.apply_object')
+def test_no_op_update_writes_no_status(mock_apply_object, mock_patch_status):
+    status = {**CREATED, 'appliedSpec': custom_operator.workload_digest(SPEC)}
+    with patch.object(custom_operator, 'RESOURCE_CACHE', _applied_cache(SPEC)):
+        asyncio.run(custom_operator.update_fn(spec={**SPEC, 'ttl_seconds': 3600}, name='test', namespace='preview-envs', status=status, meta=META, logger=MagicMock()))
+    mock_apply_object.assert_not_called()
+    mock_patch_status.assert_not_called()
+
+@patch('custom_operator.missing_namespaces', {('preview-envs', 'pr-142-env')})
+@patch('custom_operator.apply_object')
+def test_resume_fn_leaves_unfinished_create_to_create_fn(mock_apply_object):
+    before = custom_operator.ACTIVE_ENVIRONMENTS._value.get()
+    status = {'checkpoint': {'spec': custom_operator.spec_digest(SPEC), 'namespace': 'preview-pr-142', 'steps': ['namespace']}}
+    asyncio.run(custom_operator.resume_fn(name='pr-142-env', namespace='preview-envs', spec=SPEC, meta=META, status=status, logger=MagicMock()))
+    mock_apply_object.assert_not_called()
+    assert custom_operator.ACTIVE_ENVIRONMENTS._value.get() == before
+
+@patch('custom_operator.metrics_server', None)
+@patch('custom_operator.load_config', AsyncMock())
+@patch('custom_operator.start_metrics_server')
+def test_startup_fn_can_be_retried_after_a_failed_resume(mock_start_metrics_server):
+    cache, tracker = MagicMock(wait_synced=AsyncMock()), MagicMock()
+    bulk_resume = AsyncMock(side_effect=[client.exceptions.ApiException(status=500), None])
+    with patch.object(custom_operator, 'RESOURCE_CACHE', cache), \
+            patch.object(custom_operator, 'READINESS_TRACKER', tracker), \
+            patch.object(custom_operator, 'bulk_resume', bulk_resume), \
+            patch.object(custom_operator, 'DELETION_QUEUE', MagicMock()), \
+            patch.object(custom_operator, 'TTL_SCHEDULER', MagicMock()), \
+            patch.object(custom_operator, 'ORPHAN_SWEEPER', MagicMock()), \
+            patch.object(custom_operator, 'startup_complete', False):
+        with pytest.raises(client.exceptions.ApiException):
+            asyncio.run(custom_operator.startup_fn(settings=kopf.OperatorSettings()))
+        asyncio.run(custom_operator.startup_fn(settings=kopf.OperatorSettings()))
+        assert custom_operator.startup_complete
+    mock_start_metrics_server.assert_called_once()
+    assert tracker.start.call_count == 1
+
+# --- bounded metrics ---
+
+def _series(metric_name):
+    return {
+        sample.labels.get("pr_number") for family in REGISTRY.collect() for sample in family.samples
+        if sample.name == metric_name
+    }
+
+def test_bounded_labels_evicts_least_recently_used():
+    bounded = metrics.BoundedLabels(Counter("test_bounded_total", "test", ["pr_number"]), max_series=2)
+    bounded.labels(pr_number=1).inc()
+    bounded.labels(pr_number=2).inc()
+    bounded.labels(pr_number=1).inc()
+    bounded.labels(pr_number=3).inc()
+    assert _series("test_bounded_total") == {"1", "3"}
+    bounded.remove(pr_number=1)
+    bounded.remove(pr_number=99)  # unknown series are ignored
+    assert _series("test_bounded_total") == {"3"}
+
+@patch.object(custom_operator, 'DELETION_QUEUE', DeletionQueue(delete=AsyncMock(return_value=True)))
+def test_delete_fn_forgets_per_pr_series():
+    metrics.RECONCILE_COUNT.labels(pr_number="142").inc()
+    asyncio.run(custom_operator.delete_fn(spec=SPEC, name='test', namespace='preview-envs', status=CREATED, logger=MagicMock()))
+    assert "142" not in _series("preview_environments_reconcile_total")
+
+# --- TTL scheduler ---
+
+def test_ttl_scheduler_pops_in_deadline_order():
+    scheduler = TTLScheduler(expire=AsyncMock(), batch_size=10)
+    scheduler.schedule(('ns', 'b'), 200)
+    scheduler.schedule(('ns', 'a'), 100)
+    scheduler.schedule(('ns', 'c'), 300)
+    assert scheduler.next_deadline() == 100
+    assert scheduler.pop_expired(now=250) == [('ns', 'a'), ('ns', 'b')]
+    assert len(scheduler) == 1
 
-@patch('custom_operator.client.CustomObjectsApi')
-def test_ttl_check_fn_expired(mock_custom_api):
-    past = datetime.now(timezone.utc) - timedelta(hours=1)
-    meta = {'creationTimestamp': past.strftime('%Y-%m-%dT%H:%M:%SZ')}
-    spec = {'ttl_seconds': 60}
+def test_ttl_scheduler_cancel_and_reschedule():
+    scheduler = TTLScheduler(expire=AsyncMock(), batch_size=10)
+    scheduler.schedule(('ns', 'a'), 100)
+    scheduler.schedule(('ns', 'b'), 150)
+    scheduler.cancel(('ns', 'a'))
+    scheduler.schedule(('ns', 'b'), 500)  # TTL extended by an update
+    assert scheduler.pop_expired(now=200) == []
+    assert scheduler.next_deadline() == 500
+
+def test_ttl_scheduler_batches_expiries():
+    scheduler = TTLScheduler(expire=AsyncMock(), batch_size=2)
+    for i in range(5):
+        scheduler.schedule(('ns', f'env-{i}'), i)
+    assert len(scheduler.pop_expired(now=10)) == 2
+    assert len(scheduler) == 3
+
+def test_ttl_scheduler_run_expires_due_environments():
+    expire = AsyncMock(return_value=[])
+
+    async def run():
+        scheduler = TTLScheduler(expire=expire)
+        scheduler.start()
+        scheduler.schedule(('ns', 'due'), time.time() - 1)
+        scheduler.schedule(('ns', 'later'), time.time() + 3600)
+        await asyncio.sleep(0.05)
+        await scheduler.stop()
+        return scheduler
+
+    scheduler = asyncio.run(run())
+    expire.assert_awaited_once_with([('ns', 'due')])
+    assert len(scheduler) == 1
+
+def test_schedule_ttl_no_ttl_cancels():
+    custom_operator.TTL_SCHEDULER.schedule(('preview-envs', 'pr-142-env'), 100)
+    custom_operator.schedule_ttl('pr-142-env', 'preview-envs', {}, META)
+    assert ('preview-envs', 'pr-142-env') not in custom_operator.TTL_SCHEDULER._deadlines
+
+def test_schedule_ttl_uses_creation_time():
+    custom_operator.schedule_ttl('pr-142-env', 'preview-envs', {'ttl_seconds': 60}, META)
+    deadline = custom_operator.TTL_SCHEDULER._deadlines[('preview-envs', 'pr-142-env')]
+    assert deadline == datetime(2024, 1, 1, tzinfo=timezone.utc).timestamp() + 60
+    custom_operator.TTL_SCHEDULER.cancel(('preview-envs', 'pr-142-env'))
+
+@patch('custom_operator.client.CustomObjectsApi', return_value=AsyncMock())
+def test_expire_environments(mock_custom_api):
+    mock_custom_api.return_value.delete_namespaced_custom_object.side_effect = [
+        None, client.exceptions.ApiException(status=404), client.exceptions.ApiException(status=500)
+    ]
+    keys = [('preview-envs', 'pr-1-env'), ('preview-envs', 'pr-2-env'), ('preview-envs', 'pr-3-env')]
     before = custom_operator.ENVIRONMENTS_EXPIRED._value.get()
-    custom_operator.ttl_check_fn(
-        name='pr-142-env', namespace='preview-envs', spec=spec, meta=meta, logger=MagicMock()
-    )
-    after = custom_operator.ENVIRONMENTS_EXPIRED._value.get()
-    assert after == before + 1
-    mock_custom_api.return_value.delete_namespaced_custom_object.assert_called_once_with(
+    failed = asyncio.run(custom_operator.expire_environments(keys))
+    assert failed == [('preview-envs', 'pr-3-env')]
+    assert custom_operator.ENVIRONMENTS_EXPIRED._value.get() == before + 1
+    mock_custom_api.return_value.delete_namespaced_custom_object.assert_any_call(
         group="devops.orima.com",
         version="v1",
         namespace="preview-envs",
         plural="previewenvironments",
-        name="pr-142-env",
+        name="pr-1-env",
+    )
+
+# --- resource cache ---
+
+def _raw(name, namespace=None, pr_number=142, resource_version="1", **extra):
+    metadata = {'name': name, 'resourceVersion': resource_version, 'labels': {'pr-number': str(pr_number)}}
+    if namespace:
+        metadata['namespace'] = namespace
+    return {'metadata': metadata, **extra}
+
+class FakeResponse:
+    def __init__(self, payload=None, lines=()):
+        self._payload = payload
+        self.content = self._lines(lines)
+
+    async def _lines(self, lines):
+        for line in lines:
+            yield json.dumps(line).encode() + b"\n"
+
+    async def read(self):
+        return json.dumps(self._payload).encode()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+def test_resource_cache_tri_state_lookups():
+    cache = ResourceCache(kinds={"namespace": None})
+    assert cache.exists("namespace", "preview-pr-142") is None  # not synced yet
+    cache.replace("namespace", [_raw("preview-pr-142", status={'phase': 'Active'})])
+    assert cache.exists("namespace", "preview-pr-142") is True
+    assert cache.exists("namespace", "preview-pr-7") is False
+    assert cache.get("namespace", "preview-pr-142").phase == "Active"
+
+def test_resource_cache_applies_watch_events():
+    cache = ResourceCache(kinds={"deployment": None})
+    seen = []
+    cache.subscribe(lambda kind, event_type, key, entry: seen.append((event_type, key)))
+    cache.replace("deployment", [])
+    deployment = _raw("pr-142-app", "preview-pr-142", spec={'template': {'spec': {'containers': [{'image': 'app:v1'}]}}})
+    cache.apply_event("deployment", "ADDED", deployment)
+    assert cache.get("deployment", "pr-142-app", "preview-pr-142").image == "app:v1"
+    cache.apply_event("deployment", "DELETED", deployment)
+    assert cache.exists("deployment", "pr-142-app", "preview-pr-142") is False
+    assert seen == [("ADDED", ("preview-pr-142", "pr-142-app")), ("DELETED", ("preview-pr-142", "pr-142-app"))]
+
+def test_resource_cache_eviction_bounds_memory():
+    cache = ResourceCache(kinds={"namespace": None}, max_entries=2)
+    cache.replace("namespace", [_raw("preview-pr-1"), _raw("preview-pr-2")])
+    cache.get("namespace", "preview-pr-1")  # touch so pr-2 is least recently used
+    cache.apply_event("namespace", "ADDED", _raw("preview-pr-3"))
+    assert len(cache.items("namespace")) == 2
+    assert cache.exists("namespace", "preview-pr-2") is None  # evicted, no longer provably absent
+    assert cache.exists("namespace", "preview-pr-1") is True
+
+def test_resource_cache_lookup_metrics():
+    cache = ResourceCache(kinds={"service": None})
+    misses = metrics.CACHE_LOOKUPS.labels(kind="service", result="miss")
+    hits = metrics.CACHE_LOOKUPS.labels(kind="service", result="hit")
+    misses_before, hits_before = misses._value.get(), hits._value.get()
+    cache.get("service", "pr-142-svc", "preview-pr-142")
+    cache.replace("service", [])
+    cache.get("service", "pr-142-svc", "preview-pr-142")
+    assert misses._value.get() == misses_before + 1
+    assert hits._value.get() == hits_before + 1
+
+def test_resource_cache_list_then_watch():
+    cache = ResourceCache(kinds={"namespace": None})
+    responses = [
+        FakeResponse(payload={'items': [_raw("preview-pr-1")], 'metadata': {'resourceVersion': "10"}}),
+        FakeResponse(lines=[
+            {'type': 'ADDED', 'object': _raw("preview-pr-2", resource_version="11")},
+            {'type': 'BOOKMARK', 'object': {'metadata': {'resourceVersion': "12"}}},
+        ]),
+    ]
+    requests = []
+
+    async def fake_request(kind, **kwargs):
+        requests.append(kwargs)
+        if responses:
+            return responses.pop(0)
+        await asyncio.sleep(3600)
+
+    async def run():
+        cache._request = fake_request
+        cache.start()
+        await cache.wait_synced(timeout=1)
+        await asyncio.sleep(0.05)
+        await cache.stop()
+
+    asyncio.run(run())
+    assert {key[1] for key, _ in cache.items("namespace")} == {"preview-pr-1", "preview-pr-2"}
+    assert requests[1]['resource_version'] == "10"
+    assert requests[2]['resource_version'] == "12"  # re-watch resumes from the bookmark
+
+@patch('custom_operator.apply_object')
+def test_reconcile_skips_namespace_apply_when_cached(mock_apply_object):
+    with patch.object(custom_operator, 'RESOURCE_CACHE', ResourceCache(kinds={"namespace": None})) as cache:
+        cache.replace("namespace", [_raw("preview-pr-142", status={'phase': 'Active'})])
+        asyncio.run(custom_operator.reconcile_environment(SPEC))
+    assert "namespace" not in [call.args[0] for call in mock_apply_object.call_args_list]
+    assert mock_apply_object.call_count == 4
+
+@patch('custom_operator.client.CoreV1Api', return_value=AsyncMock())
+def test_delete_fn_skips_api_when_namespace_gone(mock_core_v1):
+    with patch.object(custom_operator, 'RESOURCE_CACHE', ResourceCache(kinds={"namespace": None})) as cache:
+        cache.replace("namespace", [])
+        asyncio.run(custom_operator.delete_fn(spec={'pr_number': 142}, name='test', namespace='preview-envs', status=CREATED, logger=MagicMock()))
+    mock_core_v1.return_value.delete_namespace.assert_not_called()
+
+# --- deletion queue ---
+
+def test_deletion_queue_sends_bounded_batches():
+    in_flight, peak = 0, 0
+
+    async def delete(name):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        return name != "ns-4"  # already gone
+
+    gone = []
+    queue = DeletionQueue(delete=delete, batch_size=2, batch_interval=0.01)
+
+    async def run():
+        await asyncio.gather(*(queue.delete(f"ns-{i}", on_gone=lambda i=i: gone.append(i)) for i in range(5)))
+
+    asyncio.run(run())
+    assert peak == 2
+    assert queue.terminating() == {"ns-0", "ns-1", "ns-2", "ns-3"}
+    assert gone == [4]
+    queue.observe("namespace", "DELETED", (None, "ns-1"), None)
+    queue.observe("deployment", "DELETED", ("ns-2", "ns-2"), None)
+    assert gone == [4, 1]
+
+def test_deletion_queue_propagates_failed_delete():
+    queue = DeletionQueue(delete=AsyncMock(side_effect=client.exceptions.ApiException(status=500)))
+    with pytest.raises(client.exceptions.ApiException):
+        asyncio.run(queue.delete("ns-1"))
+    assert queue.terminating() == set()
+
+def test_deletion_queue_check_finishes_missed_and_counts_stuck():
+    existing = {"ns-1", "ns-2"}
+    queue = DeletionQueue(delete=AsyncMock(return_value=True), exists=lambda name: name in existing, stuck_after=0.01)
+    asyncio.run(queue.delete("ns-1"))
+    asyncio.run(queue.delete("ns-2"))
+    existing.discard("ns-1")  # deleted while the watch was relisting
+    time.sleep(0.02)
+    queue.check()
+    assert queue.terminating() == {"ns-2"}
+    assert queue.stuck() == ["ns-2"]
+    assert REGISTRY.get_sample_value('preview_namespaces_stuck_terminating') == 1
+
+# --- warm pool ---
+
+def test_warm_pool_claim_hit_and_miss():
+    provision, bind = AsyncMock(), AsyncMock()
+    hits = metrics.WARM_POOL_CLAIMS.labels(result="hit")
+    misses = metrics.WARM_POOL_CLAIMS.labels(result="miss")
+    hits_before, misses_before = hits._value.get(), misses._value.get()
+
+    async def run():
+        pool = WarmPool(provision=provision, bind=bind, discover=AsyncMock(return_value=[]), size=1)
+        pool.start()
+        await asyncio.sleep(0.01)
+        first = await pool.claim(142)
+        second = await pool.claim(143)  # refill has not run yet
+        await asyncio.sleep(0.01)
+        ready = pool.ready()
+        await pool.stop()
+        return first, second, ready
+
+    first, second, ready = asyncio.run(run())
+    assert first.startswith("preview-warm-")
+    assert second is None
+    assert ready == 1  # refilled in the background
+    bind.assert_awaited_once_with(first, 142)
+    assert provision.await_count == 2
+    assert hits._value.get() == hits_before + 1
+    assert misses._value.get() == misses_before + 1
+
+def test_warm_pool_reuses_discovered_namespaces():
+    provision = AsyncMock()
+
+    async def run():
+        pool = WarmPool(provision=provision, bind=AsyncMock(), discover=AsyncMock(return_value=["preview-warm-old1"]), size=1)
+        pool.start()
+        await asyncio.sleep(0.01)
+        await pool.stop()
+        return pool.ready()
+
+    assert asyncio.run(run()) == 1
+    provision.assert_not_called()
+
+def test_render_bundle_in_warm_namespace_skips_plumbing():
+    names, bundle = custom_operator.render_bundle(142, "orim2002/my-app", "v2.1", "preview-warm-ab12")
+    assert names['namespace'] == "preview-warm-ab12"
+    assert list(bundle) == ["deployment", "service", "ingress"]
+
+@patch('custom_operator.apply_object')
+def test_create_fn_binds_claimed_warm_namespace(mock_apply_object):
+    pool = MagicMock(enabled=True)
+    pool.claim = AsyncMock(return_value="preview-warm-ab12")
+    with patch.object(custom_operator, 'WARM_POOL', pool):
+        result = asyncio.run(custom_operator.create_fn(spec=SPEC, name='test', namespace='preview-envs', meta=META, status={}, patch=kopf.Patch(), logger=MagicMock()))
+    pool.claim.assert_awaited_once_with(142)
+    assert result['namespace'] == "preview-warm-ab12"
+    assert {call.args[0] for call in mock_apply_object.call_args_list} == {"deployment", "service", "ingress"}
+    assert all(call.kwargs['namespace'] == "preview-warm-ab12" for call in mock_apply_object.call_args_list)
+
+def test_claim_namespace_reuses_namespace_from_failed_attempt():
+    pool = MagicMock(enabled=True)
+    pool.claim = AsyncMock()
+    cache = ResourceCache(kinds={"namespace": None})
+    cache.replace("namespace", [_raw("preview-warm-ab12", pr_number=142)])
+    with patch.object(custom_operator, 'WARM_POOL', pool), patch.object(custom_operator, 'RESOURCE_CACHE', cache):
+        assert asyncio.run(custom_operator.claim_namespace(142)) == "preview-warm-ab12"
+    pool.claim.assert_not_called()
+
+# --- scale to zero ---
+
+class FakeTraffic:
+    def __init__(self):
+        self.counts = {}
+
+    async def requests_by_host(self):
+        return dict(self.counts)
+
+def _deployment(name, namespace, replicas=1):
+    return {
+        "apiVersion": "apps/v1",
+        "kind": "Deployment",
+        "metadata": {"name": name, "namespace": namespace},
+        "spec": {
+            "replicas": replicas,
+            "selector": {"matchLabels": {"app": name}},
+            "template": {"metadata": {"labels": {"app": name}}, "spec": {"containers": [{"name": "app", "image": "app"}]}},
+        },
+        "status": {"readyReplicas": replicas},
+    }
+
+def _run_against_fake_apiserver(scenario, module='scale_to_zero'):
+    async def run():
+        server = FakeApiServer()
+        await server.start()
+        api_client = server.api_client()
+        try:
+            with patch(f'{module}.get_api_client', return_value=api_client):
+                return await scenario(server)
+        finally:
+            await api_client.close()
+            await server.stop()
+    return asyncio.run(run())
+
+def test_idle_controller_scales_idle_preview_to_zero():
+    traffic = FakeTraffic()
+    controller = IdleController(traffic, idle_after=60, interval=1)
+    host = "pr-142.preview.orimatest.com"
+
+    async def scenario(server):
+        server.add("deployments", _deployment("pr-142-app", "preview-pr-142"))
+        controller.track(host, "preview-pr-142", "pr-142-app")
+        traffic.counts[host] = 5
+        await controller.check()  # counter moved: still active
+        with patch('scale_to_zero.time.monotonic', return_value=time.monotonic() + 61):
+            await controller.check()
+        return server.get("deployments", "pr-142-app", "preview-pr-142")
+
+    deployment = _run_against_fake_apiserver(scenario)
+    assert deployment["spec"]["replicas"] == 0
+    assert controller.is_sleeping(host)
+
+@patch.object(custom_operator.UPDATE_COALESCER, 'quiet_window', 0)
+@patch('custom_operator.apply_object')
+def test_update_marks_preview_awake_only_when_deployment_applied(mock_apply_object):
+    spec = {'pr_number': 142, 'branch_name': 'feature-x', 'image': 'orim2002/my-app', 'image_tag': 'v1'}
+    host = custom_operator.preview_host(142)
+    controller = IdleController(FakeTraffic(), idle_after=60)
+    with patch.object(custom_operator, 'RESOURCE_CACHE', _applied_cache(spec)), \
+            patch.object(custom_operator, 'IDLE_CONTROLLER', controller):
+        controller.track(host, "preview-pr-142", "pr-142-app")
+        controller._sleeping.add(host)
+        asyncio.run(custom_operator.update_fn(spec={**spec, 'ttl_seconds': 3600}, name='test', namespace='preview-envs', status={}, meta=META, logger=MagicMock()))
+        assert controller.is_sleeping(host)  # Deployment untouched, still at zero replicas
+        asyncio.run(custom_operator.update_fn(spec={**spec, 'image_tag': 'v2'}, name='test', namespace='preview-envs', status={}, meta=META, logger=MagicMock()))
+    assert not controller.is_sleeping(host)
+
+def test_activator_wakes_preview_and_redirects():
+    from aiohttp.test_utils import TestClient, TestServer
+
+    controller = IdleController(FakeTraffic(), idle_after=60)
+    host = "pr-142.preview.orimatest.com"
+
+    def mark_ready(plural, event_type, obj):
+        # Plays the deployment controller: scaled-up replicas become ready
+        if plural == "deployments":
+            obj["status"] = {"readyReplicas": obj["spec"]["replicas"]}
+
+    async def scenario(server):
+        server.add("deployments", _deployment("pr-142-app", "preview-pr-142", replicas=0))
+        server.on_change(mark_ready)
+        controller.track(host, "preview-pr-142", "pr-142-app")
+        controller._sleeping.add(host)
+        async with TestClient(TestServer(activator_app(controller))) as http:
+            response = await http.get("/", headers={"X-Namespace": "preview-pr-142", "X-Original-URI": "/login?next=/"}, allow_redirects=False)
+            unknown = await http.get("/", headers={"X-Namespace": "preview-pr-999"}, allow_redirects=False)
+        return response, unknown, server.get("deployments", "pr-142-app", "preview-pr-142")
+
+    response, unknown, deployment = _run_against_fake_apiserver(scenario)
+    assert response.status == 307
+    assert response.headers["Location"] == "https://pr-142.preview.orimatest.com/login?next=/"
+    assert unknown.status == 404
+    assert deployment["spec"]["replicas"] == 1
+    assert not controller.is_sleeping(host)
+
+def test_activator_passes_app_503_through_without_waking():
+    from aiohttp.test_utils import TestClient, TestServer
+
+    replicas = {"pr-142-app": 1, "pr-143-app": 0}
+    controller = IdleController(FakeTraffic(), idle_after=60, replicas=lambda namespace, deployment: replicas[deployment])
+    controller.track("pr-142.preview.orimatest.com", "preview-pr-142", "pr-142-app")
+    controller.track("pr-143.preview.orimatest.com", "preview-pr-143", "pr-143-app")
+
+    async def scenario(server):
+        server.add("deployments", _deployment("pr-143-app", "preview-pr-143", replicas=0))
+        async with TestClient(TestServer(activator_app(controller, timeout=0.1))) as http:
+            awake = await http.get("/", headers={"X-Namespace": "preview-pr-142"}, allow_redirects=False)
+            # Scaled down before an operator restart: known from the cache, not from memory
+            asleep = await http.get("/", headers={"X-Namespace": "preview-pr-143"}, allow_redirects=False)
+        return awake.status, asleep.status, server.count("PATCH")
+
+    awake, asleep, patches = _run_against_fake_apiserver(scenario)
+    assert awake == 503
+    assert asleep == 503  # woken, but no ready pod within the timeout
+    assert patches == 1  # only the sleeping preview was scaled up
+
+def test_render_bundle_routes_to_activator_when_scale_to_zero_enabled():
+    with patch.object(custom_operator.IDLE_CONTROLLER, 'idle_after', 600):
+        _, bundle = custom_operator.render_bundle(142, "orim2002/my-app", "v2.1")
+    annotations = bundle["ingress"]["metadata"]["annotations"]
+    assert annotations["nginx.ingress.kubernetes.io/default-backend"] == "preview-activator"
+    assert annotations["nginx.ingress.kubernetes.io/custom-http-errors"] == "503"
+    assert bundle["activator_service"]["spec"]["type"] == "ExternalName"
+
+# --- readiness ---
+
+def _ready_pod(name, namespace):
+    return {
+        "apiVersion": "v1",
+        "kind": "Pod",
+        "metadata": {"name": name, "namespace": namespace, "labels": {"app": "pr-142-app"}},
+        "spec": {"containers": [{"name": "app", "image": "orim2002/my-app:v2.1"}]},
+        "status": {
+            "conditions": [
+                {"type": "PodScheduled", "status": "True", "lastTransitionTime": "2024-01-01T00:00:03Z"},
+                {"type": "Ready", "status": "True", "lastTransitionTime": "2024-01-01T00:00:25Z"},
+            ],
+            "containerStatuses": [{
+                "name": "app", "image": "orim2002/my-app:v2.1", "imageID": "", "ready": True, "restartCount": 0,
+                "state": {"running": {"startedAt": "2024-01-01T00:00:18Z"}},
+            }],
+        },
+    }
+
+def test_phase_durations_split_time_to_ready():
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    pod = {"scheduled": start + timedelta(seconds=3), "started": start + timedelta(seconds=18), "ready": start + timedelta(seconds=25)}
+    assert phase_durations(start, pod, start + timedelta(seconds=40)) == {
+        "scheduling": 3, "image_pull": 15, "probe": 7, "tls": 40
+    }
+
+def test_readiness_tracker_reports_ready_in_status():
+    tracker = ReadinessTracker(poll_interval=0.01, timeout=5)
+
+    async def scenario(server):
+        server.add("previewenvironments", {"metadata": {"name": "pr-142-env", "namespace": "preview-envs"}, "spec": SPEC})
+        server.add("pods", _ready_pod("pr-142-app-abc", "preview-pr-142"))
+        tracker.track(("preview-envs", "pr-142-env"), "preview-pr-142", "pr-142-app",
+                      "pr-142.preview.orimatest.com-tls", datetime(2024, 1, 1, tzinfo=timezone.utc))
+        await asyncio.sleep(0.1)
+        assert tracker.tracking(("preview-envs", "pr-142-env"))  # still waiting for the certificate
+        server.add("certificates", {
+            "metadata": {"name": "pr-142.preview.orimatest.com-tls", "namespace": "preview-pr-142"},
+            "status": {"conditions": [{"type": "Ready", "status": "True", "lastTransitionTime": "2024-01-01T00:00:40Z"}]},
+        })
+        await asyncio.sleep(0.1)
+        return server.get("previewenvironments", "pr-142-env", "preview-envs")
+
+    environment = _run_against_fake_apiserver(scenario, module='readiness')
+    assert environment["status"] == {"ready": True, "readyAt": "2024-01-01T00:00:40Z"}
+    assert not tracker.tracking(("preview-envs", "pr-142-env"))
+
+def test_readiness_tracker_wakes_on_watch_events_instead_of_polling():
+    tracker = ReadinessTracker(poll_interval=60, timeout=5, resync_interval=60)
+    certificate = {
+        "metadata": {"name": "pr-142.preview.orimatest.com-tls", "namespace": "preview-pr-142"},
+        "status": {"conditions": [{"type": "Ready", "status": "True", "lastTransitionTime": "2024-01-01T00:00:40Z"}]},
+    }
+
+    async def scenario(server):
+        server.add("previewenvironments", {"metadata": {"name": "pr-142-env", "namespace": "preview-envs"}, "spec": SPEC})
+        tracker.start()
+        for _ in range(100):
+            if tracker.check_interval() == 60:
+                break
+            await asyncio.sleep(0.01)
+        tracker.track(("preview-envs", "pr-142-env"), "preview-pr-142", "pr-142-app",
+                      "pr-142.preview.orimatest.com-tls", datetime(2024, 1, 1, tzinfo=timezone.utc))
+        await asyncio.sleep(0.1)
+        checks = server.count("GET", "pods")
+        await asyncio.sleep(0.2)
+        assert server.count("GET", "pods") == checks  # nothing changed, nothing polled
+        pod = _ready_pod("pr-142-app-abc", "preview-pr-142")
+        pod["metadata"]["labels"].update(custom_operator.environment_labels(142))
+        server.add("pods", pod)
+        server.add("certificates", certificate)
+        for _ in range(100):
+            if not tracker.tracking(("preview-envs", "pr-142-env")):
+                break
+            await asyncio.sleep(0.01)
+        await tracker.stop()
+        return server.get("previewenvironments", "pr-142-env", "preview-envs")
+
+    environment = _run_against_fake_apiserver(scenario, module='readiness')
+    assert environment["status"] == {"ready": True, "readyAt": "2024-01-01T00:00:40Z"}
+
+def test_readiness_poll_slows_down_with_many_previews_while_unwatched():
+    tracker = ReadinessTracker(poll_interval=2, watches={})
+    tracker._tasks = {("preview-envs", f"pr-{n}-env"): None for n in range(200)}
+    assert tracker.check_interval() == 8
+    tracker._tasks = {}
+    assert tracker.check_interval() == 2
+
+# --- sharding ---
+
+def test_shard_owner_spreads_prs_and_moves_few_on_join():
+    prs = [str(n) for n in range(1, 1001)]
+    before = {pr: shard_owner(pr, ("op-0", "op-1")) for pr in prs}
+    after = {pr: shard_owner(pr, ("op-0", "op-1", "op-2")) for pr in prs}
+    assert 400 < sum(owner == "op-0" for owner in before.values()) < 600
+    moved = [pr for pr in prs if before[pr] != after[pr]]
+    # Only PRs taken over by the new replica change owner
+    assert all(after[pr] == "op-2" for pr in moved)
+    assert 250 < len(moved) < 420
+
+def test_shard_coordinator_membership_via_leases():
+    async def scenario(server):
+        first = ShardCoordinator(identity="op-0", namespace="preview-operator", enabled=True, on_rebalance=AsyncMock())
+        second = ShardCoordinator(identity="op-1", namespace="preview-operator", enabled=True)
+        await first.join()
+        await second.join()
+        await first.sync()
+        joined = first.members
+        await second.stop()
+        await first.sync()
+        return first, joined
+
+    first, joined = _run_against_fake_apiserver(scenario, module='sharding')
+    assert joined == ("op-0", "op-1")
+    assert first.members == ("op-0",)
+    assert first.on_rebalance.await_args_list[-1].args == (("op-0", "op-1"), ("op-0",))
+
+@patch('custom_operator.list_preview_environments')
+def test_rebalance_adopts_gained_and_releases_lost_prs(mock_list):
+    environments = [_environment(n) for n in range(1, 21)]
+    mock_list.return_value = environments
+    coordinator = ShardCoordinator(identity="op-0", enabled=True)
+    with patch.object(custom_operator, 'SHARD_COORDINATOR', coordinator), \
+            patch.object(custom_operator, 'adopt_environment', AsyncMock()) as mock_adopt, \
+            patch.object(custom_operator, 'release_environment') as mock_release:
+        asyncio.run(custom_operator.rebalance_environments(("op-0", "op-1"), ("op-0",)))
+        adopted = {call.args[0]['spec']['pr_number'] for call in mock_adopt.await_args_list}
+        assert adopted == {n for n in range(1, 21) if shard_owner(str(n), ("op-0", "op-1")) == "op-1"}
+        mock_release.assert_not_called()
+        mock_adopt.reset_mock()
+        asyncio.run(custom_operator.rebalance_environments(("op-0",), ("op-0", "op-1")))
+        assert {call.args[0]['spec']['pr_number'] for call in mock_release.call_args_list} == adopted
+        mock_adopt.assert_not_called()
+
+def test_cr_deletes_after_rebalance_through_its_new_owner():
+    pr_number = next(n for n in range(1, 100) if shard_owner(str(n), ("op-0", "op-1")) == "op-0")
+    spec = {**SPEC, 'pr_number': pr_number}
+    pr_namespace = f"preview-pr-{pr_number}"
+    diffbase = json.dumps({"spec": spec})
+    settings = kopf.OperatorSettings()
+    configure_persistence(settings, "op-0")
+    coordinator = ShardCoordinator(identity="op-0", enabled=True)
+    queue = DeletionQueue(delete=custom_operator.delete_namespace)
+    before = custom_operator.ACTIVE_ENVIRONMENTS._value.get()
+
+    async def scenario(server):
+        server.add("previewenvironments", {
+            "metadata": {
+                "name": "env", "namespace": "preview-envs",
+                "finalizers": [finalizer_of("op-1")], "annotations": {diffbase_annotation_of("op-1"): diffbase},
+            },
+            "spec": spec,
+            "status": {"create_fn": {"namespace": pr_namespace}},
+        })
+        server.add("namespaces", {"metadata": {"name": pr_namespace, "labels": custom_operator.environment_labels(pr_number)}})
+        # op-1 owned every PR until op-0 joined
+        await custom_operator.rebalance_environments(("op-1",), ("op-0", "op-1"))
+        env = server.get("previewenvironments", "env", "preview-envs")
+        assert env["metadata"]["finalizers"] == [settings.persistence.finalizer]
+        assert env["metadata"]["annotations"] == {diffbase_annotation_of("op-0"): diffbase}
+        assert custom_operator.ACTIVE_ENVIRONMENTS._value.get() == before + 1
+        # kopf on op-0 holds the finalizer, so its delete_fn runs once op-1 is gone
+        await custom_operator.delete_fn(spec=spec, name="env", namespace="preview-envs", status=env["status"], logger=MagicMock())
+        return server.get("namespaces", pr_namespace)
+
+    with patch.object(custom_operator, 'SHARD_COORDINATOR', coordinator), \
+            patch.object(custom_operator, 'DELETION_QUEUE', queue), \
+            patch.object(custom_operator, 'track_readiness'):
+        assert _run_against_fake_apiserver(scenario, module='custom_operator') is None
+    queue.gone(pr_namespace)
+    assert custom_operator.ACTIVE_ENVIRONMENTS._value.get() == before
+
+@patch('custom_operator.apply_object')
+def test_create_fn_adopts_environment_created_by_another_replica(mock_apply_object):
+    active_before = custom_operator.ACTIVE_ENVIRONMENTS._value.get()
+    created_before = custom_operator.ENVIRONMENTS_CREATED_ALL._value.get()
+    status = {'create_fn': {'namespace': 'preview-pr-142'}}
+    with patch.object(custom_operator, 'track_readiness'):
+        result = asyncio.run(custom_operator.create_fn(spec=SPEC, name='test', namespace='preview-envs', meta=META, status=status, patch=kopf.Patch(), logger=MagicMock()))
+    assert result == status['create_fn']
+    assert custom_operator.ACTIVE_ENVIRONMENTS._value.get() == active_before
+    assert custom_operator.ENVIRONMENTS_CREATED_ALL._value.get() == created_before
+
+def test_owned_by_this_shard_filters_handlers():
+    coordinator = ShardCoordinator(identity="op-0", enabled=True)
+    coordinator.members = ("op-0", "op-1")
+    with patch.object(custom_operator, 'SHARD_COORDINATOR', coordinator):
+        owned = [n for n in range(1, 21) if custom_operator.owned_by_this_shard(spec={'pr_number': n})]
+    assert owned == [n for n in range(1, 21) if shard_owner(str(n), ("op-0", "op-1")) == "op-0"]
+    assert ShardCoordinator(enabled=False).owns(142)
+
+# --- orphan sweeper ---
+
+def _aged_namespace(name, pr_number=None, age_seconds=3600, phase="Active", labels=None):
+    return client.V1Namespace(
+        metadata=client.V1ObjectMeta(
+            name=name,
+            labels=labels if labels is not None else {"managed-by": "preview-operator", "pr-number": str(pr_number)},
+            creation_timestamp=datetime.now(timezone.utc) - timedelta(seconds=age_seconds)
+        ),
+        status=client.V1NamespaceStatus(phase=phase)
+    )
+
+def test_orphan_sweeper_finds_only_unclaimed_namespaces():
+    sweeper = OrphanSweeper(None, None, None, owns=lambda pr_number: pr_number != "7", pooled=lambda: {"preview-warm-cd34"}, grace=600)
+    namespaces = [
+        _aged_namespace("preview-pr-1", 1),                           # CR exists
+        _aged_namespace("preview-pr-2", 2, age_seconds=7200),         # orphan
+        _aged_namespace("preview-warm-ab12", 3),                      # claimed warm namespace, orphan
+        _aged_namespace("preview-pr-4", 4, age_seconds=60),           # too young
+        _aged_namespace("preview-pr-5", 5, phase="Terminating"),      # already going
+        _aged_namespace("preview-warm-cd34", labels={"managed-by": "preview-operator", "preview-pool": "warm"}),  # in the pool
+        _aged_namespace("preview-pr-7", 7),                           # another shard's PR
+    ]
+    orphans = sweeper.find_orphans(namespaces, [_environment(1)], datetime.now(timezone.utc))
+    assert [name for name, _ in orphans] == ["preview-pr-2", "preview-warm-ab12"]
+
+def _warm_namespace(name, shard, age_seconds=3600):
+    return _aged_namespace(name, age_seconds=age_seconds, labels={"managed-by": "preview-operator", "preview-pool": "warm", "preview-shard": shard})
+
+def test_orphan_sweeper_deletes_warm_namespaces_no_pool_holds():
+    sweeper = OrphanSweeper(
+        None, None, None, owns=lambda name: name != "preview-warm-dead2", shard="op-0",
+        members=lambda: ("op-0", "op-1"), pooled=lambda: {"preview-warm-kept"}, grace=600
+    )
+    namespaces = [
+        _warm_namespace("preview-warm-kept", "op-0"),                  # in this replica's pool
+        _warm_namespace("preview-warm-extra", "op-0", 7200),           # beyond the pool size
+        _warm_namespace("preview-warm-young", "op-0", age_seconds=60),  # may still be provisioning
+        _warm_namespace("preview-warm-peer", "op-1"),                  # a live replica's pool
+        _warm_namespace("preview-warm-dead1", "op-2"),                 # replica gone, swept here
+        _warm_namespace("preview-warm-dead2", "op-2"),                 # replica gone, swept by another survivor
+    ]
+    orphans = sweeper.find_orphans(namespaces, [], datetime.now(timezone.utc))
+    assert [name for name, _ in orphans] == ["preview-warm-extra", "preview-warm-dead1"]
+
+def test_warm_pool_reuses_at_most_its_size_of_discovered_namespaces():
+    async def run():
+        pool = WarmPool(provision=AsyncMock(), bind=AsyncMock(), discover=AsyncMock(return_value=["preview-warm-a", "preview-warm-b"]), size=1)
+        pool.start()
+        await asyncio.sleep(0.01)
+        await pool.stop()
+        return pool.names()
+
+    assert asyncio.run(run()) == {"preview-warm-a"}
+
+def test_orphan_sweeper_deletes_in_batches():
+    namespaces = [_aged_namespace(f"preview-pr-{n}", n) for n in range(1, 6)]
+    delete = AsyncMock(side_effect=[None, None, None, client.exceptions.ApiException(status=500), None])
+    sweeper = OrphanSweeper(
+        AsyncMock(return_value=namespaces), AsyncMock(return_value=[]), delete,
+        batch_size=2, batch_pause=0
     )
+    assert asyncio.run(sweeper.sweep()) == 4
+    assert delete.await_count == 5
+    assert metrics.ORPHANS_FOUND._value.get() == 5
+
+# --- API governor ---
+
+def test_api_governor_admits_by_priority():
+    governor = ApiGovernor(qps=1000, burst=1000, max_in_flight=1)
+    order = []
+
+    async def request(priority, label):
+        await governor.acquire(priority)
+        order.append(label)
+        await asyncio.sleep(0)
+        governor._release()
+
+    async def run():
+        await governor.acquire(UPDATE)  # holds the only slot while the others queue
+        tasks = [asyncio.create_task(request(priority, label)) for priority, label in
+                 [(UPDATE, "update"), (CREATE, "create"), (DELETE, "delete"), (CREATE, "create-2")]]
+        await asyncio.sleep(0.01)
+        assert governor.queued() == 4
+        governor._release()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(run())
+    assert order == ["delete", "create", "create-2", "update"]
+
+def test_api_governor_honors_retry_after():
+    governor = ApiGovernor(qps=1000, burst=1000, max_in_flight=4)
+    throttled = client.exceptions.ApiException(status=429, reason="Too Many Requests")
+    throttled.headers = {"Retry-After": "0.2"}
+    send = AsyncMock(side_effect=[throttled, "ok"])
+
+    async def run():
+        started = time.monotonic()
+        result = await governor.call(send, "PATCH", "/apis/apps/v1/namespaces/x/deployments/y")
+        return result, time.monotonic() - started
+
+    result, elapsed = asyncio.run(run())
+    assert result == "ok"
+    assert send.await_count == 2
+    assert elapsed >= 0.2
+
+def test_api_governor_rate_limits_with_token_bucket():
+    governor = ApiGovernor(qps=100, burst=1, max_in_flight=10)
+    send = AsyncMock(return_value="ok")
+
+    async def run():
+        started = time.monotonic()
+        await asyncio.gather(*(governor.call(send, "GET", "/api/v1/namespaces") for _ in range(11)))
+        return time.monotonic() - started
+
+    # One request from the burst, then ten more at 100/s
+    assert asyncio.run(run()) >= 0.09
+
+# --- shared ingress ---
+
+def test_route_table_batches_changes_into_one_write():
+    apply = AsyncMock()
+    writes_before = metrics.ROUTE_TABLE_WRITES._value.get()
+
+    async def run():
+        table = RouteTable(apply=apply, flush_interval=0.05, enabled=True)
+        table.add("pr-1.preview.orimatest.com", "pr-1")
+        await asyncio.sleep(0.1)
+        apply.assert_not_called()  # never write a table that isn't fully seeded
+        table.start()
+        for pr_number in (2, 3):
+            table.add(f"pr-{pr_number}.preview.orimatest.com", f"pr-{pr_number}")
+        await asyncio.sleep(0.15)
+        table.remove("pr-1.preview.orimatest.com")
+        await table.stop()
+
+    asyncio.run(run())
+    assert apply.call_count == 2
+    assert set(apply.call_args_list[0].args[0]) == {f"pr-{n}.preview.orimatest.com" for n in (1, 2, 3)}
+    assert set(apply.call_args_list[1].args[0]) == {"pr-2.preview.orimatest.com", "pr-3.preview.orimatest.com"}
+    assert metrics.ROUTE_TABLE_WRITES._value.get() == writes_before + 2
+
+def test_route_table_retries_failed_write():
+    apply = AsyncMock(side_effect=[client.exceptions.ApiException(status=500), None])
+
+    async def run():
+        table = RouteTable(apply=apply, flush_interval=0.02, enabled=True)
+        table.add("pr-1.preview.orimatest.com", "pr-1")
+        table.start()
+        await asyncio.sleep(0.1)
+        await table.stop()
+
+    asyncio.run(run())
+    assert apply.call_count == 2
+
+def test_render_shared_ingress_uses_wildcard_certificate():
+    ingress = custom_operator.render_shared_ingress({"pr-2.preview.orimatest.com": "pr-2", "pr-1.preview.orimatest.com": "pr-1"})
+    assert ingress["spec"]["tls"][0]["hosts"] == ["*.preview.orimatest.com"]
+    assert ingress["spec"]["tls"][0]["secretName"] == route_table.WILDCARD_TLS_SECRET
+    assert [rule["host"] for rule in ingress["spec"]["rules"]] == ["pr-1.preview.orimatest.com", "pr-2.preview.orimatest.com"]
+    assert "cert-manager.io/cluster-issuer" not in ingress["metadata"].get("annotations", {})
+
+def test_shared_ingress_never_routes_errors_to_the_activator():
+    controller = IdleController(FakeTraffic(), idle_after=60)
+    with patch.object(custom_operator, 'IDLE_CONTROLLER', controller):
+        ingress = custom_operator.render_shared_ingress({"pr-1.preview.orimatest.com": "pr-1"})
+    assert "nginx.ingress.kubernetes.io/default-backend" not in ingress["metadata"].get("annotations", {})
+
+@patch('custom_operator.apply_object')
+def test_reconcile_routes_through_shared_ingress(mock_apply_object):
+    table = RouteTable(apply=AsyncMock(), enabled=True)
+    with patch.object(custom_operator, 'ROUTE_TABLE', table):
+        asyncio.run(custom_operator.reconcile_environment(SPEC))
+    applied = {call.args[0]: call for call in mock_apply_object.call_args_list}
+    assert set(applied) == {"namespace", "deployment", "service", "network_policy", "route_service"}
+    route = applied["route_service"]
+    assert route.kwargs['namespace'] == route_table.ROUTER_NAMESPACE
+    assert route.args[1]["spec"]["externalName"] == "pr-142-svc.preview-pr-142.svc.cluster.local"
+    assert table.routes() == {"pr-142.preview.orimatest.com": "pr-142"}
+
+# --- tracing and profiling ---
+
+@pytest.mark.parametrize("method,url,query,expected", [
+    ("GET", "https://k8s/api/v1/namespaces", None, ("list", "namespaces")),
+    ("GET", "https://k8s/api/v1/namespaces", [("watch", True)], ("watch", "namespaces")),
+    ("PATCH", "https://k8s/api/v1/namespaces/preview-pr-1", None, ("patch", "namespaces")),
+    ("GET", "https://k8s/apis/apps/v1/namespaces/preview-pr-1/deployments/pr-1-app", None, ("get", "deployments")),
+    ("PATCH", "https://k8s/apis/devops.orima.com/v1/namespaces/preview-envs/previewenvironments/pr-1-env/status", None, ("patch", "previewenvironments/status")),
+    ("GET", "https://k8s/apis/apps/v1/deployments", None, ("list", "deployments")),
+])
+def test_request_labels(method, url, query, expected):
+    assert tracing.request_labels(method, url, query) == expected
+
+@patch('custom_operator.apply_object')
+def test_reconcile_is_traced_per_step(mock_apply_object):
+    with patch.object(tracing, 'TRACE_BUFFER', tracing.TraceBuffer(10)) as buffer:
+        asyncio.run(custom_operator.reconcile_environment(SPEC))
+        asyncio.run(custom_operator.reconcile_environment(SPEC))
+        traces = buffer.recent()
+    assert len(traces) == 2
+    root, *steps = sorted(traces[0]["spans"], key=lambda span: span["parent_id"] or 0)
+    assert root["name"] == "reconcile" and root["attributes"] == {"pr_number": 142}
+    assert {span["name"] for span in steps} == {"namespace", "deployment", "service", "ingress", "network_policy"}
+    assert all(span["parent_id"] == root["span_id"] for span in steps)
+
+def test_spans_outside_a_trace_are_not_recorded():
+    with patch.object(tracing, 'TRACE_BUFFER', tracing.TraceBuffer(10)) as buffer:
+        with tracing.span("poll") as current:
+            assert current is None
+        assert buffer.recent() == []
+
+def test_instrumented_requests_record_latency_and_spans():
+    def samples(verb, resource, code):
+        return REGISTRY.get_sample_value(
+            "preview_operator_api_request_duration_seconds_count",
+            {"verb": verb, "resource": resource, "code": code}
+        ) or 0
+
+    async def scenario(server):
+        api_client = custom_operator.get_api_client()
+        api_client.rest_client.request = tracing.instrument(api_client.rest_client.request)
+        tracing.instrument_serialization(api_client)
+        body = custom_operator.render_deployment("pr-142-app", "orim2002/my-app", "v1", 142)
+        with tracing.trace("create"):
+            await custom_operator.apply_object("deployment", body, namespace="preview-pr-142")
+            with pytest.raises(client.exceptions.ApiException):
+                await client.AppsV1Api(api_client).read_namespaced_deployment("missing", "preview-pr-142")
+
+    created_before, missing_before = samples("patch", "deployments", "201"), samples("get", "deployments", "404")
+    with patch.object(tracing, 'TRACE_BUFFER', tracing.TraceBuffer(10)) as buffer:
+        _run_against_fake_apiserver(scenario, module='custom_operator')
+        trace_ = buffer.recent()[0]
+    assert samples("patch", "deployments", "201") == created_before + 1
+    assert samples("get", "deployments", "404") == missing_before + 1
+    root = trace_["spans"][0]
+    patch_span = next(span for span in trace_["spans"] if span["name"] == "patch deployments")
+    assert patch_span["parent_id"] == root["span_id"] and patch_span["attributes"]["code"] == "201"
+    assert root["attributes"]["serialize_ms"] > 0
+
+def test_profiler_samples_target_thread():
+    def busy_loop_for_profile(stop):
+        while not stop.is_set():
+            sum(range(1000))
+
+    stop = threading.Event()
+    worker = threading.Thread(target=busy_loop_for_profile, args=(stop,))
+    worker.start()
+    try:
+        profiler = SamplingProfiler(interval=0.001, max_seconds=1)
+        profiler.attach(worker.ident)
+        output = profiler.profile(0.05)
+        with pytest.raises(ValueError):
+            profiler.profile(5)
+    finally:
+        stop.set()
+        worker.join()
+    assert "busy_loop_for_profile" in output
+    stack, count = output.splitlines()[0].rsplit(" ", 1)
+    assert int(count) > 0
+
+def test_metrics_server_serves_debug_routes():
+    def broken(query):
+        raise ValueError("bad input")
+
+    server = metrics.start_metrics_server(port=0, debug_routes={
+        "/debug/traces": tracing.traces_endpoint,
+        "/debug/broken": broken,
+    })
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    try:
+        with urllib.request.urlopen(f"{base}/debug/traces?limit=5") as response:
+            assert isinstance(json.loads(response.read()), list)
+        with urllib.request.urlopen(f"{base}/metrics") as response:
+            assert b"preview_operator_api_request_duration_seconds" in response.read()
+        with pytest.raises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(f"{base}/debug/broken")
+        assert error.value.code == 400
+    finally:
+        server.shutdown()
+        server.server_close()
+
+# --- startup ---
+
+def test_readyz_waits_for_startup_while_healthz_passes():
+    ready = False
+    server = metrics.start_metrics_server(port=0, ready=lambda: ready)
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    try:
+        with urllib.request.urlopen(f"{base}/healthz") as response:
+            assert response.status == 200
+        with pytest.raises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(f"{base}/readyz")
+        assert error.value.code == 503
+        ready = True
+        with urllib.request.urlopen(f"{base}/readyz") as response:
+            assert response.status == 200
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def test_startup_phase_records_duration_even_on_failure():
+    with pytest.raises(RuntimeError):
+        with custom_operator.startup_phase("config"):
+            time.sleep(0.01)
+            raise RuntimeError("no kubeconfig")
+    assert REGISTRY.get_sample_value('preview_operator_startup_phase_seconds', {'phase': 'config'}) >= 0.01
+    assert REGISTRY.get_sample_value('preview_operator_startup_phase_seconds', {'phase': 'import'}) > 0
+
+# --- admission queue ---
+
+REQUEST = {"cpu": "100m", "memory": "128Mi"}
+
+def test_admission_queue_admits_by_priority_as_slots_free():
+    queue = AdmissionQueue(REQUEST, max_environments=1, budget={})
+    created = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    assert queue.try_admit(("ns", "a"), 0, created) == (True, None)
+    assert queue.try_admit(("ns", "b"), 0, created + timedelta(seconds=1)) == (False, 1)
+    assert queue.try_admit(("ns", "c"), 10, created + timedelta(seconds=2)) == (False, 1)
+    assert queue.position(("ns", "b")) == 2
+    queue.release(("ns", "a"))
+    assert queue.admitted(("ns", "c")) and not queue.admitted(("ns", "b"))
+    queue.release(("ns", "b"))  # deleted while queued
+    queue.release(("ns", "c"))
+    assert queue.position(("ns", "b")) is None and not queue.admitted(("ns", "b"))
+
+def test_admission_capacity_from_budget_and_node_pool():
+    queue = AdmissionQueue(REQUEST, budget={"cpu": "1", "memory": "1Gi"}, members=lambda: 2)
+    assert queue.capacity() == 4  # memory allows 8, split across two replicas
+    nodes = [MagicMock(status=MagicMock(allocatable={"cpu": "500m", "memory": "4Gi"})) for _ in range(2)]
+    pooled = AdmissionQueue(REQUEST, budget={}, list_nodes=AsyncMock(return_value=nodes))
+    assert pooled.enabled and pooled.capacity() is None
+    asyncio.run(pooled.refresh())
+    assert pooled.capacity() == 10  # CPU is the tighter of the two
+    assert not AdmissionQueue(REQUEST, budget={}).enabled
+
+def test_branch_priority():
+    rules = parse_priorities("release/*=100, main=50")
+    assert branch_priority("release/1.2", rules) == 100
+    assert branch_priority("main", rules) == 50
+    assert branch_priority("feature-x", rules) == 0
+
+@patch('custom_operator.client.NetworkingV1Api', return_value=AsyncMock())
+@patch('custom_operator.client.CoreV1Api', return_value=AsyncMock())
+@patch('custom_operator.client.AppsV1Api', return_value=AsyncMock())
+def test_create_fn_waits_in_admission_queue(mock_apps_v1, mock_core_v1, mock_networking_v1):
+    queue = AdmissionQueue(REQUEST, max_environments=1, budget={})
+    queue.mark_admitted(("preview-envs", "running"))
+    waits_before = REGISTRY.get_sample_value("preview_admission_wait_seconds_count")
+    with patch.object(custom_operator, 'ADMISSION_QUEUE', queue):
+        patch_ = kopf.Patch()
+        with pytest.raises(kopf.TemporaryError):
+            asyncio.run(custom_operator.create_fn(spec=SPEC, name='test', namespace='preview-envs', meta=META, status={}, patch=patch_, logger=MagicMock()))
+        assert patch_.status['admission'] == {'state': 'Queued', 'position': 1}
+        mock_apps_v1.return_value.patch_namespaced_deployment.assert_not_called()
+
+        queue.release(("preview-envs", "running"))
+        patch_ = kopf.Patch()
+        asyncio.run(custom_operator.create_fn(spec=SPEC, name='test', namespace='preview-envs', meta=META, status={'admission': {'state': 'Queued', 'position': 1}}, patch=patch_, logger=MagicMock()))
+    assert patch_.status['admission'] == {'state': 'Admitted'}
+    mock_apps_v1.return_value.patch_namespaced_deployment.assert_called_once()
+    assert REGISTRY.get_sample_value("preview_admission_wait_seconds_count") == waits_before + 1
+
+@patch('custom_operator.missing_namespaces', {('preview-envs', 'queued')})
+@patch('custom_operator.apply_object')
+def test_resume_fn_leaves_queued_environment_to_create_fn(mock_apply_object):
+    queue = AdmissionQueue(REQUEST, max_environments=1, budget={})
+    before = custom_operator.ACTIVE_ENVIRONMENTS._value.get()
+    with patch.object(custom_operator, 'ADMISSION_QUEUE', queue):
+        status = {'admission': {'state': 'Queued', 'position': 1}}
+        asyncio.run(custom_operator.resume_fn(name='queued', namespace='preview-envs', spec=SPEC, meta=META, status=status, logger=MagicMock()))
+    mock_apply_object.assert_not_called()
+    assert custom_operator.ACTIVE_ENVIRONMENTS._value.get() == before
+
+@patch('custom_operator.missing_namespaces', None)
+@patch('custom_operator.client.CustomObjectsApi', return_value=AsyncMock())
+@patch('custom_operator.client.CoreV1Api', return_value=AsyncMock())
+def test_bulk_resume_does_not_count_queued_environments_as_missing(mock_core_v1, mock_custom_api):
+    mock_core_v1.return_value.list_namespace.return_value = client.V1NamespaceList(items=[_namespace(1)], metadata=client.V1ListMeta())
+    created = _environment(1)
+    queued = _environment(2, created=False)
+    queued['metadata']['creationTimestamp'] = "2026-01-01T00:00:00Z"
+    mock_custom_api.return_value.list_cluster_custom_object.return_value = {'items': [created, queued], 'metadata': {}}
+    queue = AdmissionQueue(REQUEST, max_environments=1, budget={})
+    with patch.object(custom_operator, 'ADMISSION_QUEUE', queue):
+        asyncio.run(custom_operator.bulk_resume())
+    assert custom_operator.ACTIVE_ENVIRONMENTS._value.get() == 1
+    assert custom_operator.missing_namespaces == set()
+
+@patch('custom_operator.client.CoreV1Api', return_value=AsyncMock())
+def test_delete_fn_of_queued_environment_frees_its_place_without_uncounting(mock_core_v1):
+    queue = AdmissionQueue(REQUEST, max_environments=1, budget={})
+    queue.mark_admitted(("preview-envs", "running"))
+    before = custom_operator.ACTIVE_ENVIRONMENTS._value.get()
+    with patch.object(custom_operator, 'ADMISSION_QUEUE', queue):
+        patch_ = kopf.Patch()
+        with pytest.raises(kopf.TemporaryError):
+            asyncio.run(custom_operator.create_fn(spec=SPEC, name='queued', namespace='preview-envs', meta=META, status={}, patch=patch_, logger=MagicMock()))
+        asyncio.run(custom_operator.delete_fn(spec=SPEC, name='queued', namespace='preview-envs', status=dict(patch_.status), logger=MagicMock()))
+        assert queue.position(("preview-envs", "queued")) is None
+    mock_core_v1.return_value.delete_namespace.assert_not_called()
+    assert custom_operator.ACTIVE_ENVIRONMENTS._value.get() == before
+
+@patch('custom_operator.apply_object')
+def test_rebalance_leaves_queued_environment_to_create_fn(mock_apply_object):
+    queue = AdmissionQueue(REQUEST, max_environments=1, budget={})
+    queued = {'metadata': {'namespace': 'preview-envs', 'name': 'queued'}, 'spec': SPEC, 'status': {'admission': {'state': 'Queued', 'position': 1}}}
+    before = custom_operator.ACTIVE_ENVIRONMENTS._value.get()
+    with patch.object(custom_operator, 'ADMISSION_QUEUE', queue):
+        asyncio.run(custom_operator.adopt_environment(queued))
+        assert not queue.admitted(("preview-envs", "queued"))
+        custom_operator.release_environment(queued)
+    mock_apply_object.assert_not_called()
+    assert custom_operator.ACTIVE_ENVIRONMENTS._value.get() == before
+
+# --- image pre-pull ---
+
+def _prepull_controller(server, states):
+    """Plays the DaemonSet controller and kubelets: one pre-pull pod per node, its init container in `states[node]`."""
+    def on_change(plural, event_type, obj):
+        if plural != "daemonsets" or event_type != "ADDED":
+            return
+        obj["status"] = {"observedGeneration": 1, "desiredNumberScheduled": len(states), "currentNumberScheduled": len(states), "numberMisscheduled": 0, "numberReady": 0}
+        labels = obj["spec"]["template"]["metadata"]["labels"]
+        for node, state in states.items():
+            server.add("pods", {
+                "apiVersion": "v1",
+                "kind": "Pod",
+                "metadata": {"name": f"{obj['metadata']['name']}-{node}", "namespace": IMAGE_PREPULL_NAMESPACE, "labels": labels},
+                "spec": {"nodeName": node, "containers": [{"name": "pause"}]},
+                "status": {"initContainerStatuses": [
+                    {"name": "prepull", "image": "", "imageID": "", "ready": False, "restartCount": 0, "state": state},
+                ]},
+            })
+    server.on_change(on_change)
+
+def test_image_prepuller_pulls_on_every_node_then_removes_daemonset():
+    image = "orim2002/my-app:v2"
+    pulled_before = REGISTRY.get_sample_value('preview_image_prepulls_total', {'result': 'pulled'})
+    puller = ImagePrePuller(
+        apply=custom_operator.apply_prepull, progress=custom_operator.prepull_progress,
+        remove=custom_operator.remove_prepull, enabled=True, poll_interval=0.01,
+    )
+
+    async def scenario(server):
+        _prepull_controller(server, {
+            "node-a": {"terminated": {"exitCode": 0}},
+            "node-b": {"waiting": {"reason": "RunContainerError"}},  # image has no shell, but it was pulled
+        })
+        puller.request(image)
+        pulled = await puller.wait(image)
+        return pulled, server.objects.get("daemonsets", {})
+
+    pulled, daemon_sets = _run_against_fake_apiserver(scenario, module='custom_operator')
+    assert pulled
+    assert daemon_sets == {}
+    assert REGISTRY.get_sample_value('preview_image_prepulls_total', {'result': 'pulled'}) == pulled_before + 1
+
+def test_image_prepuller_times_out_and_rolls_out_anyway():
+    remove = AsyncMock()
+    puller = ImagePrePuller(apply=AsyncMock(), progress=AsyncMock(return_value=(1, 2)), remove=remove, enabled=True, timeout=0.05, poll_interval=0.01)
+
+    async def run():
+        puller.request("orim2002/my-app:v2")
+        return await puller.wait("orim2002/my-app:v2")
+
+    assert asyncio.run(run()) is False
+    remove.assert_awaited_once_with("orim2002/my-app:v2")
+    assert puller.pulling() == set()
+
+@patch.object(custom_operator.UPDATE_COALESCER, 'quiet_window', 0)
+@patch('custom_operator.apply_object')
+def test_update_fn_prepulls_only_new_images(mock_apply_object):
+    spec = {'pr_number': 142, 'branch_name': 'feature-x', 'image': 'orim2002/my-app', 'image_tag': 'v1'}
+    events = []
+    apply = AsyncMock(side_effect=lambda image: events.append(("prepull", image)))
+    mock_apply_object.side_effect = lambda step, body, namespace=None: events.append(("apply", step))
+    puller = ImagePrePuller(apply=apply, progress=AsyncMock(return_value=(1, 1)), remove=AsyncMock(), enabled=True)
+    with patch.object(custom_operator, 'RESOURCE_CACHE', _applied_cache(spec)), \
+            patch.object(custom_operator, 'IMAGE_PREPULLER', puller):
+        asyncio.run(custom_operator.update_fn(spec={**spec, 'ttl_seconds': 60}, name='test', namespace='preview-envs', status={}, meta=META, logger=MagicMock()))
+        apply.assert_not_called()
+        asyncio.run(custom_operator.update_fn(spec={**spec, 'image_tag': 'v2'}, name='test', namespace='preview-envs', status={}, meta=META, logger=MagicMock()))
+    assert events == [("prepull", "orim2002/my-app:v2"), ("apply", "deployment")]
+
+def test_render_prepull_daemonset_pulls_image_in_init_container():
+    daemon_set = custom_operator.render_prepull_daemonset("orim2002/my-app:v2")
+    pod = daemon_set["spec"]["template"]["spec"]
+    assert daemon_set["metadata"]["name"] == prepull_name("orim2002/my-app:v2")
+    assert pod["initContainers"][0]["image"] == "orim2002/my-app:v2"
+    assert daemon_set["spec"]["selector"]["matchLabels"].items() <= daemon_set["spec"]["template"]["metadata"]["labels"].items()
+
+# --- benchmark harness ---
+
+def test_benchmark_runs_every_scenario():
+    import benchmark
+    import kube_client
+
+    args = benchmark.parse_args([
+        "--creates", "5", "--storm-prs", "2", "--storm-updates", "3", "--quiet-window", "0.05",
+        "--resume-crs", "20", "--ttl-crs", "20", "--timeout", "10", "--import-runs", "1", "--render-iterations", "10",
+    ])
+    with patch.object(custom_operator, 'get_api_client', kube_client.get_api_client):
+        report = asyncio.run(benchmark.main(args))
+    results = report["results"]
+    assert set(results) == set(benchmark.SCENARIOS)
+    assert results["creates"]["errors"] == 0
+    assert results["update_storm"]["rollouts"] == 2  # one per PR after coalescing
+    assert results["ttl_sweep"]["remaining"] == 0
+    assert results["import"]["operator_seconds"] > 0
+    assert results["render"]["render_us"] > 0
+    assert report["peak_rss_mb"] > 0
+    json.dumps(report)
+
+# --- kube_client ---
+
+def test_get_api_client_is_shared():
+    import kube_client
+
+    async def run():
+        first = kube_client.get_api_client()
+        second = kube_client.get_api_client()
+        connector = first.rest_client.pool_manager.connector
+        await kube_client.close_api_client()
+        return first, second, connector
+
+    first, second, connector = asyncio.run(run())
+    assert first is second
+    assert connector.limit == kube_client.API_POOL_SIZE
+    assert kube_client._api_client is None
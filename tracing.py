@@ -0,0 +1,198 @@
+import contextlib
+import contextvars
+import itertools
+import json
+import logging
+import os
+import time
+from collections import deque
+from urllib.parse import urlsplit
+from kubernetes_asyncio.client.exceptions import ApiException
+from metrics import API_REQUEST_DURATION, API_SERIALIZATION_DURATION, TRACE_SPANS_DROPPED
+
+logger = logging.getLogger(__name__)
+
+TRACE_BUFFER_SIZE = int(os.environ.get("TRACE_BUFFER_SIZE", "200")) # finished traces kept for /debug/traces; 0 disables tracing
+MAX_SPANS_PER_TRACE = 500 # spans beyond this are counted and dropped
+
+_current = contextvars.ContextVar("current_span", default=None)
+_ids = itertools.count(1)
+
+
+class Span:
+    __slots__ = ("trace", "name", "span_id", "parent_id", "start", "duration", "attributes")
+
+    def __init__(self, trace, name, parent_id, attributes):
+        self.trace = trace
+        self.name = name
+        self.span_id = next(_ids)
+        self.parent_id = parent_id
+        self.start = time.time()
+        self.duration = None
+        self.attributes = attributes
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": self.start,
+            "duration_ms": round(self.duration * 1000, 3),
+            "attributes": self.attributes,
+        }
+
+
+class Trace:
+    def __init__(self):
+        self.trace_id = next(_ids)
+        self.spans = []
+        self.open = True
+
+    def to_dict(self):
+        root = self.spans[-1]  # the root finishes last
+        return {
+            "trace_id": self.trace_id,
+            "name": root.name,
+            "duration_ms": round(root.duration * 1000, 3),
+            "spans": [span.to_dict() for span in sorted(self.spans, key=lambda span: span.start)],
+        }
+
+
+class TraceBuffer:
+    """In-process exporter: keeps the last `size` finished traces in memory."""
+
+    def __init__(self, size=TRACE_BUFFER_SIZE):
+        self.size = size
+        self._traces = deque(maxlen=max(size, 1))
+
+    def export(self, trace):
+        self._traces.append(trace)
+
+    def recent(self, limit=None, min_ms=0.0):
+        """Newest first, optionally only traces that took at least `min_ms`."""
+        traces = [trace.to_dict() for trace in reversed(self._traces)]
+        traces = [trace for trace in traces if trace["duration_ms"] >= min_ms]
+        return traces[:limit] if limit else traces
+
+TRACE_BUFFER = TraceBuffer()
+
+
+@contextlib.contextmanager
+def span(name, root=False, **attributes):
+    """Time the enclosed block as a span of the current trace.
+
+    With `root=True` a new trace is started when there is no open one;
+    otherwise the span is only recorded inside an open trace, so
+    background work started by a finished handler costs nothing. The
+    trace is exported once its root span ends.
+    """
+    parent = _current.get()
+    if parent is not None and parent.trace.open:
+        trace, parent_id = parent.trace, parent.span_id
+    elif root and TRACE_BUFFER.size > 0:
+        trace, parent_id = Trace(), None
+    else:
+        yield None
+        return
+    current = Span(trace, name, parent_id, attributes)
+    token = _current.set(current)
+    started = time.perf_counter()
+    try:
+        yield current
+    except BaseException as e:
+        current.attributes["error"] = type(e).__name__
+        raise
+    finally:
+        current.duration = time.perf_counter() - started
+        _current.reset(token)
+        if trace.open:
+            if len(trace.spans) < MAX_SPANS_PER_TRACE or parent_id is None:
+                trace.spans.append(current)
+            else:
+                TRACE_SPANS_DROPPED.inc()
+        if parent_id is None:
+            trace.open = False
+            TRACE_BUFFER.export(trace)
+
+def trace(name, **attributes):
+    """Start a trace (or a child span, inside an open one) for one reconcile."""
+    return span(name, root=True, **attributes)
+
+
+def request_labels(method, url, query_params=None):
+    """Verb and resource of a Kubernetes API request, for metric labels."""
+    parts = [part for part in urlsplit(url).path.split("/") if part]
+    parts = parts[2:] if parts[:1] == ["api"] else parts[3:]  # drop api/v1 or apis/group/version
+    if len(parts) >= 3 and parts[0] == "namespaces":
+        parts = parts[2:]
+    resource = "/".join(parts[:1] + parts[2:3]) or "unknown"  # e.g. deployments or deployments/status
+    verb = method.lower()
+    if method == "GET":
+        if any(key == "watch" and value for key, value in query_params or []):
+            verb = "watch"
+        elif len(parts) < 2:
+            verb = "list"
+    return verb, resource
+
+def instrument(send):
+    """Wrap a RESTClientObject.request to record latency and status code per call."""
+    async def request(method, url, query_params=None, **kwargs):
+        verb, resource = request_labels(method, url, query_params)
+        if verb == "watch":
+            return await send(method, url, query_params=query_params, **kwargs)
+        code = "error"
+        started = time.perf_counter()
+        with span(f"{verb} {resource}", verb=verb, resource=resource) as current:
+            try:
+                response = await send(method, url, query_params=query_params, **kwargs)
+                code = str(response.status)
+                return response
+            except ApiException as e:
+                code = str(e.status)
+                raise
+            finally:
+                API_REQUEST_DURATION.labels(verb=verb, resource=resource, code=code).observe(time.perf_counter() - started)
+                if current is not None:
+                    current.set(code=code)
+    return request
+
+def instrument_serialization(api_client):
+    """Time request body serialization and response deserialization in the operator."""
+    sanitize, deserialize = api_client.sanitize_for_serialization, api_client.deserialize
+    depth = 0
+
+    def timed(stage, fn, *args):
+        started = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            elapsed = time.perf_counter() - started
+            API_SERIALIZATION_DURATION.labels(stage=stage).observe(elapsed)
+            current = _current.get()
+            if current is not None and current.trace.open:
+                key = f"{stage}_ms"
+                current.attributes[key] = round(current.attributes.get(key, 0.0) + elapsed * 1000, 3)
+
+    def sanitize_for_serialization(obj):
+        # Recursive; only the outermost call is timed
+        nonlocal depth
+        if depth:
+            return sanitize(obj)
+        depth += 1
+        try:
+            return timed("serialize", sanitize, obj)
+        finally:
+            depth -= 1
+
+    api_client.sanitize_for_serialization = sanitize_for_serialization
+    api_client.deserialize = lambda response, response_type: timed("deserialize", deserialize, response, response_type)
+
+
+def traces_endpoint(query):
+    """/debug/traces?limit=N&min_ms=M: recent traces as JSON."""
+    limit = int(query.get("limit", "20"))
+    min_ms = float(query.get("min_ms", "0"))
+    return "application/json", json.dumps(TRACE_BUFFER.recent(limit, min_ms), indent=2)
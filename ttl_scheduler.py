@@ -0,0 +1,105 @@
+import asyncio
+import heapq
+import logging
+import os
+import time
+from metrics import TTL_EXPIRY_LAG, TTL_SCHEDULED
+
+logger = logging.getLogger(__name__)
+
+TTL_BATCH_SIZE = int(os.environ.get("TTL_BATCH_SIZE", "50")) # max environments deleted per scheduler wake-up
+TTL_RETRY_SECONDS = 30 # how long to wait before retrying a failed expiry
+
+
+class TTLScheduler:
+    """Single min-heap of TTL deadlines for every PreviewEnvironment.
+
+    Handlers call schedule()/cancel() as CRs are created, updated and
+    deleted. run() sleeps until the earliest deadline (or until a nearer
+    one is scheduled) and hands expired keys to `expire` in batches.
+    `expire` is an async callable taking a list of keys and returning the
+    keys it failed to expire, which are retried after TTL_RETRY_SECONDS.
+    """
+
+    def __init__(self, expire, batch_size=TTL_BATCH_SIZE):
+        self._expire = expire
+        self._batch_size = batch_size
+        self._heap = []  # (deadline, key); may hold stale entries
+        self._deadlines = {}  # key -> current deadline, the source of truth
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def schedule(self, key, deadline):
+        if self._deadlines.get(key) == deadline:
+            return
+        self._deadlines[key] = deadline
+        heapq.heappush(self._heap, (deadline, key))
+        self._compact()
+        TTL_SCHEDULED.set(len(self._deadlines))
+        self._wakeup.set()
+
+    def cancel(self, key):
+        # Heap entry stays behind and is skipped when popped
+        if self._deadlines.pop(key, None) is not None:
+            TTL_SCHEDULED.set(len(self._deadlines))
+
+    def next_deadline(self):
+        while self._heap and self._deadlines.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    def pop_expired(self, now):
+        expired = []
+        while len(expired) < self._batch_size:
+            deadline = self.next_deadline()
+            if deadline is None or deadline > now:
+                break
+            _, key = heapq.heappop(self._heap)
+            del self._deadlines[key]
+            TTL_EXPIRY_LAG.observe(now - deadline)
+            expired.append(key)
+        TTL_SCHEDULED.set(len(self._deadlines))
+        return expired
+
+    def _compact(self):
+        if len(self._heap) > 2 * len(self._deadlines) + 64:
+            self._heap = [(deadline, key) for key, deadline in self._deadlines.items()]
+            heapq.heapify(self._heap)
+
+    async def run(self):
+        while True:
+            self._wakeup.clear()
+            now = time.time()
+            expired = self.pop_expired(now)
+            if expired:
+                try:
+                    failed = await self._expire(expired)
+                except Exception as e:
+                    logger.error(f"TTL expiry batch failed: {e}")
+                    failed = expired
+                for key in failed or []:
+                    self.schedule(key, now + TTL_RETRY_SECONDS)
+                continue
+            deadline = self.next_deadline()
+            timeout = None if deadline is None else max(deadline - now, 0)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+            logger.info("TTL scheduler started")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -0,0 +1,93 @@
+import asyncio
+import logging
+import os
+import time
+from metrics import UPDATES_RECEIVED, UPDATES_APPLIED
+
+logger = logging.getLogger(__name__)
+
+UPDATE_QUIET_WINDOW_SECONDS = float(os.environ.get("UPDATE_QUIET_WINDOW_SECONDS", "5")) # apply once a PR has had no new spec for this long
+UPDATE_MAX_DELAY_SECONDS = float(os.environ.get("UPDATE_MAX_DELAY_SECONDS", "30")) # never hold an update back longer than this
+
+
+class UpdateCoalescer:
+    """Per-key debouncer for rapid spec updates.
+
+    submit() records the latest value for a key; once the key has been
+    quiet for `quiet_window` seconds (or `max_delay` has passed since the
+    first pending value) only that latest value is handed to `apply`.
+    Intermediate values are dropped. A failed apply is retried after
+    another quiet window unless a newer value has arrived meanwhile.
+    With `quiet_window <= 0` values are applied inline.
+    """
+
+    def __init__(self, apply, quiet_window=UPDATE_QUIET_WINDOW_SECONDS, max_delay=UPDATE_MAX_DELAY_SECONDS):
+        self._apply = apply
+        self.quiet_window = quiet_window
+        self.max_delay = max_delay
+        self._pending = {}  # key -> (value, first submitted, last submitted)
+        self._tasks = {}
+
+    def pending(self):
+        return len(self._pending)
+
+    async def submit(self, key, value):
+        UPDATES_RECEIVED.inc()
+        if self.quiet_window <= 0:
+            await self._apply(key, value)
+            UPDATES_APPLIED.inc()
+            return
+        now = time.monotonic()
+        first_submitted = self._pending[key][1] if key in self._pending else now
+        self._pending[key] = (value, first_submitted, now)
+        if key not in self._tasks:
+            self._tasks[key] = asyncio.create_task(self._flush_later(key))
+
+    def cancel(self, key):
+        self._pending.pop(key, None)
+        task = self._tasks.pop(key, None)
+        if task is not None:
+            task.cancel()
+
+    async def _flush_later(self, key):
+        try:
+            while key in self._pending:
+                _, first_submitted, last_submitted = self._pending[key]
+                due = min(last_submitted + self.quiet_window, first_submitted + self.max_delay)
+                delay = due - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    continue
+                value, _, _ = self._pending.pop(key)
+                await self._apply_or_requeue(key, value)
+        finally:
+            if self._tasks.get(key) is asyncio.current_task():
+                del self._tasks[key]
+
+    async def _apply_or_requeue(self, key, value):
+        try:
+            await self._apply(key, value)
+            UPDATES_APPLIED.inc()
+        except Exception as e:
+            logger.error(f"Coalesced update for {key} failed, retrying: {e}")
+            if key not in self._pending:
+                now = time.monotonic()
+                self._pending[key] = (value, now, now)
+
+    async def drain(self):
+        """Wait until every pending value has been applied (or dropped after cancel())."""
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks.values()), return_exceptions=True)
+
+    async def flush(self):
+        """Apply every pending value now, e.g. on shutdown."""
+        for task in list(self._tasks.values()):
+            task.cancel()
+        self._tasks.clear()
+        pending, self._pending = self._pending, {}
+        for key, (value, _, _) in pending.items():
+            try:
+                await self._apply(key, value)
+                UPDATES_APPLIED.inc()
+            except Exception as e:
+                logger.error(f"Failed to flush pending update for {key}: {e}")
@@ -0,0 +1,106 @@
+import asyncio
+import logging
+import os
+import secrets
+import time
+from collections import deque
+from metrics import WARM_POOL_CLAIMS, WARM_POOL_CLAIM_DURATION, WARM_POOL_READY
+
+logger = logging.getLogger(__name__)
+
+WARM_POOL_SIZE = int(os.environ.get("WARM_POOL_SIZE", "0")) # pre-provisioned namespaces to keep ready; 0 disables the pool
+WARM_POOL_RETRY_SECONDS = 10 # back-off after a failed refill
+WARM_NAMESPACE_PREFIX = "preview-warm-"
+
+
+def warm_namespace_name():
+    return f"{WARM_NAMESPACE_PREFIX}{secrets.token_hex(4)}"
+
+
+class WarmPool:
+    """Keeps `size` preview namespaces provisioned ahead of demand.
+
+    `provision(name)` creates a namespace with its generic plumbing,
+    `bind(name, pr_number)` hands a ready namespace to a PR and
+    `discover()` returns the names of ready namespaces left over from a
+    previous run; at most `size` of them are reused, the rest are left to
+    the orphan sweeper. Claims are served from memory; refill runs in the
+    background whenever the pool drops below `size`.
+    """
+
+    def __init__(self, provision, bind, discover, size=WARM_POOL_SIZE):
+        self._provision = provision
+        self._bind = bind
+        self._discover = discover
+        self.size = size
+        self._ready = deque()
+        self._binding = set()
+        self._refill = asyncio.Event()
+        self._task = None
+
+    @property
+    def enabled(self):
+        return self.size > 0
+
+    def ready(self):
+        return len(self._ready)
+
+    def names(self):
+        """Warm namespaces this pool holds, including ones being bound to a PR right now."""
+        return set(self._ready) | self._binding
+
+    async def claim(self, pr_number):
+        """Bind a ready namespace to `pr_number`, or return None if the pool is empty."""
+        started = time.monotonic()
+        while self._ready:
+            name = self._ready.popleft()
+            WARM_POOL_READY.set(len(self._ready))
+            self._refill.set()
+            self._binding.add(name)
+            try:
+                await self._bind(name, pr_number)
+            except Exception as e:
+                logger.warning(f"Could not claim warm namespace {name}: {e}")
+                continue
+            finally:
+                self._binding.discard(name)
+            WARM_POOL_CLAIMS.labels(result="hit").inc()
+            WARM_POOL_CLAIM_DURATION.observe(time.monotonic() - started)
+            logger.info(f"PR {pr_number} claimed warm namespace {name}")
+            return name
+        WARM_POOL_CLAIMS.labels(result="miss").inc()
+        return None
+
+    async def run(self):
+        try:
+            self._ready.extend((await self._discover())[:self.size])
+        except Exception as e:
+            logger.warning(f"Could not discover existing warm namespaces: {e}")
+        WARM_POOL_READY.set(len(self._ready))
+        while True:
+            while len(self._ready) < self.size:
+                name = warm_namespace_name()
+                try:
+                    await self._provision(name)
+                except Exception as e:
+                    logger.error(f"Failed to provision warm namespace {name}: {e}")
+                    await asyncio.sleep(WARM_POOL_RETRY_SECONDS)
+                    continue
+                self._ready.append(name)
+                WARM_POOL_READY.set(len(self._ready))
+            self._refill.clear()
+            await self._refill.wait()
+
+    def start(self):
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self.run())
+            logger.info(f"Warm pool started (size={self.size})")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None